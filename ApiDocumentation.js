@@ -57,6 +57,66 @@ function ApiDocumentation() {
       ],
       example: '```\nGET /api/art/123\n```'
     },
+    {
+      method: 'GET',
+      endpoint: '/api/art/',
+      description: 'Browse the catalog, newest first, one page at a time; with Accept: application/x-ndjson every match is streamed',
+      parameters: [
+        { name: 'limit', type: 'query', description: 'Page size (default 20, max 100)' },
+        { name: 'cursor', type: 'query', description: 'next_cursor value from the previous page' },
+        { name: 'style', type: 'query', description: 'Comma-separated styles to include' },
+        { name: 'color_palette', type: 'query', description: 'Comma-separated color palettes to include' },
+        { name: 'theme', type: 'query', description: 'Comma-separated themes to include' }
+      ],
+      example: '```\nGET /api/art/?style=geometric&limit=50&cursor=WyIyMDI1LTA0LTAzVDEyOjMxOjAyIiwgNDJd\n```'
+    },
+    {
+      method: 'GET',
+      endpoint: '/api/art/export',
+      description: 'Stream the whole art catalog as newline-delimited JSON, one record per line',
+      parameters: [],
+      example: '```\nGET /api/art/export\nAccept: application/x-ndjson\n```'
+    },
+    {
+      method: 'GET',
+      endpoint: '/api/art/facets',
+      description: 'Count catalog art pieces per style, color palette and theme',
+      parameters: [
+        { name: 'style', type: 'query', description: 'Comma-separated styles to filter by' },
+        { name: 'color_palette', type: 'query', description: 'Comma-separated color palettes to filter by' },
+        { name: 'theme', type: 'query', description: 'Comma-separated themes to filter by' }
+      ],
+      example: '```\nGET /api/art/facets?theme=space,ocean\n```'
+    },
+    {
+      method: 'GET',
+      endpoint: '/api/art/{id}/quote',
+      description: 'Get a signed price quote for renting an art piece, valid for 15 minutes at checkout and rent',
+      parameters: [
+        { name: 'id', type: 'path', description: 'ID of the art piece' },
+        { name: 'duration_days', type: 'query', description: 'Rental length in days (default 1)' }
+      ],
+      example: '```\nGET /api/art/123/quote?duration_days=7\n```'
+    },
+    {
+      method: 'GET',
+      endpoint: '/api/art/quotes',
+      description: 'Get signed price quotes for up to 100 art pieces, priced together; each id counts against the rate limit',
+      parameters: [
+        { name: 'ids', type: 'query', description: 'Comma-separated art piece IDs' },
+        { name: 'duration_days', type: 'query', description: 'Rental length in days (default 1)' }
+      ],
+      example: '```\nGET /api/art/quotes?ids=12,15,19&duration_days=3\n```'
+    },
+    {
+      method: 'GET',
+      endpoint: '/api/art/batch',
+      description: 'Get details for up to 100 art pieces in one request; results follow the requested order',
+      parameters: [
+        { name: 'ids', type: 'query', description: 'Comma-separated art piece IDs' }
+      ],
+      example: '```\nGET /api/art/batch?ids=12,7,42\n```'
+    },
     {
       method: 'POST',
       endpoint: '/api/generate-art',
@@ -68,22 +128,65 @@ function ApiDocumentation() {
       ],
       example: '```\nPOST /api/generate-art\n{\n  "style": "geometric",\n  "color_palette": "vibrant",\n  "theme": "nature"\n}\n```'
     },
+    {
+      method: 'POST',
+      endpoint: '/api/generate-art/batch',
+      description: 'Generate up to 100 art pieces in one request; each item counts against the rate limit',
+      parameters: [
+        { name: 'items', type: 'body', description: 'List of {style, color_palette, theme} specs' }
+      ],
+      example: '```\nPOST /api/generate-art/batch\n{\n  "items": [\n    {"style": "pixel", "color_palette": "pastel", "theme": "space"},\n    {"style": "fractal", "color_palette": "ocean", "theme": "ocean"}\n  ]\n}\n```'
+    },
     {
       method: 'POST',
       endpoint: '/api/rent',
       description: 'Rent an art piece',
       parameters: [
         { name: 'art_id', type: 'body', description: 'ID of the art piece' },
-        { name: 'duration_days', type: 'body', description: 'Rental duration in days' }
+        { name: 'duration_days', type: 'body', description: 'Rental duration in days' },
+        { name: 'quote', type: 'body', description: 'Optional quote token from /api/art/{id}/quote; its price is charged' }
       ],
       example: '```\nPOST /api/rent\n{\n  "art_id": 123,\n  "duration_days": 7\n}\n```'
     },
+    {
+      method: 'POST',
+      endpoint: '/api/rent/batch',
+      description: 'Create up to 100 rentals in a single transaction; failed items report an error and status',
+      parameters: [
+        { name: 'items', type: 'body', description: 'List of {user_id, art_id, duration_days} rentals' }
+      ],
+      example: '```\nPOST /api/rent/batch\n{\n  "items": [\n    {"user_id": 1, "art_id": 123, "duration_days": 7},\n    {"user_id": 1, "art_id": 124, "duration_days": 3}\n  ]\n}\n```'
+    },
+    {
+      method: 'GET',
+      endpoint: '/api/art/{id}/access-url',
+      description: 'Get a signed, expiring image URL; full-size images need an active rental and expire with it',
+      parameters: [
+        { name: 'id', type: 'path', description: 'ID of the art piece' },
+        { name: 'variant', type: 'query', description: 'preview or full (default full)' }
+      ],
+      example: '```\nGET /api/art/123/access-url?variant=full\n```'
+    },
     {
       method: 'GET',
       endpoint: '/api/user/rentals',
-      description: 'Get all active rentals for the authenticated user',
+      description: 'Get all active rentals for the authenticated user; send Accept: application/x-ndjson to stream them',
       parameters: [],
       example: '```\nGET /api/user/rentals\n```'
+    },
+    {
+      method: 'GET',
+      endpoint: '/api/user/entitlements',
+      description: 'Get your plan, its limits and the rentals used this month',
+      parameters: [],
+      example: '```\nGET /api/user/entitlements\n```'
+    },
+    {
+      method: 'GET',
+      endpoint: '/api/user/rentals/history',
+      description: 'Full rental history of the authenticated user, including archived rentals; supports NDJSON streaming',
+      parameters: [],
+      example: '```\nGET /api/user/rentals/history\nAccept: application/x-ndjson\n```'
     }
   ];
   
@@ -0,0 +1,174 @@
+import hmac
+import time
+import hashlib
+import secrets
+import datetime
+from sqlalchemy import select, update, insert
+from sqlalchemy.exc import IntegrityError
+from ttl_cache import TTLCache
+
+KEY_PREFIX = 'art_'
+# Characters of a key stored in clear and indexed (KEY_PREFIX plus 8 hex digits)
+PREFIX_LENGTH = 12
+# CacheGeneration row bumped by every revocation
+GENERATION = 'api_keys'
+
+def _hash_key(raw_key, salt):
+    return hmac.new(salt.encode('ascii'), raw_key.encode('utf-8'), hashlib.sha256).hexdigest()
+
+class ApiKeyStore:
+    """API keys persisted as salted hashes, with an LRU/TTL cache in front of the database.
+
+    Only the key prefix is stored in clear, so a leaked table cannot be used to
+    authenticate. Cache hits need no query; misses cost one indexed query on
+    the prefix. Revocation bumps a shared generation number in the same
+    transaction, and each worker polls it by primary key at most once every
+    `generation_interval` seconds, dropping its cached keys when it moved. A
+    revoked key therefore stops working on this worker at once and on every
+    other worker within `generation_interval` seconds.
+    """
+
+    def __init__(self, rental_system, cache_size=10000, cache_ttl=60, negative_ttl=5, generation_interval=1.0):
+        self.rental_system = rental_system
+        self.negative_ttl = negative_ttl
+        self.generation_interval = generation_interval
+        self.cache = TTLCache(maxsize=cache_size, ttl=cache_ttl)
+        # Revocation generation the cached entries were filled under, and when it was last read
+        self.generation = None
+        self._generation_checked_at = None
+
+    @staticmethod
+    def _cache_key(raw_key):
+        # Raw keys are never held in memory beyond the request that carried them
+        return hashlib.sha256(raw_key.encode('utf-8')).digest()
+
+    @staticmethod
+    def _record(api_key):
+        return {'id': api_key.id, 'user_id': api_key.user_id, 'tier': api_key.tier}
+
+    def create(self, user_id, tier='free'):
+        """Issue a new key; returns (raw_key, record). The raw key cannot be recovered later."""
+        raw_key = KEY_PREFIX + secrets.token_hex(16)
+        salt = secrets.token_hex(16)
+
+        session = self.rental_system.Session()
+        api_key = self.rental_system.ApiKey(
+            user_id=user_id,
+            prefix=raw_key[:PREFIX_LENGTH],
+            salt=salt,
+            key_hash=_hash_key(raw_key, salt),
+            tier=tier
+        )
+        session.add(api_key)
+        session.commit()
+        record = self._record(api_key)
+        session.close()
+
+        self.cache.set(self._cache_key(raw_key), record)
+        return raw_key, record
+
+    def lookup_query(self, raw_key):
+        """Select the live keys sharing this key's prefix"""
+        ApiKey = self.rental_system.ApiKey
+        return select(ApiKey).where(
+            ApiKey.prefix == raw_key[:PREFIX_LENGTH],
+            ApiKey.revoked_at.is_(None)
+        )
+
+    def match(self, candidates, raw_key):
+        """Return the record of the candidate whose hash matches raw_key, or None"""
+        for api_key in candidates:
+            if hmac.compare_digest(api_key.key_hash, _hash_key(raw_key, api_key.salt)):
+                return self._record(api_key)
+        return None
+
+    def generation_query(self):
+        """Select the current revocation generation (no row until the first revocation)"""
+        CacheGeneration = self.rental_system.CacheGeneration
+        return select(CacheGeneration.generation).where(CacheGeneration.name == GENERATION)
+
+    def generation_due(self):
+        """True if the revocation generation should be read again; claims the poll for this interval"""
+        now = time.monotonic()
+        if self._generation_checked_at is not None and now - self._generation_checked_at < self.generation_interval:
+            return False
+        self._generation_checked_at = now
+        return True
+
+    def observe_generation(self, generation):
+        """Drop every cached key if a key was revoked anywhere since the cache was filled"""
+        generation = generation or 0
+        if generation != self.generation:
+            # Revoked keys cannot be told apart by their digest, so the whole cache goes
+            self.cache.clear()
+            self.generation = generation
+
+    def _bump_generation(self, session):
+        table = self.rental_system.CacheGeneration.__table__
+        bump = update(table).where(table.c.name == GENERATION).values(generation=table.c.generation + 1)
+        if session.execute(bump).rowcount:
+            return
+        try:
+            with session.begin_nested():
+                session.execute(insert(table).values(name=GENERATION, generation=1))
+        except IntegrityError:
+            # Another worker created the row first
+            session.execute(bump)
+
+    def remember(self, raw_key, record):
+        # Unknown keys are cached briefly too, so a client retrying a bad key cannot hammer the database
+        self.cache.set(self._cache_key(raw_key), record, None if record else self.negative_ttl)
+
+    def authenticate(self, raw_key):
+        """Return {'id', 'user_id', 'tier'} for a valid key, or None"""
+        if not raw_key.startswith(KEY_PREFIX):
+            return None
+
+        if self.generation_due():
+            session = self.rental_system.Session()
+            self.observe_generation(session.execute(self.generation_query()).scalar())
+            session.close()
+        record = self.cache.get(self._cache_key(raw_key), False)
+        if record is not False:
+            return record
+
+        session = self.rental_system.Session()
+        record = self.match(session.execute(self.lookup_query(raw_key)).scalars(), raw_key)
+        session.close()
+
+        self.remember(raw_key, record)
+        return record
+
+    def revoke(self, key_id, user_id=None):
+        """Revoke a key by id (optionally only if owned by user_id); returns True if revoked"""
+        session = self.rental_system.Session()
+        api_key = session.get(self.rental_system.ApiKey, key_id)
+        if not api_key or api_key.revoked_at or (user_id is not None and api_key.user_id != user_id):
+            session.close()
+            return False
+
+        api_key.revoked_at = datetime.datetime.utcnow()
+        self._bump_generation(session)
+        session.commit()
+        session.close()
+
+        # The cache is keyed by raw key digests, which are not stored; drop entries by key id instead
+        self.cache.pop_matching(lambda record: record and record['id'] == key_id)
+        return True
+
+    def list_keys(self, user_id):
+        """Metadata for a user's keys, newest first"""
+        ApiKey = self.rental_system.ApiKey
+        session = self.rental_system.Session()
+        keys = session.execute(
+            select(ApiKey).where(ApiKey.user_id == user_id).order_by(ApiKey.id.desc())
+        ).scalars().all()
+        result = [{
+            "id": key.id,
+            "prefix": key.prefix,
+            "tier": key.tier,
+            "created_at": key.created_at.isoformat(),
+            "revoked_at": key.revoked_at.isoformat() if key.revoked_at else None
+        } for key in keys]
+        session.close()
+        return result
@@ -1,19 +1,24 @@
 import os
 import json
 import datetime
-from flask import Blueprint, request, jsonify, current_app
+from flask import Blueprint, request, jsonify, current_app, make_response, g, Response, stream_with_context
 from flask_cors import CORS
-from functools import wraps
+from functools import wraps, partial
+from concurrent.futures import ThreadPoolExecutor
 import secrets
 import hashlib
+import base64
+from sqlalchemy import and_, or_
+from rate_limiter import RateLimiter, create_backend
+from response_cache import cached_response, setup_response_cache
+from catalog_io import CatalogTransfer
+from idempotency import idempotent
+from price_quotes import InvalidQuote, parse_duration_days
 
 # API Blueprint
 api_blueprint = Blueprint('api', __name__)
 CORS(api_blueprint)
 
-# API key storage (in production, this would be in a database)
-API_KEYS = {}
-
 # API rate limiting (in production, this would use Redis or similar)
 RATE_LIMITS = {
     'free': 100,  # requests per day
@@ -22,11 +27,33 @@ RATE_LIMITS = {
     'enterprise': float('inf')
 }
 
-# Request counters (in production, this would be in a database)
-REQUEST_COUNTERS = {}
+# Short-term burst allowance per tier: (bucket size, refill per minute)
+BURST_LIMITS = {
+    'free': (10, 10),
+    'basic': (50, 60),
+    'premium': (200, 600),
+    'enterprise': None
+}
+
+# Catalog listing page sizes
+DEFAULT_PAGE_SIZE = 20
+MAX_PAGE_SIZE = 100
+
+# Most items accepted by one batch request
+MAX_BATCH_SIZE = 100
+
+# Rows fetched from the database per round trip when streaming NDJSON
+STREAM_BATCH_SIZE = 500
+NDJSON_MIMETYPE = 'application/x-ndjson'
+
+# Server-side columns left out of the public catalog export
+EXPORT_PRIVATE_COLUMNS = ('file_path',)
 
-# Decorator for API key authentication
-def require_api_key(f):
+# Decorator for API key authentication; `cost` returns how many rate limit units a request uses
+def require_api_key(f=None, cost=None):
+    if f is None:
+        return partial(require_api_key, cost=cost)
+    
     @wraps(f)
     def decorated_function(*args, **kwargs):
         auth_header = request.headers.get('Authorization')
@@ -36,30 +63,101 @@ def require_api_key(f):
         
         api_key = auth_header.split('Bearer ')[1]
         
-        if api_key not in API_KEYS:
+        key_record = current_app.config['RENTAL_SYSTEM'].api_keys.authenticate(api_key)
+        if not key_record and 'user_id' in g:
+            # Signed-in users calling with the JWT verified by SecurityManager get the free tier
+            key_record = {'id': None, 'user_id': g.user_id, 'tier': 'free'}
+        if not key_record:
             return jsonify({"error": "Invalid API key"}), 401
+        g.api_key = key_record
         
         # Check rate limit
-        user_id = API_KEYS[api_key]['user_id']
-        tier = API_KEYS[api_key]['tier']
-        
-        # Initialize counter if not exists
-        today = datetime.datetime.utcnow().strftime('%Y-%m-%d')
-        if user_id not in REQUEST_COUNTERS:
-            REQUEST_COUNTERS[user_id] = {}
-        if today not in REQUEST_COUNTERS[user_id]:
-            REQUEST_COUNTERS[user_id][today] = 0
-        
-        # Check if rate limit exceeded
-        if REQUEST_COUNTERS[user_id][today] >= RATE_LIMITS[tier]:
-            return jsonify({"error": "Rate limit exceeded"}), 429
+        decision = current_app.config['RATE_LIMITER'].check(
+            key_record['user_id'], key_record['tier'], cost() if cost else 1
+        )
+        if decision and not decision.allowed:
+            response = jsonify({"error": "Rate limit exceeded"})
+            response.status_code = 429
+            response.headers.update(RateLimiter.headers(decision))
+            return response
         
-        # Increment counter
-        REQUEST_COUNTERS[user_id][today] += 1
-        
-        return f(*args, **kwargs)
+        response = make_response(f(*args, **kwargs))
+        if decision:
+            response.headers.update(RateLimiter.headers(decision))
+        return response
     return decorated_function
 
+def _serialize_art(art):
+    """Public JSON representation of an art piece"""
+    return {
+        "id": art.id,
+        "title": art.title,
+        "style": art.style,
+        "color_palette": art.color_palette,
+        "theme": art.theme,
+        "created_at": art.created_at.isoformat(),
+        "preview_url": f"/api/art/{art.id}/preview"
+    }
+
+def _encode_cursor(art):
+    """Opaque cursor pointing just past the given art piece"""
+    raw = json.dumps([art.created_at.isoformat(), art.id]).encode('utf-8')
+    return base64.urlsafe_b64encode(raw).decode('ascii')
+
+def _decode_cursor(cursor):
+    """Return (created_at, id) from a cursor, or raise ValueError"""
+    try:
+        created_at, art_id = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+        return datetime.datetime.fromisoformat(created_at), int(art_id)
+    except Exception:
+        raise ValueError("Invalid cursor")
+
+def _wants_ndjson():
+    """True if the client asked for newline-delimited JSON over plain JSON"""
+    return request.accept_mimetypes.best_match(['application/json', NDJSON_MIMETYPE]) == NDJSON_MIMETYPE
+
+def _json_default(value):
+    if isinstance(value, (datetime.datetime, datetime.date)):
+        return value.isoformat()
+    raise TypeError(f"{type(value).__name__} is not JSON serializable")
+
+def _charge_page():
+    """Charge one more page of streamed rows to the daily quota; False once it is used up"""
+    decision = current_app.config['RATE_LIMITER'].charge(g.api_key['user_id'], g.api_key['tier'])
+    return decision is None or decision.allowed
+
+def _ndjson_response(rows, serialize, session=None, metered=False):
+    """Stream one JSON document per row as it is fetched, closing the session with the response.
+
+    Metered streams are charged like paging through the listing: the request
+    pays for the first MAX_PAGE_SIZE rows and each further page is charged to
+    the daily quota as it starts, ending the stream with an error line once
+    the quota runs out.
+    """
+    def generate():
+        for count, row in enumerate(rows):
+            if metered and count and count % MAX_PAGE_SIZE == 0 and not _charge_page():
+                yield json.dumps({"error": "Rate limit exceeded"}) + '\n'
+                return
+            yield json.dumps(serialize(row), default=_json_default) + '\n'
+    response = Response(stream_with_context(generate()), mimetype=NDJSON_MIMETYPE)
+    if session is not None:
+        response.call_on_close(session.close)
+    return response
+
+def _batch_items():
+    """Items of a JSON batch request body"""
+    items = (request.get_json(silent=True) or {}).get('items')
+    return items if isinstance(items, list) else []
+
+def _batch_ids():
+    """Art ids from the comma-separated `ids` query parameter"""
+    return [v for v in request.args.get('ids', '').split(',') if v]
+
+def _batch_cost(items):
+    # Batches are charged per item, so they cannot be used to get around rate limits
+    return lambda: max(1, min(len(items()), MAX_BATCH_SIZE))
+
 # API routes
 @api_blueprint.route('/generate-key', methods=['POST'])
 def generate_api_key():
@@ -73,24 +171,37 @@ def generate_api_key():
     if tier not in RATE_LIMITS:
         return jsonify({"error": "Invalid tier"}), 400
     
-    # Generate a new API key
-    api_key = 'art_' + secrets.token_hex(16)
-    
-    # Store the API key
-    API_KEYS[api_key] = {
-        'user_id': user_id,
-        'tier': tier,
-        'created_at': datetime.datetime.utcnow().isoformat()
-    }
+    # Generate and store a new API key; only its hash is persisted
+    rental_system = current_app.config['RENTAL_SYSTEM']
+    api_key, key_record = rental_system.api_keys.create(user_id, tier)
     
     return jsonify({
         "api_key": api_key,
+        "key_id": key_record['id'],
         "tier": tier,
         "rate_limit": RATE_LIMITS[tier]
     })
 
+@api_blueprint.route('/keys', methods=['GET'])
+@require_api_key
+def list_api_keys():
+    rental_system = current_app.config['RENTAL_SYSTEM']
+    return jsonify(rental_system.api_keys.list_keys(g.api_key['user_id']))
+
+@api_blueprint.route('/keys/<int:key_id>', methods=['DELETE'])
+@require_api_key
+def revoke_api_key(key_id):
+    rental_system = current_app.config['RENTAL_SYSTEM']
+    
+    # Users may only revoke their own keys
+    if not rental_system.api_keys.revoke(key_id, user_id=g.api_key['user_id']):
+        return jsonify({"error": "API key not found"}), 404
+    
+    return jsonify({"revoked": key_id})
+
 @api_blueprint.route('/art/<int:art_id>', methods=['GET'])
 @require_api_key
+@cached_response(tags=lambda art_id: [f"art:{art_id}"], scope=lambda: 'api_key')
 def get_art(art_id):
     # Get the rental system from the app
     rental_system = current_app.config['RENTAL_SYSTEM']
@@ -102,21 +213,187 @@ def get_art(art_id):
         session.close()
         return jsonify({"error": "Art piece not found"}), 404
     
+    result = _serialize_art(art)
+    
+    session.close()
+    return jsonify(result)
+
+@api_blueprint.route('/art/<int:art_id>/quote', methods=['GET'])
+@require_api_key
+def get_price_quote(art_id):
+    # Get the rental system from the app
+    rental_system = current_app.config['RENTAL_SYSTEM']
+    
+    duration_days = request.args.get('duration_days', 1, type=int)
+    if duration_days < 1:
+        return jsonify({"error": "duration_days must be at least 1"}), 400
+    
+    quote = rental_system.quotes.quote(art_id, duration_days)
+    if quote is None:
+        return jsonify({"error": "Art piece not found"}), 404
+    return jsonify(quote)
+
+@api_blueprint.route('/art/quotes', methods=['GET'])
+@require_api_key(cost=_batch_cost(_batch_ids))
+def get_price_quotes():
+    # Get the rental system from the app
+    rental_system = current_app.config['RENTAL_SYSTEM']
+    
+    try:
+        art_ids = [int(v) for v in _batch_ids()]
+    except ValueError:
+        return jsonify({"error": "Invalid art id"}), 400
+    duration_days = request.args.get('duration_days', 1, type=int)
+    if not art_ids:
+        return jsonify({"error": "Missing art ids"}), 400
+    if len(art_ids) > MAX_BATCH_SIZE:
+        return jsonify({"error": f"At most {MAX_BATCH_SIZE} art ids per request"}), 400
+    if duration_days < 1:
+        return jsonify({"error": "duration_days must be at least 1"}), 400
+    
+    # A gallery page is priced with a single model prediction
+    quotes = rental_system.quotes.quote_many(art_ids, duration_days)
+    return jsonify({
+        "items": [quote or {"art_id": art_id, "error": "Art piece not found"} for art_id, quote in zip(art_ids, quotes)]
+    })
+
+@api_blueprint.route('/art/batch', methods=['GET'])
+@require_api_key(cost=_batch_cost(_batch_ids))
+def get_art_batch():
+    # Get the rental system from the app
+    rental_system = current_app.config['RENTAL_SYSTEM']
+    
+    try:
+        art_ids = [int(v) for v in _batch_ids()]
+    except ValueError:
+        return jsonify({"error": "Invalid art id"}), 400
+    if not art_ids:
+        return jsonify({"error": "Missing art ids"}), 400
+    if len(art_ids) > MAX_BATCH_SIZE:
+        return jsonify({"error": f"At most {MAX_BATCH_SIZE} art ids per request"}), 400
+    
+    # One IN query for the whole batch
+    session = rental_system.Session()
+    art_pieces = session.query(rental_system.ArtPiece).filter(
+        rental_system.ArtPiece.id.in_(set(art_ids))
+    ).all()
+    found = {art.id: _serialize_art(art) for art in art_pieces}
+    session.close()
+    
+    # Results follow the requested order, with an error entry for each missing id
+    return jsonify({
+        "items": [found.get(art_id) or {"id": art_id, "error": "Art piece not found"} for art_id in art_ids]
+    })
+
+@api_blueprint.route('/art/', methods=['GET'])
+@require_api_key
+def list_art():
+    # Get the rental system from the app
+    rental_system = current_app.config['RENTAL_SYSTEM']
+    ArtPiece = rental_system.ArtPiece
+    
+    # NDJSON clients get every matching row streamed unless they ask for a limit
+    stream = _wants_ndjson()
+    try:
+        limit = int(request.args.get('limit', 0 if stream else DEFAULT_PAGE_SIZE))
+    except ValueError:
+        return jsonify({"error": "Invalid limit"}), 400
+    if not stream:
+        limit = max(1, min(limit, MAX_PAGE_SIZE))
+    
+    session = rental_system.Session()
+    query = session.query(ArtPiece)
+    
+    # Facet filters accept comma-separated values
+    for param, column in (('style', ArtPiece.style),
+                          ('color_palette', ArtPiece.color_palette),
+                          ('theme', ArtPiece.theme)):
+        values = [v for v in request.args.get(param, '').split(',') if v]
+        if len(values) == 1:
+            query = query.filter(column == values[0])
+        elif values:
+            query = query.filter(column.in_(values))
+    
+    # Keyset pagination: seek past the last row of the previous page instead of using OFFSET
+    cursor = request.args.get('cursor')
+    if cursor:
+        try:
+            created_at, art_id = _decode_cursor(cursor)
+        except ValueError:
+            session.close()
+            return jsonify({"error": "Invalid cursor"}), 400
+        query = query.filter(or_(
+            ArtPiece.created_at < created_at,
+            and_(ArtPiece.created_at == created_at, ArtPiece.id < art_id)
+        ))
+    
+    if stream:
+        query = query.order_by(ArtPiece.created_at.desc(), ArtPiece.id.desc())
+        if limit > 0:
+            query = query.limit(limit)
+        return _ndjson_response(query.yield_per(STREAM_BATCH_SIZE), _serialize_art, session, metered=True)
+    
+    # Fetch one extra row to know whether another page exists
+    art_pieces = query.order_by(ArtPiece.created_at.desc(), ArtPiece.id.desc()).limit(limit + 1).all()
+    has_more = len(art_pieces) > limit
+    art_pieces = art_pieces[:limit]
+    
     result = {
-        "id": art.id,
-        "title": art.title,
-        "style": art.style,
-        "color_palette": art.color_palette,
-        "theme": art.theme,
-        "created_at": art.created_at.isoformat(),
-        "preview_url": f"/api/art/{art.id}/preview"
+        "items": [_serialize_art(art) for art in art_pieces],
+        "next_cursor": _encode_cursor(art_pieces[-1]) if has_more else None
     }
     
     session.close()
     return jsonify(result)
 
+@api_blueprint.route('/art/export', methods=['GET'])
+@require_api_key
+def export_art():
+    # Get the rental system from the app
+    rental_system = current_app.config['RENTAL_SYSTEM']
+    
+    # Same records as the JSONL catalog export, streamed straight from a server-side cursor
+    transfer = CatalogTransfer(rental_system, batch_size=STREAM_BATCH_SIZE)
+    return _ndjson_response(transfer.iter_records(), lambda record: {
+        k: v for k, v in record.items() if k not in EXPORT_PRIVATE_COLUMNS
+    }, metered=True)
+
+@api_blueprint.route('/art/facets', methods=['GET'])
+@require_api_key
+def get_art_facets():
+    # Get the rental system from the app
+    rental_system = current_app.config['RENTAL_SYSTEM']
+    
+    # Same comma-separated filters as the catalog listing
+    filters = {}
+    for facet in ('style', 'color_palette', 'theme'):
+        values = [v for v in request.args.get(facet, '').split(',') if v]
+        if values:
+            filters[facet] = values
+    
+    return jsonify({
+        "total": rental_system.facet_index.count(**filters),
+        "facets": rental_system.facet_index.facet_counts(**filters)
+    })
+
+@api_blueprint.route('/recommendations', methods=['GET'])
+@require_api_key
+@cached_response(tags=lambda: ['art', f"user:{g.api_key['user_id']}"])
+def get_recommendations():
+    content_curation = current_app.config.get('CONTENT_CURATION')
+    if content_curation is None:
+        return jsonify({"error": "Recommendations are not available"}), 503
+    
+    try:
+        count = max(1, min(int(request.args.get('count', 3)), MAX_PAGE_SIZE))
+    except ValueError:
+        return jsonify({"error": "Invalid count"}), 400
+    
+    return jsonify(content_curation.recommend_art(g.api_key['user_id'], count=count))
+
 @api_blueprint.route('/generate-art', methods=['POST'])
 @require_api_key
+@idempotent
 def api_generate_art():
     # Get the rental system from the app
     rental_system = current_app.config['RENTAL_SYSTEM']
@@ -149,8 +426,62 @@ def api_generate_art():
         "preview_url": f"/api/art/{art_id}/preview"
     })
 
+@api_blueprint.route('/generate-art/batch', methods=['POST'])
+@require_api_key(cost=_batch_cost(_batch_items))
+@idempotent
+def api_generate_art_batch():
+    # Get the rental system from the app
+    rental_system = current_app.config['RENTAL_SYSTEM']
+    
+    specs = _batch_items()
+    if not specs:
+        return jsonify({"error": "Missing items"}), 400
+    if len(specs) > MAX_BATCH_SIZE:
+        return jsonify({"error": f"At most {MAX_BATCH_SIZE} items per request"}), 400
+    
+    specs = [(spec.get('style', 'abstract'), spec.get('color_palette', 'vibrant'), spec.get('theme', 'nature'))
+             if isinstance(spec, dict) else None for spec in specs]
+    
+    # Render every image on the shared worker pool, keeping results in request order
+    pool = current_app.config['GENERATION_POOL']
+    futures = [pool.submit(rental_system.generate_art, *spec) if spec else None for spec in specs]
+    
+    session = rental_system.Session()
+    results = []
+    for spec, future in zip(specs, futures):
+        if future is None:
+            results.append({"error": "Invalid item"})
+            continue
+        try:
+            art_filename = future.result()
+        except Exception as e:
+            results.append({"error": f"Art generation failed: {e}"})
+            continue
+        style, color_palette, theme = spec
+        new_art = rental_system.ArtPiece(
+            title=f"{style.capitalize()} {theme.capitalize()}",
+            file_path=art_filename,
+            style=style,
+            color_palette=color_palette,
+            theme=theme
+        )
+        session.add(new_art)
+        results.append(new_art)
+    
+    # Insert every generated piece in one commit
+    session.commit()
+    items = [item if isinstance(item, dict) else {
+        "id": item.id,
+        "title": item.title,
+        "preview_url": f"/api/art/{item.id}/preview"
+    } for item in results]
+    session.close()
+    
+    return jsonify({"items": items})
+
 @api_blueprint.route('/rent', methods=['POST'])
 @require_api_key
+@idempotent
 def api_rent_art():
     # Get the rental system from the app
     rental_system = current_app.config['RENTAL_SYSTEM']
@@ -158,10 +489,13 @@ def api_rent_art():
     data = request.json
     user_id = data.get('user_id')
     art_id = data.get('art_id')
-    duration_days = data.get('duration_days', 1)
     
     if not user_id or not art_id:
         return jsonify({"error": "Missing required parameters"}), 400
+    try:
+        duration_days = parse_duration_days(data.get('duration_days', 1))
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
     
     session = rental_system.Session()
     art = session.query(rental_system.ArtPiece).filter(rental_system.ArtPiece.id == art_id).first()
@@ -171,13 +505,36 @@ def api_rent_art():
         session.close()
         return jsonify({"error": "Art or user not found"}), 404
     
+    # Enforce the user's plan: rentals per month and longest rental
+    allowed, reason, entitlement = rental_system.entitlements.check(user.id, duration_days)
+    if not allowed:
+        session.close()
+        return jsonify({"error": reason, "entitlement": entitlement}), 403
+    
     # Calculate rental period
     start_date = datetime.datetime.utcnow()
     end_date = start_date + datetime.timedelta(days=duration_days)
     
-    # Calculate price (simplified for now)
-    base_price = 5.0  # Base price per day
-    price = base_price * duration_days
+    # Charge the quoted price if the client brings a quote
+    try:
+        price = rental_system.quotes.price_for(art.id, duration_days, data.get('quote'))
+    except InvalidQuote as e:
+        session.close()
+        return jsonify({"error": str(e)}), 400
+    
+    # Reject rentals overlapping one this user already holds for the piece; the index
+    # answers most requests, the database check inside this transaction settles races
+    if (rental_system.availability.is_rented(art.id, user.id, start_date, end_date)
+            or not rental_system.availability.reserve(session, art.id, user.id, start_date, end_date)):
+        session.rollback()
+        session.close()
+        return jsonify({"error": "Art piece already rented for this period"}), 409
+    
+    # The cached check above answers early; counting the rental settles the limit across workers
+    if not rental_system.entitlements.claim(session, user.id, start_date):
+        session.rollback()
+        session.close()
+        return jsonify({"error": rental_system.entitlements.limit_reason(entitlement), "entitlement": entitlement}), 403
     
     # Create rental
     new_rental = rental_system.Rental(
@@ -198,50 +555,184 @@ def api_rent_art():
         "rental_id": rental_id,
         "start_date": start_date.isoformat(),
         "end_date": end_date.isoformat(),
-        "price": price
+        "price": price,
+        "resolution": entitlement['resolution']
     })
 
+@api_blueprint.route('/rent/batch', methods=['POST'])
+@require_api_key(cost=_batch_cost(_batch_items))
+@idempotent
+def api_rent_art_batch():
+    # Get the rental system from the app
+    rental_system = current_app.config['RENTAL_SYSTEM']
+    
+    items = _batch_items()
+    if not items:
+        return jsonify({"error": "Missing items"}), 400
+    if len(items) > MAX_BATCH_SIZE:
+        return jsonify({"error": f"At most {MAX_BATCH_SIZE} items per request"}), 400
+    
+    # Normalize ids so they can be matched against query results; unusable items become None
+    parsed = []
+    for item in items:
+        try:
+            parsed.append((int(item.get('user_id') or 0), int(item.get('art_id') or 0),
+                           parse_duration_days(item.get('duration_days', 1)), item.get('quote')))
+        except (AttributeError, TypeError, ValueError):
+            parsed.append(None)
+    
+    # Load every referenced art piece and user with one query each
+    session = rental_system.Session()
+    art_ids = {item[1] for item in parsed if item}
+    user_ids = {item[0] for item in parsed if item}
+    arts = {art.id for art in session.query(rental_system.ArtPiece.id).filter(rental_system.ArtPiece.id.in_(art_ids))}
+    users = {user.id for user in session.query(rental_system.User.id).filter(rental_system.User.id.in_(user_ids))}
+    
+    start_date = datetime.datetime.utcnow()
+    results = []
+    accepted = set()
+    # Rentals accepted per user so far, counted against their monthly allowance
+    used_in_batch = {}
+    for item in parsed:
+        if item is None:
+            results.append({"error": "Invalid item", "status": 400})
+            continue
+        user_id, art_id, duration_days, quote = item
+        
+        if not user_id or not art_id:
+            results.append({"error": "Missing required parameters", "status": 400})
+            continue
+        if art_id not in arts or user_id not in users:
+            results.append({"error": "Art or user not found", "status": 404})
+            continue
+        
+        allowed, reason, entitlement = rental_system.entitlements.check(user_id, duration_days)
+        remaining = entitlement['rentals_remaining']
+        if allowed and remaining is not None and used_in_batch.get(user_id, 0) >= remaining:
+            allowed, reason = False, rental_system.entitlements.limit_reason(entitlement)
+        if not allowed:
+            results.append({"error": reason, "status": 403})
+            continue
+        
+        try:
+            price = rental_system.quotes.price_for(art_id, duration_days, quote)
+        except InvalidQuote as e:
+            results.append({"error": str(e), "status": 400})
+            continue
+        
+        # Every rental in the batch starts now, so a repeated (art, user) pair always overlaps
+        end_date = start_date + datetime.timedelta(days=duration_days)
+        if ((art_id, user_id) in accepted
+                or rental_system.availability.is_rented(art_id, user_id, start_date, end_date)
+                or not rental_system.availability.reserve(session, art_id, user_id, start_date, end_date)):
+            results.append({"error": "Art piece already rented for this period", "status": 409})
+            continue
+        if not rental_system.entitlements.claim(session, user_id, start_date):
+            results.append({"error": rental_system.entitlements.limit_reason(entitlement), "status": 403})
+            continue
+        accepted.add((art_id, user_id))
+        used_in_batch[user_id] = used_in_batch.get(user_id, 0) + 1
+        
+        new_rental = rental_system.Rental(
+            user_id=user_id,
+            art_piece_id=art_id,
+            start_date=start_date,
+            end_date=end_date,
+            price=price,
+            is_active=True
+        )
+        session.add(new_rental)
+        results.append(new_rental)
+    
+    # All rentals in the batch are created in a single transaction
+    session.commit()
+    items = [item if isinstance(item, dict) else {
+        "rental_id": item.id,
+        "start_date": item.start_date.isoformat(),
+        "end_date": item.end_date.isoformat(),
+        "price": item.price
+    } for item in results]
+    session.close()
+    
+    return jsonify({"items": items})
+
+def _serialize_user_rental(row):
+    rental, art = row
+    remaining_time = rental.end_date - datetime.datetime.utcnow()
+    return {
+        "id": rental.id,
+        "title": art.title if art else "Unknown Art",
+        "previewUrl": f"/api/art/{art.id}/preview" if art else None,
+        "startDate": rental.start_date.isoformat(),
+        "endDate": rental.end_date.isoformat(),
+        "remainingHours": max(0, int(remaining_time.total_seconds() / 3600)),
+        "price": rental.price
+    }
+
 @api_blueprint.route('/user/rentals', methods=['GET'])
 @require_api_key
 def api_get_user_rentals():
     # Get the rental system from the app
     rental_system = current_app.config['RENTAL_SYSTEM']
+    Rental = rental_system.Rental
+    ArtPiece = rental_system.ArtPiece
     
     # Get user ID from API key
-    auth_header = request.headers.get('Authorization')
-    api_key = auth_header.split('Bearer ')[1]
-    user_id = API_KEYS[api_key]['user_id']
+    user_id = g.api_key['user_id']
     
+    # Rentals and their art pieces in one query
     session = rental_system.Session()
-    rentals = session.query(rental_system.Rental).filter(
-        rental_system.Rental.user_id == user_id,
-        rental_system.Rental.is_active == True
-    ).all()
+    query = session.query(Rental, ArtPiece).outerjoin(ArtPiece, ArtPiece.id == Rental.art_piece_id).filter(
+        Rental.user_id == user_id,
+        Rental.is_active == True
+    ).order_by(Rental.id)
     
-    result = []
-    for rental in rentals:
-        art = session.query(rental_system.ArtPiece).filter(rental_system.ArtPiece.id == rental.art_piece_id).first()
-        
-        # Calculate remaining time
-        now = datetime.datetime.utcnow()
-        remaining_time = rental.end_date - now
-        remaining_hours = max(0, int(remaining_time.total_seconds() / 3600))
-        
-        result.append({
-            "id": rental.id,
-            "title": art.title if art else "Unknown Art",
-            "previewUrl": f"/api/art/{art.id}/preview" if art else None,
-            "startDate": rental.start_date.isoformat(),
-            "endDate": rental.end_date.isoformat(),
-            "remainingHours": remaining_hours,
-            "price": rental.price
-        })
+    if _wants_ndjson():
+        return _ndjson_response(query.yield_per(STREAM_BATCH_SIZE), _serialize_user_rental, session)
+    
+    result = [_serialize_user_rental(row) for row in query.all()]
     
     session.close()
     return jsonify(result)
 
+@api_blueprint.route('/user/entitlements', methods=['GET'])
+@require_api_key
+def api_get_entitlements():
+    # Get the rental system from the app
+    rental_system = current_app.config['RENTAL_SYSTEM']
+    
+    # Plan, limits and this month's usage from the entitlement cache
+    return jsonify(rental_system.entitlements.status(g.api_key['user_id']))
+
+@api_blueprint.route('/user/rentals/history', methods=['GET'])
+@require_api_key
+def api_get_rental_history():
+    # Get the rental system from the app
+    rental_system = current_app.config['RENTAL_SYSTEM']
+    
+    # Live and archived rentals, oldest first
+    history = rental_system.iter_rental_history(user_id=g.api_key['user_id'], batch_size=STREAM_BATCH_SIZE)
+    if _wants_ndjson():
+        return _ndjson_response(history, lambda row: row)
+    
+    return current_app.response_class(json.dumps(list(history), default=_json_default), mimetype='application/json')
+
 # Function to initialize API blueprint
 def setup_api(app, rental_system):
     app.config['RENTAL_SYSTEM'] = rental_system
+    
+    # Rate limit state lives in-process by default; point RATE_LIMIT_STORAGE at
+    # sqlite:///path or redis://host to share it between worker processes
+    if 'RATE_LIMITER' not in app.config:
+        backend = create_backend(app.config.get('RATE_LIMIT_STORAGE', 'memory://'))
+        app.config['RATE_LIMITER'] = RateLimiter(backend, RATE_LIMITS, BURST_LIMITS)
+    
+    # Cached GET responses, invalidated on ArtPiece and Rental commits
+    setup_response_cache(app, rental_system)
+    
+    # Worker pool shared by batch art generation requests
+    if 'GENERATION_POOL' not in app.config:
+        app.config['GENERATION_POOL'] = ThreadPoolExecutor(max_workers=app.config.get('GENERATION_WORKERS', 4))
+    
     app.register_blueprint(api_blueprint, url_prefix='/api')
     return api_blueprint
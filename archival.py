@@ -0,0 +1,172 @@
+import sys
+import json
+import argparse
+import datetime
+from sqlalchemy import select, insert, update, delete, func, literal, union_all
+from popularity import _non_negative
+from response_cache import invalidate
+
+class RentalArchiver:
+    """Move long-finished rentals out of the live table into an archive with per-user/per-art rollups"""
+
+    def __init__(self, rental_system, retention_days=90, batch_size=1000):
+        self.rental_system = rental_system
+        self.retention_days = retention_days
+        self.batch_size = batch_size
+
+    def archive(self, now=None, max_batches=None):
+        """Archive rentals that ended more than retention_days ago, one bounded batch per transaction"""
+        now = now or datetime.datetime.utcnow()
+        cutoff = now - datetime.timedelta(days=self.retention_days)
+        archived = 0
+        batches = 0
+        user_ids = set()
+
+        while max_batches is None or batches < max_batches:
+            with self.rental_system.engine.begin() as conn:
+                moved = self._archive_batch(conn, cutoff, now, user_ids)
+            if not moved:
+                break
+            archived += moved
+            batches += 1
+
+        # Archived rentals ended long ago; drop any the interval index still holds
+        self.rental_system.availability.prune(now)
+        # Core deletes bypass the commit hooks that keep cached responses current
+        if archived:
+            invalidate(self.rental_system, ['art'] + [f"user:{user_id}" for user_id in sorted(user_ids)])
+        return archived
+
+    def _archive_batch(self, conn, cutoff, now, user_ids):
+        """Copy, roll up and delete one batch of ended rentals, adding their users to user_ids"""
+        rentals = self.rental_system.Rental.__table__
+        archive = self.rental_system.RentalArchive.__table__
+
+        rows = conn.execute(
+            select(rentals.c.id, rentals.c.user_id).where(rentals.c.end_date < cutoff)
+            .order_by(rentals.c.id).limit(self.batch_size)
+        ).fetchall()
+        if not rows:
+            return 0
+        ids = [rental_id for rental_id, _ in rows]
+        user_ids.update(user_id for _, user_id in rows)
+
+        batch = rentals.c.id.in_(ids)
+        self._expire_batch(conn, batch)
+        columns = [column.name for column in rentals.columns]
+        conn.execute(insert(archive).from_select(
+            columns + ['archived_at'],
+            select(*[rentals.c[name] for name in columns], literal(now, archive.c.archived_at.type)).where(batch)
+        ))
+
+        self._roll_up(conn, self.rental_system.UserRentalRollup.__table__, 'user_id', 'total_spent',
+                      rentals.c.user_id, batch)
+        self._roll_up(conn, self.rental_system.ArtRentalRollup.__table__, 'art_piece_id', 'total_revenue',
+                      rentals.c.art_piece_id, batch)
+
+        conn.execute(delete(rentals).where(batch))
+        return len(ids)
+
+    def _expire_batch(self, conn, batch):
+        """Deactivate rentals in the batch that were never expired, releasing their active counters"""
+        rentals = self.rental_system.Rental.__table__
+        art_table = self.rental_system.ArtPiece.__table__
+        active = (batch, rentals.c.is_active == True)
+        per_art = conn.execute(
+            select(rentals.c.art_piece_id, func.count(rentals.c.id)).where(*active).group_by(rentals.c.art_piece_id)
+        ).fetchall()
+        if not per_art:
+            return
+        # Core writes bypass the flush hooks, so counters are adjusted here as in expire_rentals
+        conn.execute(update(rentals).where(*active).values(is_active=False))
+        for art_id, count in per_art:
+            conn.execute(update(art_table).where(art_table.c.id == art_id).values(
+                active_rental_count=_non_negative(art_table.c.active_rental_count - count)
+            ))
+
+    def _roll_up(self, conn, rollup, key_name, total_name, key_column, batch):
+        """Fold one batch's aggregates into a rollup table"""
+        rentals = self.rental_system.Rental.__table__
+        groups = conn.execute(
+            select(key_column, func.count(rentals.c.id), func.sum(rentals.c.price),
+                   func.min(rentals.c.start_date), func.max(rentals.c.start_date))
+            .where(batch).group_by(key_column)
+        ).fetchall()
+
+        for key, count, total, first, last in groups:
+            existing = conn.execute(select(rollup).where(rollup.c[key_name] == key)).fetchone()
+            if existing is None:
+                conn.execute(insert(rollup).values(**{
+                    key_name: key, 'rental_count': count, total_name: total or 0.0,
+                    'first_rented_at': first, 'last_rented_at': last
+                }))
+                continue
+            existing = existing._mapping
+            conn.execute(update(rollup).where(rollup.c[key_name] == key).values(**{
+                'rental_count': existing['rental_count'] + count,
+                total_name: existing[total_name] + (total or 0.0),
+                'first_rented_at': min(d for d in (existing['first_rented_at'], first) if d is not None),
+                'last_rented_at': max(d for d in (existing['last_rented_at'], last) if d is not None)
+            }))
+
+    def iter_rental_history(self, user_id=None, art_id=None, batch_size=1000):
+        """Analytics scan over live and archived rentals together, oldest first"""
+        rentals = self.rental_system.Rental.__table__
+        archive = self.rental_system.RentalArchive.__table__
+        columns = ['id', 'user_id', 'art_piece_id', 'start_date', 'end_date', 'price', 'is_active', 'created_at']
+
+        def part(table, archived):
+            query = select(*[table.c[name] for name in columns], literal(archived).label('archived'))
+            if user_id is not None:
+                query = query.where(table.c.user_id == user_id)
+            if art_id is not None:
+                query = query.where(table.c.art_piece_id == art_id)
+            return query
+
+        history = union_all(part(rentals, False), part(archive, True)).subquery()
+        with self.rental_system.engine.connect() as conn:
+            result = conn.execution_options(stream_results=True).execute(
+                select(history).order_by(history.c.start_date, history.c.id)
+            )
+            while True:
+                rows = result.fetchmany(batch_size)
+                if not rows:
+                    break
+                for row in rows:
+                    yield dict(row._mapping)
+
+    def user_summary(self, user_id):
+        """Lifetime rental totals for a user: archived rollup plus live aggregates"""
+        Rental = self.rental_system.Rental
+        session = self.rental_system.Session()
+        rollup = session.query(self.rental_system.UserRentalRollup).get(user_id)
+        live_count, live_total = session.query(
+            func.count(Rental.id), func.coalesce(func.sum(Rental.price), 0.0)
+        ).filter(Rental.user_id == user_id).one()
+        session.close()
+
+        return {
+            'user_id': user_id,
+            'rental_count': live_count + (rollup.rental_count if rollup else 0),
+            'total_spent': round(live_total + (rollup.total_spent if rollup else 0.0), 2),
+            'archived_rental_count': rollup.rental_count if rollup else 0
+        }
+
+
+def main(argv=None):
+    """Command line entry point: python archival.py [--retention-days N]"""
+    parser = argparse.ArgumentParser(description="Archive finished ArtLens rentals")
+    parser.add_argument('--database-url', default="sqlite:///./artlens.db")
+    parser.add_argument('--retention-days', type=int, default=90)
+    parser.add_argument('--batch-size', type=int, default=1000)
+    parser.add_argument('--max-batches', type=int, default=None)
+    args = parser.parse_args(argv)
+
+    from rental_system import RentalSystem
+    rental_system = RentalSystem(None, database_url=args.database_url)
+    archived = rental_system.archive_rentals(args.retention_days, args.batch_size, args.max_batches)
+    print(json.dumps({'archived': archived}))
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
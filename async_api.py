@@ -0,0 +1,208 @@
+import re
+import json
+import inspect
+import datetime
+from urllib.parse import parse_qs
+from api_service import DEFAULT_PAGE_SIZE, MAX_PAGE_SIZE, _serialize_art, _encode_cursor, _decode_cursor
+from price_quotes import InvalidQuote, parse_duration_days
+from entitlements import Entitlements, PlanLimitReached
+
+class AsyncAPI:
+    """Minimal ASGI application serving the rental and listing API on an AsyncRentalSystem.
+
+    Run it with any ASGI server, e.g. `uvicorn --factory async_api:create_asgi_app`. Each request
+    only holds the event loop while it is doing work, so one process can keep
+    thousands of slow clients open.
+    """
+
+    def __init__(self, rental_system, authenticate=None):
+        self.rental_system = rental_system
+        # Maps an API key to its {'user_id', 'tier'} record, or None if unknown; may be async
+        self.authenticate = authenticate or rental_system.authenticate_api_key
+        self.routes = [
+            ('GET', re.compile(r'^/api/art/$'), self.list_art),
+            ('GET', re.compile(r'^/api/art/(?P<art_id>\d+)$'), self.get_art),
+            ('POST', re.compile(r'^/api/generate-art$'), self.generate_art),
+            ('POST', re.compile(r'^/api/rent$'), self.rent_art),
+            ('GET', re.compile(r'^/api/user/rentals$'), self.get_user_rentals),
+        ]
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self._lifespan(receive, send)
+            return
+        if scope['type'] != 'http':
+            return
+
+        status, payload = await self._dispatch(scope, receive)
+        body = json.dumps(payload).encode('utf-8')
+        await send({
+            'type': 'http.response.start',
+            'status': status,
+            'headers': [(b'content-type', b'application/json'), (b'content-length', str(len(body)).encode())]
+        })
+        await send({'type': 'http.response.body', 'body': body})
+
+    async def _lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await self.rental_system.setup_database()
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await self.rental_system.close()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    async def _dispatch(self, scope, receive):
+        """Route a request and return (status, payload)"""
+        for method, pattern, handler in self.routes:
+            match = pattern.match(scope['path'])
+            if match and scope['method'] == method:
+                break
+        else:
+            return 404, {"error": "Not found"}
+
+        headers = {name.decode('latin-1').lower(): value.decode('latin-1') for name, value in scope['headers']}
+        auth_header = headers.get('authorization', '')
+        if not auth_header.startswith('Bearer '):
+            return 401, {"error": "Missing or invalid API key"}
+        key_record = self.authenticate(auth_header.split('Bearer ')[1])
+        if inspect.isawaitable(key_record):
+            key_record = await key_record
+        if not key_record:
+            return 401, {"error": "Invalid API key"}
+
+        request = {
+            'args': {k: v[0] for k, v in parse_qs(scope.get('query_string', b'').decode('latin-1')).items()},
+            'json': await self._read_json(receive) if method == 'POST' else None,
+            'api_key': key_record,
+        }
+        return await handler(request, **match.groupdict())
+
+    async def _read_json(self, receive):
+        body = b''
+        while True:
+            message = await receive()
+            body += message.get('body', b'')
+            if not message.get('more_body'):
+                break
+        return json.loads(body) if body else {}
+
+    async def get_art(self, request, art_id):
+        art = await self.rental_system.get_art(int(art_id))
+        if not art:
+            return 404, {"error": "Art piece not found"}
+        return 200, _serialize_art(art)
+
+    async def list_art(self, request):
+        args = request['args']
+        try:
+            limit = int(args.get('limit', DEFAULT_PAGE_SIZE))
+        except ValueError:
+            return 400, {"error": "Invalid limit"}
+        limit = max(1, min(limit, MAX_PAGE_SIZE))
+
+        filters = {}
+        for facet in ('style', 'color_palette', 'theme'):
+            values = [v for v in args.get(facet, '').split(',') if v]
+            if values:
+                filters[facet] = values
+
+        cursor = None
+        if args.get('cursor'):
+            try:
+                cursor = _decode_cursor(args['cursor'])
+            except ValueError:
+                return 400, {"error": "Invalid cursor"}
+
+        art_pieces, has_more = await self.rental_system.list_art(limit, cursor, filters)
+        return 200, {
+            "items": [_serialize_art(art) for art in art_pieces],
+            "next_cursor": _encode_cursor(art_pieces[-1]) if has_more else None
+        }
+
+    async def generate_art(self, request):
+        data = request['json']
+        new_art = await self.rental_system.create_art(
+            data.get('style', 'abstract'),
+            data.get('color_palette', 'vibrant'),
+            data.get('theme', 'nature')
+        )
+        return 200, {
+            "id": new_art.id,
+            "title": new_art.title,
+            "preview_url": f"/api/art/{new_art.id}/preview"
+        }
+
+    async def rent_art(self, request):
+        data = request['json']
+        user_id = data.get('user_id')
+        art_id = data.get('art_id')
+
+        if not user_id or not art_id:
+            return 400, {"error": "Missing required parameters"}
+        # Ids are ints everywhere else, including the entitlement cache keys
+        try:
+            user_id, art_id = int(user_id), int(art_id)
+        except (TypeError, ValueError):
+            return 400, {"error": "Invalid user or art id"}
+        try:
+            duration_days = parse_duration_days(data.get('duration_days', 1))
+        except ValueError as e:
+            return 400, {"error": str(e)}
+
+        # Same plan limits as the Flask /rent
+        allowed, reason, entitlement = await self.rental_system.check_entitlement(user_id, duration_days)
+        if not allowed:
+            return 403, {"error": reason, "entitlement": entitlement}
+
+        # Priced through the same quote service as the Flask /rent and checkout
+        try:
+            rental = await self.rental_system.rent_art(user_id, art_id, duration_days, data.get('quote'))
+        except InvalidQuote as e:
+            return 400, {"error": str(e)}
+        except PlanLimitReached:
+            return 403, {"error": Entitlements.limit_reason(entitlement), "entitlement": entitlement}
+        if rental is None:
+            return 404, {"error": "Art or user not found"}
+        if rental is False:
+            return 409, {"error": "Art piece already rented for this period"}
+
+        return 200, {
+            "rental_id": rental.id,
+            "start_date": rental.start_date.isoformat(),
+            "end_date": rental.end_date.isoformat(),
+            "price": rental.price,
+            "resolution": entitlement['resolution']
+        }
+
+    async def get_user_rentals(self, request):
+        rows = await self.rental_system.get_user_rentals(request['api_key']['user_id'])
+        now = datetime.datetime.utcnow()
+
+        result = []
+        for rental, art in rows:
+            remaining_hours = max(0, int((rental.end_date - now).total_seconds() / 3600))
+            result.append({
+                "id": rental.id,
+                "title": art.title if art else "Unknown Art",
+                "previewUrl": f"/api/art/{art.id}/preview" if art else None,
+                "startDate": rental.start_date.isoformat(),
+                "endDate": rental.end_date.isoformat(),
+                "remainingHours": remaining_hours,
+                "price": rental.price
+            })
+        return 200, result
+
+
+def create_asgi_app(database_url="sqlite+aiosqlite:///./artlens.db", authenticate=None):
+    """Create the ASGI application backed by an AsyncRentalSystem"""
+    from async_rental_system import AsyncRentalSystem
+    from autonomous_features import DynamicPricing
+    rental_system = AsyncRentalSystem(database_url)
+    # The pricing model of the Flask app, so a rental costs the same on either service
+    rental_system.quotes.pricing = DynamicPricing(rental_system)
+    # Refuse to start without the secret that signs price quotes
+    rental_system.quotes.check_secret()
+    return AsyncAPI(rental_system, authenticate=authenticate)
@@ -0,0 +1,219 @@
+import os
+import asyncio
+import datetime
+from concurrent.futures import ProcessPoolExecutor
+from sqlalchemy import select, and_, or_
+from sqlalchemy.orm import Session, sessionmaker
+from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession
+from database.models import (Base, User, ArtPiece, Rental, ApiKey, Subscription, RentalArchive, UsageCounter,
+                             CacheGeneration)
+from art_generator import generate_art
+from popularity import PopularityCounters
+from availability import AvailabilityIndex
+from api_keys import ApiKeyStore, KEY_PREFIX
+from price_quotes import PriceQuotes
+from entitlements import Entitlements, PlanLimitReached
+
+class _SyncSession(Session):
+    """Sync session class behind AsyncRentalSystem sessions, so ORM hooks apply only to them"""
+
+
+class AsyncRentalSystem:
+    """asyncio counterpart of RentalSystem built on SQLAlchemy's async engine (aiosqlite locally)"""
+
+    def __init__(self, database_url="sqlite+aiosqlite:///./artlens.db", generation_workers=None):
+        self.database_url = database_url
+        self.engine = create_async_engine(database_url)
+        self.Session = sessionmaker(bind=self.engine, class_=AsyncSession,
+                                    sync_session_class=_SyncSession, expire_on_commit=False)
+
+        # CPU-bound rendering runs in worker processes so it never blocks the event loop
+        self.executor = ProcessPoolExecutor(max_workers=generation_workers)
+
+        self.storage_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "storage")
+        if not os.path.exists(self.storage_path):
+            os.makedirs(self.storage_path)
+
+        # Same write-side bookkeeping as the sync RentalSystem
+        self.popularity = PopularityCounters(self)
+        self.popularity.register(_SyncSession)
+        self.availability = AvailabilityIndex(self)
+        self.availability.register(_SyncSession)
+        self.entitlements = Entitlements(self)
+        self.entitlements.register(_SyncSession)
+        self.api_keys = ApiKeyStore(self)
+        # Same signing secret as the Flask app, so quotes issued there are honoured here
+        self.quotes = PriceQuotes(self)
+
+    # Make models accessible through the rental system
+    @property
+    def User(self):
+        return User
+
+    @property
+    def ArtPiece(self):
+        return ArtPiece
+
+    @property
+    def Rental(self):
+        return Rental
+    
+    @property
+    def ApiKey(self):
+        return ApiKey
+
+    @property
+    def CacheGeneration(self):
+        return CacheGeneration
+
+    @property
+    def Subscription(self):
+        return Subscription
+
+    @property
+    def RentalArchive(self):
+        return RentalArchive
+
+    @property
+    def UsageCounter(self):
+        return UsageCounter
+
+    async def setup_database(self):
+        """Create tables and load the availability index"""
+        async with self.engine.begin() as conn:
+            await conn.run_sync(Base.metadata.create_all)
+
+        now = datetime.datetime.utcnow()
+        async with self.Session() as session:
+            result = await session.stream(select(
+                Rental.id, Rental.user_id, Rental.art_piece_id, Rental.start_date, Rental.end_date
+            ).where(Rental.is_active == True, Rental.end_date > now))
+            async for rental_id, user_id, art_id, start, end in result:
+                self.availability.add(rental_id, user_id, art_id, start, end)
+
+    async def close(self):
+        await self.engine.dispose()
+        self.executor.shutdown(wait=False)
+
+    async def authenticate_api_key(self, raw_key):
+        """Async counterpart of ApiKeyStore.authenticate sharing its cache"""
+        if not raw_key.startswith(KEY_PREFIX):
+            return None
+        if self.api_keys.generation_due():
+            async with self.Session() as session:
+                self.api_keys.observe_generation((await session.execute(self.api_keys.generation_query())).scalar())
+        record = self.api_keys.cache.get(self.api_keys._cache_key(raw_key), False)
+        if record is not False:
+            return record
+        async with self.Session() as session:
+            candidates = (await session.execute(self.api_keys.lookup_query(raw_key))).scalars()
+            record = self.api_keys.match(candidates, raw_key)
+        self.api_keys.remember(raw_key, record)
+        return record
+
+    async def check_entitlement(self, user_id, duration_days):
+        """Async counterpart of Entitlements.check sharing its cache; returns (allowed, reason, status)"""
+        now = datetime.datetime.utcnow()
+        entry = self.entitlements.cached(user_id, now)
+        if entry is None:
+            subscription_query, used_query = self.entitlements.load_queries(user_id, now)
+            async with self.Session() as session:
+                subscription = (await session.execute(subscription_query)).first()
+                used = (await session.execute(used_query)).scalar()
+            entry = self.entitlements.remember(user_id, subscription, used, now)
+        return self.entitlements.decide(self.entitlements.describe(entry), duration_days)
+
+    async def generate_art(self, style, color_palette, theme):
+        """Render art in the process pool and return its filename"""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, generate_art, style, color_palette, theme)
+
+    async def get_art(self, art_id):
+        async with self.Session() as session:
+            return await session.get(ArtPiece, art_id)
+
+    async def list_art(self, limit, cursor=None, filters=None):
+        """Keyset page of art pieces, newest first; returns (art_pieces, has_more)"""
+        query = select(ArtPiece)
+        for facet, values in (filters or {}).items():
+            column = getattr(ArtPiece, facet)
+            query = query.where(column == values[0] if len(values) == 1 else column.in_(values))
+        if cursor:
+            created_at, art_id = cursor
+            query = query.where(or_(
+                ArtPiece.created_at < created_at,
+                and_(ArtPiece.created_at == created_at, ArtPiece.id < art_id)
+            ))
+        query = query.order_by(ArtPiece.created_at.desc(), ArtPiece.id.desc()).limit(limit + 1)
+
+        async with self.Session() as session:
+            art_pieces = (await session.execute(query)).scalars().all()
+        return art_pieces[:limit], len(art_pieces) > limit
+
+    async def create_art(self, style, color_palette, theme):
+        """Generate and store a new art piece"""
+        art_filename = await self.generate_art(style, color_palette, theme)
+        async with self.Session() as session:
+            new_art = ArtPiece(
+                title=f"{style.capitalize()} {theme.capitalize()}",
+                file_path=art_filename,
+                style=style,
+                color_palette=color_palette,
+                theme=theme
+            )
+            session.add(new_art)
+            await session.commit()
+            return new_art
+
+    async def rent_art(self, user_id, art_id, duration_days, quote=None):
+        """Create a rental at the quoted price, or the current quote without one.
+        
+        Returns None if the art or user is missing and False on overlap; raises
+        InvalidQuote for a quote that does not verify and PlanLimitReached when
+        the user's plan has no rentals left this month.
+        """
+        async with self.Session() as session:
+            art = await session.get(ArtPiece, art_id)
+            user = await session.get(User, user_id)
+            if not art or not user:
+                return None
+
+            start_date = datetime.datetime.utcnow()
+            end_date = start_date + datetime.timedelta(days=duration_days)
+            if quote:
+                price = self.quotes.verify(quote, art.id, duration_days)
+            else:
+                price = self.quotes.quote_art(art, duration_days)['price']
+
+            if self.availability.is_rented(art.id, user.id, start_date, end_date) or not await session.run_sync(
+                lambda sync_session: self.availability.reserve(sync_session, art.id, user.id, start_date, end_date)
+            ):
+                await session.rollback()
+                return False
+            if not await session.run_sync(
+                lambda sync_session: self.entitlements.claim(sync_session, user.id, start_date)
+            ):
+                await session.rollback()
+                raise PlanLimitReached()
+
+            new_rental = Rental(
+                user_id=user.id,
+                art_piece_id=art.id,
+                start_date=start_date,
+                end_date=end_date,
+                price=price,
+                is_active=True
+            )
+            session.add(new_rental)
+            await session.commit()
+            return new_rental
+
+    async def get_user_rentals(self, user_id):
+        """Active rentals for a user joined with their art pieces"""
+        async with self.Session() as session:
+            result = await session.execute(
+                select(Rental, ArtPiece)
+                .outerjoin(ArtPiece, ArtPiece.id == Rental.art_piece_id)
+                .where(Rental.user_id == user_id, Rental.is_active == True)
+            )
+            return result.all()
@@ -7,8 +7,46 @@ from sklearn.ensemble import RandomForestRegressor
 from sklearn.preprocessing import StandardScaler
 import joblib
 import os
+import time
 
 class DynamicPricing:
+    # Map categorical features to numeric values
+    STYLE_CODES = {
+        'geometric': 0.1,
+        'pixel': 0.2,
+        'gradient': 0.3,
+        'fractal': 0.4,
+        'expressionist': 0.5
+    }
+    
+    COLOR_CODES = {
+        'vibrant': 0.1,
+        'pastel': 0.2,
+        'monochrome': 0.3,
+        'earthy': 0.4,
+        'ocean': 0.5
+    }
+    
+    THEME_CODES = {
+        'nature': 0.1,
+        'space': 0.2,
+        'urban': 0.3,
+        'abstract': 0.4,
+        'ocean': 0.5
+    }
+    
+    # Complexity based on style
+    COMPLEXITY = {
+        'geometric': 0.3,
+        'pixel': 0.4,
+        'gradient': 0.2,
+        'fractal': 0.8,
+        'expressionist': 0.6
+    }
+    
+    # Popularity is rental_count / 10 capped at 1.0, so counts 0-10 are every value the model sees
+    POPULARITY_LEVELS = 11
+    
     def __init__(self, rental_system):
         self.rental_system = rental_system
         self.base_price = 5.0  # Base price per day
@@ -19,9 +57,17 @@ class DynamicPricing:
         
         self.price_model_path = os.path.join(self.model_path, "price_model.joblib")
         self.scaler_path = os.path.join(self.model_path, "price_scaler.joblib")
+        # Forest predictions over the whole feature grid, distilled from the model above
+        self.price_table_path = os.path.join(self.model_path, "price_table.npz")
+        
+        # Category -> table index; unknown values use the extra last slot
+        self._style_index = {style: i for i, style in enumerate(self.STYLE_CODES)}
+        self._color_index = {color: i for i, color in enumerate(self.COLOR_CODES)}
+        self._theme_index = {theme: i for i, theme in enumerate(self.THEME_CODES)}
         
         # Initialize or load model
         self._initialize_model()
+        self._load_price_table()
     
     def _initialize_model(self):
         """Initialize pricing model or load existing one"""
@@ -77,95 +123,195 @@ class DynamicPricing:
             session.close()
             return None
         
-        # Get rental count for popularity
-        rental_count = session.query(self.rental_system.Rental).filter(
-            self.rental_system.Rental.art_piece_id == art_id
-        ).count()
-        
-        # Map categorical features to numeric values
-        style_map = {
-            'geometric': 0.1,
-            'pixel': 0.2,
-            'gradient': 0.3,
-            'fractal': 0.4,
-            'expressionist': 0.5
-        }
-        
-        color_map = {
-            'vibrant': 0.1,
-            'pastel': 0.2,
-            'monochrome': 0.3,
-            'earthy': 0.4,
-            'ocean': 0.5
-        }
-        
-        theme_map = {
-            'nature': 0.1,
-            'space': 0.2,
-            'urban': 0.3,
-            'abstract': 0.4,
-            'ocean': 0.5
-        }
-        
-        # Calculate complexity based on style
-        complexity_map = {
-            'geometric': 0.3,
-            'pixel': 0.4,
-            'gradient': 0.2,
-            'fractal': 0.8,
-            'expressionist': 0.6
-        }
+        # Rental count for popularity is kept denormalized on the art piece
+        features = np.array([self._feature_row(art.style, art.color_palette, art.theme, art.rental_count or 0,
+                                               datetime.datetime.now().hour)])
         
+        session.close()
+        return features
+    
+    def _feature_row(self, style, color_palette, theme, rental_count, hour):
+        """Feature vector for one art piece at the given hour"""
         # Calculate current demand (simplified)
         # In a real system, this would be based on recent views, searches, etc.
-        current_hour = datetime.datetime.now().hour
         # Assume higher demand in evenings
-        time_factor = 0.5 + 0.5 * (current_hour >= 17 and current_hour <= 23)
+        time_factor = 0.5 + 0.5 * (hour >= 17 and hour <= 23)
         # Assume higher demand for certain styles
-        style_demand = 0.7 if art.style in ['fractal', 'expressionist'] else 0.3
+        style_demand = 0.7 if style in ['fractal', 'expressionist'] else 0.3
         demand = (time_factor + style_demand) / 2
         
-        # Create feature vector
-        style_code = style_map.get(art.style, 0.0)
-        color_code = color_map.get(art.color_palette, 0.0)
-        theme_code = theme_map.get(art.theme, 0.0)
-        popularity = min(1.0, rental_count / 10)  # Normalize to 0-1
-        complexity = complexity_map.get(art.style, 0.5)
-        
-        features = np.array([[
-            style_code,
-            color_code,
-            theme_code,
-            popularity,
-            complexity,
+        return [
+            self.STYLE_CODES.get(style, 0.0),
+            self.COLOR_CODES.get(color_palette, 0.0),
+            self.THEME_CODES.get(theme, 0.0),
+            min(1.0, rental_count / 10),  # Normalize popularity to 0-1
+            self.COMPLEXITY.get(style, 0.5),
             demand
-        ]])
+        ]
+    
+    def _load_price_table(self):
+        """Load the distilled table, distilling again if it is missing or older than the model"""
+        self.price_table = None
+        if os.path.exists(self.price_table_path) and \
+                os.path.getmtime(self.price_table_path) >= os.path.getmtime(self.price_model_path):
+            self._table_version = self._file_version(self.price_table_path)
+            with np.load(self.price_table_path) as saved:
+                # A table built for other category maps does not line up with the current indexes
+                if [list(saved['styles']), list(saved['colors']), list(saved['themes'])] == \
+                        [list(self.STYLE_CODES), list(self.COLOR_CODES), list(self.THEME_CODES)]:
+                    self.price_table = saved['multipliers']
+        if self.price_table is None:
+            self.distill()
+    
+    @staticmethod
+    def _file_version(path):
+        # The table is replaced rather than rewritten, so a new inode also marks a new version
+        stat = os.stat(path)
+        return (stat.st_mtime_ns, stat.st_ino)
+    
+    def _reload_if_changed(self):
+        """Pick up a model and table another worker saved, e.g. through update_model"""
+        try:
+            version = self._file_version(self.price_table_path)
+        except FileNotFoundError:
+            return
+        if version != self._table_version:
+            self._initialize_model()
+            self._load_price_table()
+            self._clear_quotes()
+    
+    def _clear_quotes(self):
+        # Cached quotes were priced from the previous table
+        quotes = getattr(self.rental_system, 'quotes', None)
+        if quotes is not None:
+            quotes.clear()
+    
+    def distill(self):
+        """Evaluate the forest over every bucketed feature combination and save the multipliers.
+        
+        Axes are style, color palette, theme (each with a slot for unknown
+        values), popularity level and evening demand. Every feature is a
+        function of these, so lookups return exactly what the forest predicts.
+        """
+        styles = list(self.STYLE_CODES) + [None]
+        colors = list(self.COLOR_CODES) + [None]
+        themes = list(self.THEME_CODES) + [None]
+        # Noon and 8pm stand for daytime and evening demand
+        rows = [self._feature_row(style, color, theme, rental_count, hour)
+                for style in styles for color in colors for theme in themes
+                for rental_count in range(self.POPULARITY_LEVELS) for hour in (12, 20)]
+        
+        predicted = self.model.predict(self.scaler.transform(np.array(rows)))
+        shape = (len(styles), len(colors), len(themes), self.POPULARITY_LEVELS, 2)
+        self.price_table = np.clip(predicted, 0.8, 1.5).reshape(shape)
+        
+        # Written aside and renamed into place, so other workers never load a partial table
+        temporary_path = f"{self.price_table_path}.{os.getpid()}.tmp"
+        with open(temporary_path, 'wb') as f:
+            np.savez(f, multipliers=self.price_table, styles=styles[:-1], colors=colors[:-1], themes=themes[:-1])
+        os.replace(temporary_path, self.price_table_path)
+        self._table_version = self._file_version(self.price_table_path)
+        return self.price_table
+    
+    def _table_index(self, style, color_palette, theme, rental_count, hour):
+        return (
+            self._style_index.get(style, len(self._style_index)),
+            self._color_index.get(color_palette, len(self._color_index)),
+            self._theme_index.get(theme, len(self._theme_index)),
+            min(rental_count, self.POPULARITY_LEVELS - 1),
+            int(17 <= hour <= 23)
+        )
+    
+    def _multipliers(self, attributes, hour):
+        """Price multipliers for (style, color_palette, theme, rental_count) tuples"""
+        self._reload_if_changed()
+        if self.price_table is not None:
+            index = np.array([self._table_index(*attrs, hour) for attrs in attributes]).T
+            return self.price_table[tuple(index)]
+        features = np.array([self._feature_row(*attrs, hour) for attrs in attributes])
+        return np.clip(self.model.predict(self.scaler.transform(features)), 0.8, 1.5)
+    
+    def distillation_report(self, samples=2000, timed=50, seed=0):
+        """Compare table lookups with forest predictions on random art attributes and hours"""
+        rng = np.random.RandomState(seed)
+        styles = list(self.STYLE_CODES) + ['unknown']
+        colors = list(self.COLOR_CODES) + ['unknown']
+        themes = list(self.THEME_CODES) + ['unknown']
+        cases = [((str(rng.choice(styles)), str(rng.choice(colors)), str(rng.choice(themes)), int(rng.randint(0, 25))),
+                  int(rng.randint(0, 24))) for _ in range(samples)]
+        
+        features = np.array([self._feature_row(*attrs, hour) for attrs, hour in cases])
+        forest = np.clip(self.model.predict(self.scaler.transform(features)), 0.8, 1.5)
+        table = np.array([self.price_table[self._table_index(*attrs, hour)] for attrs, hour in cases])
+        errors = np.abs(table - forest)
+        
+        # Per-quote cost as calculate_price pays it: one single-row predict against one lookup
+        start = time.perf_counter()
+        for i in range(timed):
+            self.model.predict(self.scaler.transform(features[i:i + 1]))
+        forest_seconds = (time.perf_counter() - start) / timed
+        start = time.perf_counter()
+        for attrs, hour in cases:
+            self.price_table[self._table_index(*attrs, hour)]
+        table_seconds = (time.perf_counter() - start) / samples
         
+        return {
+            'cells': int(self.price_table.size),
+            'table_bytes': int(self.price_table.nbytes),
+            'samples': samples,
+            'max_abs_error': float(errors.max()),
+            'mean_abs_error': float(errors.mean()),
+            # Worst difference in the daily price, in USD
+            'max_daily_price_error': float(errors.max() * self.base_price),
+            'forest_ms_per_quote': round(forest_seconds * 1000, 3),
+            'table_us_per_quote': round(table_seconds * 1e6, 3)
+        }
+    
+    def _art_attributes(self, art_ids):
+        """(style, color_palette, theme, rental_count) per existing art id, from one query"""
+        ArtPiece = self.rental_system.ArtPiece
+        session = self.rental_system.Session()
+        rows = session.query(ArtPiece.id, ArtPiece.style, ArtPiece.color_palette, ArtPiece.theme,
+                             ArtPiece.rental_count).filter(ArtPiece.id.in_(set(art_ids))).all()
         session.close()
-        return features
+        return {row.id: (row.style, row.color_palette, row.theme, row.rental_count or 0) for row in rows}
     
     def calculate_price(self, art_id, duration_days):
         """Calculate dynamic price for an art rental"""
-        features = self._get_art_features(art_id)
-        
-        if features is None:
-            # If art not found, return base price
-            return self.base_price * duration_days
-        
-        # Scale features
-        features_scaled = self.scaler.transform(features)
-        
-        # Predict price multiplier
-        price_multiplier = self.model.predict(features_scaled)[0]
-        
-        # Ensure multiplier is within reasonable bounds
-        price_multiplier = max(0.8, min(1.5, price_multiplier))
-        
-        # Calculate final price
-        price = self.base_price * price_multiplier * duration_days
-        
-        # Round to 2 decimal places
-        return round(price, 2)
+        return self.calculate_prices([art_id], duration_days)[0]
+    
+    def calculate_prices(self, art_ids, durations):
+        """Prices for many rentals at once, in the order of art_ids.
+        
+        durations is one duration for every piece or a list matching art_ids.
+        Attributes come from a single query and multipliers from the distilled
+        table (or one forest predict over the whole matrix without it).
+        """
+        art_ids = list(art_ids)
+        found = self._art_attributes(art_ids) if art_ids else {}
+        return self.price_attributes([found.get(art_id) for art_id in art_ids], durations)
+    
+    def price_attributes(self, attributes, durations):
+        """calculate_prices for already loaded (style, color_palette, theme, rental_count) tuples.
+        
+        Used by callers without a sync session, such as the async service.
+        None stands for a missing piece, which costs the base price.
+        """
+        if not isinstance(durations, (list, tuple)):
+            durations = [int(durations)] * len(attributes)
+        if len(durations) != len(attributes):
+            raise ValueError("durations must be a single value or match the pieces priced")
+        if not attributes:
+            return []
+        
+        known = [index for index, attrs in enumerate(attributes) if attrs is not None]
+        multipliers = np.ones(len(attributes))
+        if known:
+            hour = datetime.datetime.now().hour
+            multipliers[known] = self._multipliers([attributes[index] for index in known], hour)
+        
+        prices = self.base_price * multipliers * np.array(durations, dtype=float)
+        return [round(float(price), 2) for price in prices]
     
     def update_model(self, rental_data):
         """Update the pricing model with new rental data"""
@@ -200,6 +346,11 @@ class DynamicPricing:
         # Save updated model
         joblib.dump(self.model, self.price_model_path)
         
+        # Quotes come from the table, so it must follow the retrained forest; other
+        # workers reload it when they see the file change
+        self.distill()
+        self._clear_quotes()
+        
         return True
 
 
@@ -293,21 +444,19 @@ class ContentCurationAI:
         
         session = self.rental_system.Session()
         
-        # Build query based on preferences
-        query = session.query(self.rental_system.ArtPiece)
-        
-        # Filter by user's preferred styles, color palettes, and themes
-        if preferences['preferred_styles']:
-            query = query.filter(self.rental_system.ArtPiece.style.in_(preferences['preferred_styles']))
-        
-        if preferences['preferred_color_palettes']:
-            query = query.filter(self.rental_system.ArtPiece.color_palette.in_(preferences['preferred_color_palettes']))
-        
-        if preferences['preferred_themes']:
-            query = query.filter(self.rental_system.ArtPiece.theme.in_(preferences['preferred_themes']))
+        # Match the user's preferred styles, color palettes, and themes in the facet index
+        art_ids = self.rental_system.facet_index.ids(
+            style=preferences['preferred_styles'] or None,
+            color_palette=preferences['preferred_color_palettes'] or None,
+            theme=preferences['preferred_themes'] or None
+        )[:count]
         
         # Get results
-        art_pieces = query.limit(count).all()
+        art_pieces = []
+        if len(art_ids):
+            art_pieces = session.query(self.rental_system.ArtPiece).filter(
+                self.rental_system.ArtPiece.id.in_([int(art_id) for art_id in art_ids])
+            ).all()
         
         # If not enough results, get random art to fill
         if len(art_pieces) < count:
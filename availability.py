@@ -0,0 +1,169 @@
+import bisect
+import datetime
+import threading
+from sqlalchemy import update
+from session_hooks import on_commit
+
+class _IntervalList:
+    """Rental intervals for one key, sorted by start with a running maximum of end dates.
+
+    An interval [start, end) overlaps the query [qs, qe) iff start < qe and
+    end > qs. Bisecting the starts finds every interval with start < qe, and
+    the running maximum of their ends answers "any end > qs" in O(log n).
+    """
+
+    def __init__(self):
+        self.starts = []
+        self.ends = []
+        self.rental_ids = []
+        self.max_ends = []
+
+    def add(self, rental_id, start, end):
+        i = bisect.bisect_right(self.starts, start)
+        self.starts.insert(i, start)
+        self.ends.insert(i, end)
+        self.rental_ids.insert(i, rental_id)
+        self.max_ends.insert(i, end)
+        self._refresh_max(i)
+
+    def remove(self, rental_id):
+        i = self.rental_ids.index(rental_id)
+        del self.starts[i], self.ends[i], self.rental_ids[i], self.max_ends[i]
+        self._refresh_max(i)
+
+    def _refresh_max(self, i):
+        for j in range(i, len(self.ends)):
+            previous = self.max_ends[j - 1] if j else None
+            self.max_ends[j] = self.ends[j] if previous is None or self.ends[j] > previous else previous
+
+    def overlaps(self, start, end):
+        i = bisect.bisect_left(self.starts, end)
+        return i > 0 and self.max_ends[i - 1] > start
+
+    def __len__(self):
+        return len(self.starts)
+
+
+class AvailabilityIndex:
+    """In-memory interval index over active rentals, per art piece and per (user, art piece)"""
+
+    def __init__(self, rental_system):
+        self.rental_system = rental_system
+        self._lock = threading.RLock()
+        self._by_art = {}
+        self._by_user_art = {}
+        self._rentals = {}
+
+    def register(self, session_factory):
+        """Keep the index in sync with committed Rental inserts, updates and deletes"""
+        on_commit(
+            session_factory,
+            self.rental_system.Rental,
+            lambda rental: (rental.id, rental.user_id, rental.art_piece_id,
+                            rental.start_date, rental.end_date, rental.is_active),
+            self._apply_commit
+        )
+
+    def _apply_commit(self, added, updated, deleted):
+        with self._lock:
+            for rental_id, *_ in deleted + updated:
+                self.remove(rental_id)
+            for rental_id, user_id, art_id, start, end, is_active in added + updated:
+                if is_active is not False:
+                    self.add(rental_id, user_id, art_id, start, end)
+
+    def rebuild(self, now=None, batch_size=10000):
+        """Load every active rental that has not ended yet"""
+        now = now or datetime.datetime.utcnow()
+        Rental = self.rental_system.Rental
+        session = self.rental_system.Session()
+        rows = session.query(
+            Rental.id, Rental.user_id, Rental.art_piece_id, Rental.start_date, Rental.end_date
+        ).filter(
+            Rental.is_active == True,
+            Rental.end_date > now
+        ).yield_per(batch_size)
+
+        with self._lock:
+            self._by_art = {}
+            self._by_user_art = {}
+            self._rentals = {}
+            for rental_id, user_id, art_id, start, end in rows:
+                self.add(rental_id, user_id, art_id, start, end)
+
+        session.close()
+
+    def add(self, rental_id, user_id, art_id, start, end):
+        """Index one rental covering [start, end)"""
+        with self._lock:
+            if rental_id in self._rentals:
+                self.remove(rental_id)
+            self._rentals[rental_id] = (user_id, art_id)
+            self._by_art.setdefault(art_id, _IntervalList()).add(rental_id, start, end)
+            self._by_user_art.setdefault((user_id, art_id), _IntervalList()).add(rental_id, start, end)
+
+    def remove(self, rental_id):
+        """Drop one rental from the index if present"""
+        with self._lock:
+            keys = self._rentals.pop(rental_id, None)
+            if keys is None:
+                return
+            user_id, art_id = keys
+            for index, key in ((self._by_art, art_id), (self._by_user_art, (user_id, art_id))):
+                intervals = index[key]
+                intervals.remove(rental_id)
+                if not intervals:
+                    del index[key]
+
+    def prune(self, now=None):
+        """Forget rentals that ended before `now`; returns how many were dropped"""
+        now = now or datetime.datetime.utcnow()
+        with self._lock:
+            ended = [
+                rental_id
+                for intervals in self._by_art.values()
+                for rental_id, end in zip(intervals.rental_ids, intervals.ends)
+                if end <= now
+            ]
+            for rental_id in ended:
+                self.remove(rental_id)
+        return len(ended)
+
+    def is_rented(self, art_id, user_id, start, end):
+        """True if `user_id` already rents `art_id` at any point in [start, end)"""
+        with self._lock:
+            intervals = self._by_user_art.get((user_id, art_id))
+            return intervals is not None and intervals.overlaps(start, end)
+
+    def reserve(self, session, art_id, user_id, start, end):
+        """Lock `art_id` for the rest of the caller's write transaction, then return False if
+        the database already holds an active rental of it by `user_id` overlapping [start, end).
+
+        The index only sees this process's commits, so it is a fast path; this is
+        the check that holds across workers. The lock makes a concurrent rental of
+        the same piece wait until this transaction ends, so its check sees ours.
+        """
+        art_pieces = self.rental_system.ArtPiece.__table__
+        Rental = self.rental_system.Rental
+        # A no-op UPDATE takes the row lock (SQLite: the database write lock) until commit or rollback
+        session.execute(update(art_pieces).where(art_pieces.c.id == art_id).values(id=art_pieces.c.id))
+        overlap = session.query(Rental.id).filter(
+            Rental.user_id == user_id,
+            Rental.art_piece_id == art_id,
+            Rental.is_active == True,
+            Rental.start_date < end,
+            Rental.end_date > start
+        ).first()
+        return overlap is None
+
+    def is_rented_now(self, art_id, now=None):
+        """True if anyone is renting `art_id` at `now`"""
+        now = now or datetime.datetime.utcnow()
+        with self._lock:
+            intervals = self._by_art.get(art_id)
+            return intervals is not None and intervals.overlaps(now, now + datetime.timedelta(microseconds=1))
+
+    def free_pieces(self, art_ids, now=None):
+        """Subset of `art_ids` that nobody is renting at `now`, in the given order"""
+        now = now or datetime.datetime.utcnow()
+        return [art_id for art_id in art_ids if not self.is_rented_now(art_id, now)]
@@ -0,0 +1,265 @@
+import os
+import sys
+import csv
+import json
+import datetime
+import argparse
+from sqlalchemy import Integer, Float, Boolean, DateTime
+from response_cache import invalidate
+
+class CatalogTransfer:
+    """Stream the art catalog (and optionally rentals) to and from JSONL/CSV files"""
+
+    FORMATS = ('jsonl', 'csv')
+
+    def __init__(self, rental_system, batch_size=5000, progress=None):
+        self.rental_system = rental_system
+        self.batch_size = batch_size
+        # Called as progress(table_name, rows_done) after every batch
+        self.progress = progress
+
+    def export_catalog(self, path, fmt=None, include_rentals=False):
+        """Write the catalog to `path`, one batch of rows in memory at a time"""
+        fmt = self._resolve_format(path, fmt)
+        counts = {}
+
+        if fmt == 'jsonl':
+            with open(path, 'w', encoding='utf-8') as f:
+                counts['art_pieces'] = self._export_jsonl(self.rental_system.ArtPiece.__table__, f)
+                if include_rentals:
+                    counts['rentals'] = self._export_jsonl(self.rental_system.Rental.__table__, f)
+        else:
+            with open(path, 'w', encoding='utf-8', newline='') as f:
+                counts['art_pieces'] = self._export_csv(self.rental_system.ArtPiece.__table__, f)
+            if include_rentals:
+                with open(self._rentals_csv_path(path), 'w', encoding='utf-8', newline='') as f:
+                    counts['rentals'] = self._export_csv(self.rental_system.Rental.__table__, f)
+
+        return counts
+
+    def import_catalog(self, path, fmt=None, include_rentals=False, keep_ids=True):
+        """Load a catalog written by export_catalog using batched executemany inserts.
+
+        The inserts bypass the ORM flush hooks, so the derived state they maintain
+        (facet index, popularity counters, availability index, usage counters) is
+        rebuilt once the rows are in.
+        """
+        if include_rentals and not keep_ids:
+            # Rentals reference art and users by their exported ids
+            raise ValueError("Rentals can only be imported with keep_ids, since new art ids would orphan them")
+        fmt = self._resolve_format(path, fmt)
+        tables = {
+            'art_pieces': self.rental_system.ArtPiece.__table__,
+            'rentals': self.rental_system.Rental.__table__,
+        }
+        counts = {}
+        # Users whose rentals were imported, for response cache invalidation
+        user_ids = set()
+
+        if fmt == 'jsonl':
+            with open(path, 'r', encoding='utf-8') as f:
+                records = self._iter_jsonl(f, include_rentals)
+                counts = self._import_records(records, tables, keep_ids, user_ids)
+        else:
+            with open(path, 'r', encoding='utf-8', newline='') as f:
+                records = (('art_pieces', row) for row in csv.DictReader(f))
+                counts.update(self._import_records(records, tables, keep_ids, user_ids))
+            rentals_path = self._rentals_csv_path(path)
+            if include_rentals and os.path.exists(rentals_path):
+                with open(rentals_path, 'r', encoding='utf-8', newline='') as f:
+                    records = (('rentals', row) for row in csv.DictReader(f))
+                    counts.update(self._import_records(records, tables, keep_ids, user_ids))
+
+        self._rebuild_derived(counts, user_ids)
+        return counts
+
+    def _rebuild_derived(self, counts, user_ids):
+        """Bring hook-maintained state back in step after bulk inserts"""
+        rental_system = self.rental_system
+        if counts.get('art_pieces'):
+            rental_system.facet_index.rebuild()
+        # Counters describe the rentals in this database, not the ones the export came from
+        rental_system.popularity.rebuild()
+        if counts.get('rentals'):
+            rental_system.availability.rebuild()
+            rental_system.entitlements.rebuild()
+        # Cached listings and the imported users' responses predate the new rows
+        invalidate(rental_system, ['art'] + [f"user:{user_id}" for user_id in sorted(user_ids)])
+
+    def iter_records(self, include_rentals=False):
+        """Yield export records tagged with their table name, e.g. for streaming over HTTP"""
+        tables = [self.rental_system.ArtPiece.__table__]
+        if include_rentals:
+            tables.append(self.rental_system.Rental.__table__)
+        for table in tables:
+            for rows in self._iter_batches(table):
+                for row in rows:
+                    record = {'table': table.name}
+                    record.update(self._serialize_row(table, row))
+                    yield record
+
+    def _export_jsonl(self, table, f):
+        """Write every row of `table` as a JSON line tagged with the table name"""
+        count = 0
+        for rows in self._iter_batches(table):
+            for row in rows:
+                record = {'table': table.name}
+                record.update(self._serialize_row(table, row))
+                f.write(json.dumps(record) + '\n')
+            count += len(rows)
+            self._report(table.name, count)
+        return count
+
+    def _export_csv(self, table, f):
+        """Write every row of `table` as CSV with a header line"""
+        writer = csv.writer(f)
+        writer.writerow([column.name for column in table.columns])
+        count = 0
+        for rows in self._iter_batches(table):
+            for row in rows:
+                values = self._serialize_row(table, row)
+                writer.writerow(['' if values[c.name] is None else values[c.name] for c in table.columns])
+            count += len(rows)
+            self._report(table.name, count)
+        return count
+
+    def _iter_batches(self, table):
+        """Stream rows of `table` in primary key order using a server-side cursor"""
+        with self.rental_system.engine.connect() as conn:
+            result = conn.execution_options(stream_results=True).execute(
+                table.select().order_by(table.c.id)
+            )
+            while True:
+                rows = result.fetchmany(self.batch_size)
+                if not rows:
+                    break
+                yield rows
+
+    def _iter_jsonl(self, f, include_rentals):
+        """Yield (table_name, record) pairs from a JSONL export"""
+        for line in f:
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            table_name = record.pop('table', 'art_pieces')
+            if table_name == 'rentals' and not include_rentals:
+                continue
+            yield table_name, record
+
+    def _import_records(self, records, tables, keep_ids, user_ids):
+        """Insert records in chunks of batch_size, one transaction per chunk, noting rental users in user_ids"""
+        counts = {}
+        batch = []
+        batch_table = None
+
+        for table_name, record in records:
+            if table_name not in tables:
+                raise ValueError(f"Unknown table in catalog file: {table_name}")
+            if batch and table_name != batch_table:
+                self._flush(tables[batch_table], batch, counts)
+                batch = []
+            batch_table = table_name
+            batch.append(self._coerce_record(tables[table_name], record, keep_ids))
+            if table_name == 'rentals' and batch[-1].get('user_id') is not None:
+                user_ids.add(batch[-1]['user_id'])
+            if len(batch) >= self.batch_size:
+                self._flush(tables[batch_table], batch, counts)
+                batch = []
+
+        if batch:
+            self._flush(tables[batch_table], batch, counts)
+
+        return counts
+
+    def _flush(self, table, batch, counts):
+        """Insert one chunk with a single executemany inside its own transaction"""
+        with self.rental_system.engine.begin() as conn:
+            conn.execute(table.insert(), batch)
+        counts[table.name] = counts.get(table.name, 0) + len(batch)
+        self._report(table.name, counts[table.name])
+
+    def _serialize_row(self, table, row):
+        """Convert a result row to JSON/CSV friendly values"""
+        # table.select() returns columns in table order, so rows zip with column names
+        values = dict(zip(table.columns.keys(), row))
+        for name, value in values.items():
+            if isinstance(value, datetime.datetime):
+                values[name] = value.isoformat()
+        return values
+
+    def _coerce_record(self, table, record, keep_ids):
+        """Map a parsed record onto `table` columns, converting CSV strings to column types"""
+        values = {}
+        for column in table.columns:
+            if column.name not in record:
+                continue
+            if column.name == 'id' and not keep_ids:
+                continue
+            value = record[column.name]
+            if value == '' or value is None:
+                value = None
+            elif isinstance(column.type, DateTime) and isinstance(value, str):
+                value = datetime.datetime.fromisoformat(value)
+            elif isinstance(column.type, Boolean) and isinstance(value, str):
+                value = value.lower() in ('1', 'true', 'yes')
+            elif isinstance(column.type, Integer) and isinstance(value, str):
+                value = int(value)
+            elif isinstance(column.type, Float) and isinstance(value, str):
+                value = float(value)
+            if value is None and not column.nullable:
+                # Let column defaults apply instead of inserting NULL
+                continue
+            values[column.name] = value
+        return values
+
+    def _report(self, table_name, count):
+        if self.progress:
+            self.progress(table_name, count)
+
+    def _resolve_format(self, path, fmt):
+        """Infer the file format from the extension unless given explicitly"""
+        if fmt is None:
+            fmt = os.path.splitext(path)[1].lstrip('.').lower() or 'jsonl'
+        if fmt not in self.FORMATS:
+            raise ValueError(f"Unsupported catalog format: {fmt}")
+        return fmt
+
+    def _rentals_csv_path(self, path):
+        """CSV holds one table per file, so rentals go next to the catalog file"""
+        base, ext = os.path.splitext(path)
+        return f"{base}.rentals{ext or '.csv'}"
+
+
+def main(argv=None):
+    """Command line entry point: python catalog_io.py export|import PATH"""
+    parser = argparse.ArgumentParser(description="Stream the ArtLens catalog to or from JSONL/CSV")
+    parser.add_argument('command', choices=['export', 'import'])
+    parser.add_argument('path')
+    parser.add_argument('--format', choices=CatalogTransfer.FORMATS, default=None)
+    parser.add_argument('--database-url', default=os.environ.get('DATABASE_URL', "sqlite:///./artlens.db"))
+    parser.add_argument('--include-rentals', action='store_true')
+    parser.add_argument('--batch-size', type=int, default=5000)
+    parser.add_argument('--new-ids', action='store_true', help="Let the database assign new ids on import")
+    args = parser.parse_args(argv)
+    if args.include_rentals and args.new_ids and args.command == 'import':
+        parser.error("--include-rentals cannot be combined with --new-ids")
+
+    from rental_system import RentalSystem
+    rental_system = RentalSystem(None, database_url=args.database_url)
+
+    def progress(table_name, count):
+        sys.stderr.write(f"\r{args.command}ed {count} {table_name}")
+        sys.stderr.flush()
+
+    transfer = CatalogTransfer(rental_system, batch_size=args.batch_size, progress=progress)
+    if args.command == 'export':
+        counts = transfer.export_catalog(args.path, args.format, args.include_rentals)
+    else:
+        counts = transfer.import_catalog(args.path, args.format, args.include_rentals,
+                                         keep_ids=not args.new_ids)
+    sys.stderr.write('\n')
+    print(json.dumps(counts))
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
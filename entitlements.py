@@ -0,0 +1,246 @@
+import sys
+import json
+import argparse
+import datetime
+from collections import Counter
+from sqlalchemy import event, select, update, delete, insert, union_all
+from sqlalchemy.exc import IntegrityError
+from ttl_cache import TTLCache
+from session_hooks import on_commit
+
+# What each subscription plan allows per calendar month (UTC); None means no limit
+PLANS = {
+    'basic': {'monthly_rentals': 3, 'max_duration_days': 1, 'resolution': 'standard'},
+    'premium': {'monthly_rentals': 10, 'max_duration_days': 7, 'resolution': 'high'},
+    'unlimited': {'monthly_rentals': None, 'max_duration_days': 30, 'resolution': 'ultra'},
+}
+
+# Users without a subscription pay for each rental
+PAY_PER_RENTAL = {'monthly_rentals': None, 'max_duration_days': 30, 'resolution': 'standard'}
+
+# session.info key for rentals already counted by claim() in the current transaction
+_CLAIMED = 'entitlements_claimed'
+
+def period_of(moment):
+    """Usage period a rental starting at `moment` counts against"""
+    return moment.strftime('%Y-%m')
+
+
+class PlanLimitReached(Exception):
+    """Raised when a rental would exceed the monthly limit of the user's plan"""
+
+
+class Entitlements:
+    """Plan limits checked against materialized per-user monthly usage counters.
+
+    Every flushed Rental insert increments UsageCounter for its user and month
+    in the same transaction, so counters never drift from the rentals that
+    committed. check() answers from a per-user cache of (plan, period, usage);
+    committed rentals bump the cached usage in place and subscription changes
+    drop the entry, so only the first check of a user after a miss queries.
+    Other workers see a user's new rentals once their entry expires
+    (`cache_ttl` seconds), so check() only refuses early; the limit itself is
+    enforced by claim() with a conditional UPDATE in the rental's transaction.
+    """
+
+    def __init__(self, rental_system, cache_size=10000, cache_ttl=60):
+        self.rental_system = rental_system
+        self.cache = TTLCache(maxsize=cache_size, ttl=cache_ttl)
+
+    def register(self, session_factory):
+        """Count rentals flushed through sessions of `session_factory` and keep the cache current"""
+        event.listen(session_factory, 'after_flush', self._after_flush)
+        for name in ('after_commit', 'after_rollback'):
+            event.listen(session_factory, name, lambda session: session.info.pop(_CLAIMED, None))
+
+        def rentals_committed(added, updated, deleted):
+            for user_id, period in added:
+                self.cache.update(user_id, lambda entry: (
+                    dict(entry, used=entry['used'] + 1) if entry and entry['period'] == period else entry, None
+                ))
+
+        def subscriptions_committed(added, updated, deleted):
+            for user_id in set(added + updated + deleted):
+                self.cache.pop(user_id)
+
+        on_commit(session_factory, self.rental_system.Rental,
+                  lambda rental: (rental.user_id, period_of(rental.start_date)), rentals_committed)
+        on_commit(session_factory, self.rental_system.Subscription,
+                  lambda subscription: subscription.user_id, subscriptions_committed)
+
+    def _after_flush(self, session, flush_context):
+        """Increment usage counters for rentals inserted by this flush, inside the same transaction"""
+        Rental = self.rental_system.Rental
+        usage = Counter((obj.user_id, period_of(obj.start_date)) for obj in session.new if isinstance(obj, Rental))
+        # Rentals claimed through claim() were counted already
+        claimed = session.info.get(_CLAIMED, Counter())
+        for key in usage:
+            covered = min(usage[key], claimed[key])
+            usage[key] -= covered
+            claimed[key] -= covered
+        usage = +usage
+        if not usage:
+            return
+        table = self.rental_system.UsageCounter.__table__
+        connection = session.connection()
+        for (user_id, period), count in usage.items():
+            result = connection.execute(update(table).where(
+                table.c.user_id == user_id, table.c.period == period
+            ).values(rental_count=table.c.rental_count + count))
+            if result.rowcount == 0:
+                connection.execute(insert(table).values(user_id=user_id, period=period, rental_count=count))
+
+    def claim(self, session, user_id, start_date):
+        """Count one rental starting at start_date against the user's plan, in the caller's transaction.
+
+        Returns False, counting nothing, if the plan's monthly limit is used up.
+        The limit is enforced by the UPDATE's condition, so concurrent rentals in
+        any worker cannot both take the last one. Call it before adding the Rental.
+        """
+        subscription_query, _ = self.load_queries(user_id, start_date)
+        subscription = session.execute(subscription_query).first()
+        limit = PLANS.get(subscription.plan_id if subscription else None, PAY_PER_RENTAL)['monthly_rentals']
+        period = period_of(start_date)
+
+        table = self.rental_system.UsageCounter.__table__
+        bump = update(table).where(
+            table.c.user_id == user_id, table.c.period == period
+        ).values(rental_count=table.c.rental_count + 1)
+        if limit is not None:
+            bump = bump.where(table.c.rental_count < limit)
+        if session.execute(bump).rowcount == 0:
+            counted = session.execute(select(table.c.id).where(
+                table.c.user_id == user_id, table.c.period == period
+            )).first()
+            if counted or limit == 0:
+                return False
+            try:
+                with session.begin_nested():
+                    session.execute(insert(table).values(user_id=user_id, period=period, rental_count=1))
+            except IntegrityError:
+                # Another worker counted this user's first rental of the period first
+                if session.execute(bump).rowcount == 0:
+                    return False
+
+        session.info.setdefault(_CLAIMED, Counter())[(user_id, period)] += 1
+        return True
+
+    def load_queries(self, user_id, now):
+        """Statements for a user's active plan and this period's usage, shared with the async service"""
+        Subscription = self.rental_system.Subscription
+        UsageCounter = self.rental_system.UsageCounter
+        subscription = select(Subscription.plan_id, Subscription.end_date).where(
+            Subscription.user_id == user_id,
+            Subscription.is_active == True,
+            Subscription.start_date <= now,
+            Subscription.end_date > now
+        ).order_by(Subscription.end_date.desc()).limit(1)
+        used = select(UsageCounter.rental_count).where(
+            UsageCounter.user_id == user_id, UsageCounter.period == period_of(now)
+        )
+        return subscription, used
+
+    def remember(self, user_id, subscription, used, now):
+        """Cache and return the entry built from the results of load_queries"""
+        entry = {
+            'plan': subscription.plan_id if subscription else None,
+            'plan_ends': subscription.end_date if subscription else None,
+            'period': period_of(now),
+            'used': used or 0
+        }
+        self.cache.set(user_id, entry)
+        return entry
+
+    def cached(self, user_id, now):
+        """Cached entry for a user, or None if there is none or it is out of date"""
+        entry = self.cache.get(user_id)
+        # Entries are rebuilt when the month rolls over or the subscription they saw has ended
+        if entry is None or entry['period'] != period_of(now) or (entry['plan_ends'] and entry['plan_ends'] <= now):
+            return None
+        return entry
+
+    def _load(self, user_id, now):
+        """Active plan and this period's usage for a user, as cached by check()"""
+        subscription_query, used_query = self.load_queries(user_id, now)
+        session = self.rental_system.Session()
+        subscription = session.execute(subscription_query).first()
+        used = session.execute(used_query).scalar()
+        session.close()
+        return self.remember(user_id, subscription, used, now)
+
+    def status(self, user_id, now=None):
+        """Plan, limits and usage for a user this period"""
+        now = now or datetime.datetime.utcnow()
+        return self.describe(self.cached(user_id, now) or self._load(user_id, now))
+
+    @staticmethod
+    def describe(entry):
+        """Status reported for a cached entry"""
+        limits = PLANS.get(entry['plan'], PAY_PER_RENTAL)
+        monthly = limits['monthly_rentals']
+        return {
+            'plan': entry['plan'] or 'pay_per_rental',
+            'period': entry['period'],
+            'rentals_used': entry['used'],
+            'rentals_remaining': None if monthly is None else max(0, monthly - entry['used']),
+            'max_duration_days': limits['max_duration_days'],
+            'resolution': limits['resolution']
+        }
+
+    def check(self, user_id, duration_days, now=None):
+        """May this user rent now for duration_days? Returns (allowed, reason, status)"""
+        return self.decide(self.status(user_id, now), duration_days)
+
+    @staticmethod
+    def decide(status, duration_days):
+        """(allowed, reason, status) for a rental of duration_days under status"""
+        if duration_days > status['max_duration_days']:
+            return False, f"The {status['plan']} plan allows rentals of up to {status['max_duration_days']} days", status
+        if status['rentals_remaining'] == 0:
+            return False, Entitlements.limit_reason(status), status
+        return True, None, status
+
+    @staticmethod
+    def limit_reason(status):
+        """Error message for a rental refused by the monthly limit"""
+        return f"Monthly rental limit of the {status['plan']} plan reached"
+
+    def rebuild(self, batch_size=5000):
+        """Recompute every usage counter from live and archived rentals; returns the number of counters"""
+        rentals = self.rental_system.Rental.__table__
+        archive = self.rental_system.RentalArchive.__table__
+        table = self.rental_system.UsageCounter.__table__
+
+        # Months are bucketed here rather than in SQL, which has no portable date formatting
+        usage = Counter()
+        history = union_all(select(rentals.c.user_id, rentals.c.start_date),
+                            select(archive.c.user_id, archive.c.start_date))
+        with self.rental_system.engine.connect() as conn:
+            result = conn.execution_options(yield_per=batch_size).execute(history)
+            for rows in result.partitions():
+                usage.update((user_id, period_of(start_date)) for user_id, start_date in rows)
+
+        rows = [{'user_id': user_id, 'period': period, 'rental_count': count}
+                for (user_id, period), count in usage.items()]
+        with self.rental_system.engine.begin() as conn:
+            conn.execute(delete(table))
+            for start in range(0, len(rows), batch_size):
+                conn.execute(insert(table), rows[start:start + batch_size])
+        self.cache.clear()
+        return len(rows)
+
+
+def main(argv=None):
+    """Command line entry point: python entitlements.py rebuild"""
+    parser = argparse.ArgumentParser(description="Maintain ArtLens subscription usage counters")
+    parser.add_argument('command', choices=['rebuild'])
+    parser.add_argument('--database-url', default="sqlite:///./artlens.db")
+    args = parser.parse_args(argv)
+
+    from rental_system import RentalSystem
+    rental_system = RentalSystem(None, database_url=args.database_url)
+    print(json.dumps({'usage_counters': rental_system.entitlements.rebuild()}))
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
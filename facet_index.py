@@ -0,0 +1,222 @@
+import time
+import threading
+import numpy as np
+from sqlalchemy import func
+from session_hooks import on_commit
+
+# Categorical catalog facets indexed in memory
+FACETS = ('style', 'color_palette', 'theme')
+
+# Number of set bits in every possible byte, for NumPy versions without bitwise_count
+_POPCOUNT = np.array([bin(i).count('1') for i in range(256)], dtype=np.uint8)
+
+def _popcount(bits):
+    """Count set bits in a packed bitset"""
+    if hasattr(np, 'bitwise_count'):
+        return int(np.bitwise_count(bits).sum(dtype=np.int64))
+    return int(_POPCOUNT[bits].sum(dtype=np.int64))
+
+class FacetIndex:
+    """In-process bitset index over the catalog's categorical facets.
+
+    Each facet value owns a packed bitset with one bit per art piece id, so
+    AND across facets is a bitwise and, OR within a facet is a bitwise or and
+    counts are a popcount. Filters are given as facet=value or facet=[values].
+
+    Commits made in this process are applied as they happen. Those of other
+    workers are picked up by rebuilding from the table every `refresh_interval`
+    seconds, in one background thread at a time while queries keep using the
+    current bitsets, so other workers' changes show up within that bound.
+    """
+
+    def __init__(self, rental_system, capacity=1024, refresh_interval=30):
+        self.rental_system = rental_system
+        self.refresh_interval = refresh_interval
+        self._lock = threading.RLock()
+        # Held for the duration of a rebuild, so at most one runs per process
+        self._rebuild_lock = threading.Lock()
+        self._built_at = None
+        # Commits applied in this process while a rebuild reads the table
+        self._since_snapshot = None
+        self._reset(capacity)
+
+    def _reset(self, capacity):
+        self._nbytes = max(1, (capacity + 7) // 8)
+        self._all = np.zeros(self._nbytes, dtype=np.uint8)
+        self._bitsets = {facet: {} for facet in FACETS}
+
+    def register(self, session_factory):
+        """Apply committed ArtPiece inserts and deletes to the index"""
+        ArtPiece = self.rental_system.ArtPiece
+        on_commit(
+            session_factory,
+            ArtPiece,
+            lambda art: (art.id, {facet: getattr(art, facet) for facet in FACETS}),
+            self._apply_commit
+        )
+
+    def _apply_commit(self, added, updated, deleted):
+        with self._lock:
+            if self._since_snapshot is not None:
+                self._since_snapshot.append((added, updated, deleted))
+            for art_id, values in deleted:
+                self.remove(art_id)
+            for art_id, values in added + updated:
+                self.remove(art_id)
+                self.add(art_id, values)
+
+    def rebuild(self, batch_size=10000):
+        """Reload the whole index from the database in one streaming pass"""
+        with self._lock:
+            self._since_snapshot = []
+        ArtPiece = self.rental_system.ArtPiece
+        session = self.rental_system.Session()
+        max_id = session.query(func.max(ArtPiece.id)).scalar() or 0
+
+        query = session.query(
+            ArtPiece.id, ArtPiece.style, ArtPiece.color_palette, ArtPiece.theme
+        ).yield_per(batch_size)
+
+        # Loaded into a separate index, so queries keep answering from this one meanwhile
+        fresh = FacetIndex(self.rental_system, capacity=max_id + 1)
+        batch = []
+        for row in query:
+            batch.append(row)
+            if len(batch) >= batch_size:
+                fresh._add_batch(batch)
+                batch = []
+        if batch:
+            fresh._add_batch(batch)
+        session.close()
+
+        with self._lock:
+            self._nbytes, self._all, self._bitsets = fresh._nbytes, fresh._all, fresh._bitsets
+            # Commits made after the table was read would otherwise be lost with the old bitsets
+            for added, updated, deleted in self._since_snapshot or ():
+                for art_id, values in deleted:
+                    self.remove(art_id)
+                for art_id, values in added + updated:
+                    self.remove(art_id)
+                    self.add(art_id, values)
+            self._since_snapshot = None
+            self._built_at = time.monotonic()
+
+    def _refresh_if_stale(self):
+        """Start a background rebuild once the index is older than refresh_interval"""
+        if self._built_at is not None and time.monotonic() - self._built_at > self.refresh_interval \
+                and self._rebuild_lock.acquire(blocking=False):
+            threading.Thread(target=self._refresh, name="facet-index-refresh", daemon=True).start()
+
+    def _refresh(self):
+        try:
+            self.rebuild()
+        except Exception:
+            # Keep serving the current bitsets; the next stale query tries again
+            with self._lock:
+                self._since_snapshot = None
+        finally:
+            self._rebuild_lock.release()
+
+    def _add_batch(self, rows):
+        """Set bits for a batch of (id, style, color_palette, theme) rows with vectorized ops"""
+        ids = np.array([row[0] for row in rows], dtype=np.int64)
+        if ids.max() >> 3 >= self._nbytes:
+            self._grow(int(ids.max() >> 3) + 1)
+        byte_index = ids >> 3
+        masks = np.left_shift(1, ids & 7).astype(np.uint8)
+        np.bitwise_or.at(self._all, byte_index, masks)
+
+        for position, facet in enumerate(FACETS, start=1):
+            values = np.array([row[position] for row in rows], dtype=object)
+            bitsets = self._bitsets[facet]
+            for value in set(values):
+                if value not in bitsets:
+                    bitsets[value] = np.zeros(self._nbytes, dtype=np.uint8)
+                selected = values == value
+                np.bitwise_or.at(bitsets[value], byte_index[selected], masks[selected])
+
+    def add(self, art_id, values):
+        """Index one art piece given its facet values"""
+        byte, mask = art_id >> 3, np.uint8(1 << (art_id & 7))
+        with self._lock:
+            if byte >= self._nbytes:
+                self._grow(byte + 1)
+            self._all[byte] |= mask
+            for facet in FACETS:
+                bitsets = self._bitsets[facet]
+                value = values.get(facet)
+                if value not in bitsets:
+                    bitsets[value] = np.zeros(self._nbytes, dtype=np.uint8)
+                bitsets[value][byte] |= mask
+
+    def remove(self, art_id):
+        """Drop one art piece from every bitset"""
+        byte, mask = art_id >> 3, np.uint8(~(1 << (art_id & 7)) & 0xFF)
+        with self._lock:
+            if byte >= self._nbytes:
+                return
+            self._all[byte] &= mask
+            for bitsets in self._bitsets.values():
+                for bits in bitsets.values():
+                    bits[byte] &= mask
+
+    def _grow(self, min_bytes):
+        """Resize every bitset, doubling capacity to amortize growth"""
+        nbytes = max(min_bytes, self._nbytes * 2)
+
+        def resized(bits):
+            grown = np.zeros(nbytes, dtype=np.uint8)
+            grown[:self._nbytes] = bits
+            return grown
+
+        self._all = resized(self._all)
+        for bitsets in self._bitsets.values():
+            for value in bitsets:
+                bitsets[value] = resized(bitsets[value])
+        self._nbytes = nbytes
+
+    def _match(self, filters):
+        """Bitset of art pieces matching every facet filter (values OR-ed within a facet)"""
+        result = self._all.copy()
+        for facet, values in filters.items():
+            if facet not in self._bitsets:
+                raise ValueError(f"Unknown facet: {facet}")
+            if values is None:
+                continue
+            if isinstance(values, str):
+                values = [values]
+            union = np.zeros(self._nbytes, dtype=np.uint8)
+            for value in values:
+                bits = self._bitsets[facet].get(value)
+                if bits is not None:
+                    union |= bits
+            result &= union
+        return result
+
+    def ids(self, **filters):
+        """Sorted array of art ids matching the filters"""
+        self._refresh_if_stale()
+        with self._lock:
+            bits = self._match(filters)
+        return np.flatnonzero(np.unpackbits(bits, bitorder='little'))
+
+    def count(self, **filters):
+        """Number of art pieces matching the filters"""
+        self._refresh_if_stale()
+        with self._lock:
+            return _popcount(self._match(filters))
+
+    def facet_counts(self, **filters):
+        """Per-value counts for every facet, each computed under the other facets' filters"""
+        self._refresh_if_stale()
+        counts = {}
+        with self._lock:
+            for facet in FACETS:
+                others = {f: v for f, v in filters.items() if f != facet}
+                base = self._match(others)
+                counts[facet] = {
+                    value: _popcount(bits & base)
+                    for value, bits in self._bitsets[facet].items()
+                }
+                counts[facet] = {value: n for value, n in counts[facet].items() if n}
+        return counts
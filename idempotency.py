@@ -0,0 +1,215 @@
+import time
+import logging
+import secrets
+import hashlib
+import datetime
+import threading
+from contextlib import contextmanager
+from functools import wraps
+from flask import request, jsonify, current_app, make_response, g
+from sqlalchemy import delete, update
+from sqlalchemy.exc import IntegrityError
+
+logger = logging.getLogger(__name__)
+
+class IdempotencyStore:
+    """Stored responses keyed by (user, Idempotency-Key), so retried POSTs are answered without re-running.
+
+    The first request claims the key by inserting a row with no response yet.
+    Duplicates arriving while it runs wait for the response to be stored: a
+    threading.Event wakes waiters in this process, other workers poll the row.
+    The claim only holds a short lease, renewed every lease/3 seconds while the
+    request runs; if its request dies without completing, the row expires with
+    the lease and the next retry takes the key over. Each claim carries a
+    random token, so a request that lost its claim cannot complete or abandon
+    the one that replaced it.
+    """
+
+    def __init__(self, rental_system, ttl=86400, lease=30, wait_timeout=30, poll_interval=0.05, purge_every=1000):
+        self.rental_system = rental_system
+        self.ttl = ttl
+        self.lease = lease
+        self.wait_timeout = wait_timeout
+        self.poll_interval = poll_interval
+        self.purge_every = purge_every
+        self._events = {}
+        self._lock = threading.Lock()
+        self._claims = 0
+
+    def claim(self, user_id, key, request_hash):
+        """Return ('new', claim), ('replay', (status, content_type, body)), ('mismatch', None) or ('timeout', None)
+
+        A claim is a (record_id, claim_token) pair to pass to hold(), complete() or abandon().
+        """
+        self._claims += 1
+        if self._claims % self.purge_every == 0:
+            self.purge_expired()
+
+        Record = self.rental_system.IdempotencyRecord
+        deadline = time.monotonic() + self.wait_timeout
+        while True:
+            now = datetime.datetime.utcnow()
+            session = self.rental_system.Session()
+            record = session.query(Record).filter(Record.user_id == user_id, Record.key == key).first()
+
+            if record is not None and record.expires_at <= now:
+                # An expired key, or a claim whose lease ran out, may be reused for a new request
+                session.execute(delete(Record).where(Record.id == record.id, Record.expires_at <= now))
+                session.commit()
+                record = None
+
+            if record is None:
+                token = secrets.token_hex(16)
+                record = Record(key=key, user_id=user_id, request_hash=request_hash, claim_token=token,
+                                expires_at=now + datetime.timedelta(seconds=self.lease))
+                session.add(record)
+                try:
+                    session.commit()
+                except IntegrityError:
+                    # Another request claimed the key first; look again
+                    session.rollback()
+                    session.close()
+                    continue
+                record_id = record.id
+                session.close()
+                with self._lock:
+                    self._events[token] = threading.Event()
+                return 'new', (record_id, token)
+
+            token = record.claim_token
+            lease_left = (record.expires_at - now).total_seconds()
+            result = (record.request_hash, record.status_code, record.content_type, record.response_body)
+            session.close()
+
+            stored_hash, status_code, content_type, body = result
+            if stored_hash != request_hash:
+                return 'mismatch', None
+            if status_code is not None:
+                return 'replay', (status_code, content_type, body)
+
+            # The first request is still running
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return 'timeout', None
+            with self._lock:
+                event = self._events.get(token)
+            if event is not None:
+                event.wait(min(remaining, lease_left))
+            else:
+                time.sleep(min(self.poll_interval, remaining, lease_left))
+
+    def renew(self, claim):
+        """Extend a running claim's lease; False if the claim was lost"""
+        record_id, token = claim
+        Record = self.rental_system.IdempotencyRecord
+        session = self.rental_system.Session()
+        renewed = session.execute(update(Record).where(
+            Record.id == record_id, Record.claim_token == token, Record.status_code.is_(None)
+        ).values(expires_at=datetime.datetime.utcnow() + datetime.timedelta(seconds=self.lease))).rowcount
+        session.commit()
+        session.close()
+        return bool(renewed)
+
+    @contextmanager
+    def hold(self, claim):
+        """Keep renewing the claim's lease while the request runs"""
+        stop = threading.Event()
+        def keep_alive():
+            while not stop.wait(self.lease / 3):
+                if not self.renew(claim):
+                    return
+        thread = threading.Thread(target=keep_alive, daemon=True)
+        thread.start()
+        try:
+            yield
+        finally:
+            stop.set()
+            thread.join()
+
+    def complete(self, claim, status_code, content_type, body):
+        """Store the response for replays and wake any waiting duplicates; False if the claim was lost"""
+        record_id, token = claim
+        Record = self.rental_system.IdempotencyRecord
+        session = self.rental_system.Session()
+        # Stored responses are kept for the full TTL rather than the claim's lease
+        stored = session.execute(update(Record).where(
+            Record.id == record_id, Record.claim_token == token
+        ).values(
+            expires_at=datetime.datetime.utcnow() + datetime.timedelta(seconds=self.ttl),
+            status_code=status_code, content_type=content_type, response_body=body
+        )).rowcount
+        session.commit()
+        session.close()
+        self._release(token)
+        if not stored:
+            logger.warning("Idempotency claim %s lost its lease before completing; the response was not stored", record_id)
+        return bool(stored)
+
+    def abandon(self, claim):
+        """Forget a claim whose request failed, so a retry executes again"""
+        record_id, token = claim
+        Record = self.rental_system.IdempotencyRecord
+        session = self.rental_system.Session()
+        session.execute(delete(Record).where(Record.id == record_id, Record.claim_token == token))
+        session.commit()
+        session.close()
+        self._release(token)
+
+    def _release(self, token):
+        with self._lock:
+            event = self._events.pop(token, None)
+        if event is not None:
+            event.set()
+
+    def purge_expired(self, now=None):
+        """Delete records past their TTL; returns how many were removed"""
+        now = now or datetime.datetime.utcnow()
+        Record = self.rental_system.IdempotencyRecord
+        session = self.rental_system.Session()
+        removed = session.execute(delete(Record).where(Record.expires_at <= now)).rowcount
+        session.commit()
+        session.close()
+        return removed
+
+
+def idempotent(f):
+    """Honour the Idempotency-Key header on a view wrapped by require_api_key"""
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        key = request.headers.get('Idempotency-Key')
+        if not key:
+            return f(*args, **kwargs)
+        if len(key) > 255:
+            return jsonify({"error": "Idempotency-Key is too long"}), 400
+
+        # The same key must always carry the same request
+        request_hash = hashlib.sha256(
+            request.method.encode() + b' ' + request.path.encode() + b'\n' + request.get_data()
+        ).hexdigest()
+
+        store = current_app.config['RENTAL_SYSTEM'].idempotency
+        outcome, value = store.claim(g.api_key['user_id'], key, request_hash)
+        if outcome == 'mismatch':
+            return jsonify({"error": "Idempotency-Key was already used with a different request"}), 422
+        if outcome == 'timeout':
+            return jsonify({"error": "A request with this Idempotency-Key is still in progress"}), 409
+        if outcome == 'replay':
+            status_code, content_type, body = value
+            response = current_app.response_class(body, status=status_code, content_type=content_type)
+            response.headers['Idempotent-Replayed'] = 'true'
+            return response
+
+        try:
+            with store.hold(value):
+                response = make_response(f(*args, **kwargs))
+        except Exception:
+            store.abandon(value)
+            raise
+
+        # Server errors are not stored, so the client's retry gets a fresh attempt
+        if response.status_code >= 500:
+            store.abandon(value)
+        else:
+            store.complete(value, response.status_code, response.content_type, response.get_data(as_text=True))
+        return response
+    return decorated_function
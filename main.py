@@ -1,18 +1,26 @@
 from flask import Flask
-from rental_system import create_app, RentalSystem
+from rental_system import create_app, RentalSystem, DEFAULT_DATABASE_URL
 from api_service import setup_api
 from autonomous_features import setup_autonomous_features
 from security import setup_security
 from payment_processor import setup_payment_processor
+from metrics import setup_metrics
+from traffic import setup_traffic_capture
 
-def create_main_app():
+def create_main_app(database_url=DEFAULT_DATABASE_URL):
     """Create and configure the main application"""
     # Create the Flask application
-    app = create_app()
+    app = create_app(database_url)
     
     # Get the rental system
     rental_system = app.config['RENTAL_SYSTEM']
     
+    # Set up instrumentation first so its hooks time everything else
+    setup_metrics(app, rental_system)
+    
+    # Optionally record sampled requests for load-test replays
+    setup_traffic_capture(app)
+    
     # Set up API
     setup_api(app, rental_system)
     
@@ -25,6 +33,9 @@ def create_main_app():
     # Set up payment processing
     setup_payment_processor(app, rental_system)
     
+    # Refuse to start without the secret that signs price quotes
+    rental_system.quotes.check_secret()
+    
     return app
 
 if __name__ == '__main__':
@@ -0,0 +1,188 @@
+import time
+import bisect
+import threading
+from flask import request, g, current_app
+from sqlalchemy import event
+
+# Upper bounds in seconds; chosen to resolve both cache hits and art renders
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+def _format_labels(names, values):
+    if not names:
+        return ''
+    pairs = []
+    for name, value in zip(names, values):
+        value = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        pairs.append(f'{name}="{value}"')
+    return '{' + ','.join(pairs) + '}'
+
+
+class Counter:
+    """Monotonic count per label set"""
+
+    kind = 'counter'
+
+    def __init__(self, name, help_text, labels=()):
+        self.name = name
+        self.help_text = help_text
+        self.labels = labels
+        self.values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *label_values, amount=1):
+        with self._lock:
+            self.values[label_values] = self.values.get(label_values, 0) + amount
+
+    def samples(self):
+        with self._lock:
+            items = list(self.values.items())
+        for label_values, value in items:
+            yield self.name, _format_labels(self.labels, label_values), value
+
+
+class Gauge(Counter):
+    """Value that can go up and down, e.g. requests in flight"""
+
+    kind = 'gauge'
+
+    def dec(self, *label_values, amount=1):
+        self.inc(*label_values, amount=-amount)
+
+
+class Histogram:
+    """Bucketed distribution per label set, rendered cumulatively as Prometheus expects"""
+
+    kind = 'histogram'
+
+    def __init__(self, name, help_text, labels=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.labels = labels
+        self.buckets = buckets
+        # label values -> [per-bucket counts (last is +Inf), sum, count]
+        self.values = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, *label_values):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            entry = self.values.get(label_values)
+            if entry is None:
+                entry = self.values[label_values] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            entry[0][index] += 1
+            entry[1] += value
+            entry[2] += 1
+
+    def samples(self):
+        with self._lock:
+            items = [(k, (list(v[0]), v[1], v[2])) for k, v in self.values.items()]
+        for label_values, (counts, total, count) in items:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += bucket_count
+                le = '+Inf' if bound == float('inf') else repr(bound)
+                yield (f"{self.name}_bucket",
+                       _format_labels(self.labels + ('le',), label_values + (le,)), cumulative)
+            yield f"{self.name}_sum", _format_labels(self.labels, label_values), total
+            yield f"{self.name}_count", _format_labels(self.labels, label_values), count
+
+
+class Metrics:
+    """Request, database and render instrumentation exported in Prometheus text format"""
+
+    def __init__(self):
+        self.request_latency = Histogram('artlens_http_request_duration_seconds',
+                                         'Request latency by route', ('method', 'route'))
+        self.requests = Counter('artlens_http_requests_total',
+                                'Requests by route and status code', ('method', 'route', 'status'))
+        self.in_flight = Gauge('artlens_http_requests_in_flight', 'Requests currently being served')
+        self.db_queries = Counter('artlens_db_queries_total', 'SQL statements executed', ('operation',))
+        self.db_latency = Histogram('artlens_db_query_duration_seconds', 'SQL statement latency', ('operation',))
+        self.render_latency = Histogram('artlens_art_render_duration_seconds', 'Art render time by style', ('style',))
+        self.collectors = [self.request_latency, self.requests, self.in_flight,
+                           self.db_queries, self.db_latency, self.render_latency]
+
+    def instrument_app(self, app):
+        """Time every request through before/after hooks"""
+        @app.before_request
+        def start_timer():
+            g.metrics_start = time.perf_counter()
+            g.metrics_in_flight = True
+            self.in_flight.inc()
+
+        @app.after_request
+        def record_request(response):
+            start = g.pop('metrics_start', None)
+            if start is not None:
+                # Route templates (/api/art/<int:art_id>) keep label cardinality bounded
+                route = request.url_rule.rule if request.url_rule else 'unmatched'
+                self.request_latency.observe(time.perf_counter() - start, request.method, route)
+                self.requests.inc(request.method, route, str(response.status_code))
+            return response
+
+        @app.teardown_request
+        def finish_request(exc):
+            # Only requests that reached start_timer were counted in flight
+            if g.pop('metrics_in_flight', False):
+                self.in_flight.dec()
+
+    def instrument_engine(self, engine):
+        """Count and time SQL statements through engine events"""
+        @event.listens_for(engine, 'before_cursor_execute')
+        def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+            context._metrics_start = time.perf_counter()
+
+        @event.listens_for(engine, 'after_cursor_execute')
+        def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+            operation = statement.lstrip()[:6].upper()
+            self.db_queries.inc(operation)
+            self.db_latency.observe(time.perf_counter() - context._metrics_start, operation)
+
+    def observe_render(self, style, seconds):
+        self.render_latency.observe(seconds, style)
+
+    def render(self, extra=()):
+        """Prometheus text exposition of every collector plus (name, help, value) gauges in `extra`"""
+        lines = []
+        for collector in self.collectors:
+            lines.append(f"# HELP {collector.name} {collector.help_text}")
+            lines.append(f"# TYPE {collector.name} {collector.kind}")
+            for name, labels, value in collector.samples():
+                lines.append(f"{name}{labels} {value}")
+        for name, help_text, value in extra:
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} gauge")
+            lines.append(f"{name} {value}")
+        return '\n'.join(lines) + '\n'
+
+
+def _cache_gauges(app, rental_system):
+    """Hit counters of the in-process caches"""
+    gauges = []
+    caches = [('response_cache', app.config.get('RESPONSE_CACHE')),
+              ('api_key_cache', getattr(rental_system, 'api_keys', None) and rental_system.api_keys.cache),
+              ('price_quote_cache', getattr(rental_system, 'quotes', None) and rental_system.quotes.cache),
+              ('entitlement_cache', getattr(rental_system, 'entitlements', None) and rental_system.entitlements.cache)]
+    for name, cache in caches:
+        if cache is None:
+            continue
+        stats = cache.stats()
+        gauges.append((f"artlens_{name}_hits", f"Hits in the {name.replace('_', ' ')}", stats['hits']))
+        gauges.append((f"artlens_{name}_misses", f"Misses in the {name.replace('_', ' ')}", stats['misses']))
+        gauges.append((f"artlens_{name}_size", f"Entries in the {name.replace('_', ' ')}", stats['size']))
+    return gauges
+
+def setup_metrics(app, rental_system):
+    """Instrument the app and its database engine, and serve /api/metrics"""
+    metrics = Metrics()
+    metrics.instrument_app(app)
+    metrics.instrument_engine(rental_system.engine)
+    rental_system.metrics = metrics
+    app.config['METRICS'] = metrics
+
+    @app.route('/api/metrics', methods=['GET'])
+    def get_metrics():
+        body = metrics.render(_cache_gauges(current_app, rental_system))
+        return current_app.response_class(body, content_type='text/plain; version=0.0.4; charset=utf-8')
+
+    return metrics
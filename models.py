@@ -1,6 +1,6 @@
-from sqlalchemy import Column, Integer, String, Float, Boolean, DateTime, ForeignKey, Text
+from sqlalchemy import Column, Integer, String, Float, Boolean, DateTime, ForeignKey, Text, Index
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import relationship
+from sqlalchemy.orm import relationship, column_property
 import datetime
 
 Base = declarative_base()
@@ -11,7 +11,8 @@ class User(Base):
     id = Column(Integer, primary_key=True)
     username = Column(String(50), unique=True, nullable=False)
     email = Column(String(100), unique=True, nullable=False)
-    password_hash = Column(String(100), nullable=False)
+    # scrypt$n$r$p$salt$hash, see passwords.py
+    password_hash = Column(String(255), nullable=False)
     created_at = Column(DateTime, default=datetime.datetime.utcnow)
     
     # Relationships
@@ -30,8 +31,21 @@ class ArtPiece(Base):
     theme = Column(String(50), nullable=False)
     created_at = Column(DateTime, default=datetime.datetime.utcnow)
     
+    # Popularity counters, maintained alongside Rental writes (see popularity.py)
+    rental_count = Column(Integer, default=0, nullable=False)
+    active_rental_count = Column(Integer, default=0, nullable=False)
+    last_rented_at = Column(DateTime, nullable=True)
+    
     # Relationships
     rentals = relationship("Rental", back_populates="art_piece")
+    
+    # Keyset pagination walks (created_at, id); the facet variants serve filtered listings
+    __table_args__ = (
+        Index('ix_art_pieces_created_at_id', 'created_at', 'id'),
+        Index('ix_art_pieces_style_created_at_id', 'style', 'created_at', 'id'),
+        Index('ix_art_pieces_color_palette_created_at_id', 'color_palette', 'created_at', 'id'),
+        Index('ix_art_pieces_theme_created_at_id', 'theme', 'created_at', 'id'),
+    )
 
 class Rental(Base):
     __tablename__ = 'rentals'
@@ -42,12 +56,20 @@ class Rental(Base):
     start_date = Column(DateTime, nullable=False)
     end_date = Column(DateTime, nullable=False)
     price = Column(Float, nullable=False)
-    is_active = Column(Boolean, default=True)
+    # Load the previous value on change so popularity counters see activations and expiries
+    is_active = column_property(Column(Boolean, default=True), active_history=True)
     created_at = Column(DateTime, default=datetime.datetime.utcnow)
+    # Stripe checkout session that paid for the rental, if any
+    payment_reference = Column(String(255), nullable=True, index=True)
     
     # Relationships
     user = relationship("User", back_populates="rentals")
     art_piece = relationship("ArtPiece", back_populates="rentals")
+    
+    # Archival scans rentals by end date
+    __table_args__ = (
+        Index('ix_rentals_end_date', 'end_date'),
+    )
 
 class UserPreference(Base):
     __tablename__ = 'user_preferences'
@@ -73,6 +95,153 @@ class Subscription(Base):
     is_active = Column(Boolean, default=True)
     price = Column(Float, nullable=False)
     created_at = Column(DateTime, default=datetime.datetime.utcnow)
+    # Stripe checkout session that started the subscription, if any
+    payment_reference = Column(String(255), nullable=True, index=True)
     
     # Relationships
     user = relationship("User", back_populates="subscriptions")
+
+class RentalArchive(Base):
+    __tablename__ = 'rentals_archive'
+    
+    # Same id as the live rental it was moved from
+    id = Column(Integer, primary_key=True, autoincrement=False)
+    user_id = Column(Integer, ForeignKey('users.id'), nullable=False, index=True)
+    art_piece_id = Column(Integer, ForeignKey('art_pieces.id'), nullable=False, index=True)
+    start_date = Column(DateTime, nullable=False)
+    end_date = Column(DateTime, nullable=False)
+    price = Column(Float, nullable=False)
+    is_active = Column(Boolean, default=False)
+    created_at = Column(DateTime)
+    payment_reference = Column(String(255), nullable=True)
+    archived_at = Column(DateTime, default=datetime.datetime.utcnow)
+
+class UserRentalRollup(Base):
+    __tablename__ = 'user_rental_rollups'
+    
+    # Totals over archived rentals only; live rentals are aggregated on demand
+    user_id = Column(Integer, ForeignKey('users.id'), primary_key=True)
+    rental_count = Column(Integer, default=0, nullable=False)
+    total_spent = Column(Float, default=0.0, nullable=False)
+    first_rented_at = Column(DateTime, nullable=True)
+    last_rented_at = Column(DateTime, nullable=True)
+
+class ArtRentalRollup(Base):
+    __tablename__ = 'art_rental_rollups'
+    
+    # Totals over archived rentals only; live rentals are aggregated on demand
+    art_piece_id = Column(Integer, ForeignKey('art_pieces.id'), primary_key=True)
+    rental_count = Column(Integer, default=0, nullable=False)
+    total_revenue = Column(Float, default=0.0, nullable=False)
+    first_rented_at = Column(DateTime, nullable=True)
+    last_rented_at = Column(DateTime, nullable=True)
+
+class ApiKey(Base):
+    __tablename__ = 'api_keys'
+    
+    id = Column(Integer, primary_key=True)
+    user_id = Column(Integer, ForeignKey('users.id'), nullable=False, index=True)
+    # Leading characters of the key, kept in clear so lookups hit one index entry
+    prefix = Column(String(16), nullable=False, index=True)
+    salt = Column(String(32), nullable=False)
+    key_hash = Column(String(64), nullable=False)
+    tier = Column(String(20), nullable=False, default='free')
+    created_at = Column(DateTime, default=datetime.datetime.utcnow)
+    revoked_at = Column(DateTime, nullable=True)
+
+class CacheGeneration(Base):
+    __tablename__ = 'cache_generations'
+    
+    # Bumped by writes that must invalidate every worker's in-process cache, e.g. API key revocation
+    name = Column(String(50), primary_key=True)
+    generation = Column(Integer, nullable=False, default=0)
+
+class IdempotencyRecord(Base):
+    __tablename__ = 'idempotency_records'
+    
+    id = Column(Integer, primary_key=True)
+    key = Column(String(255), nullable=False)
+    user_id = Column(Integer, nullable=False)
+    request_hash = Column(String(64), nullable=False)
+    # Random token of the request holding the claim, so a claim taken over after its lease ran out is told apart
+    claim_token = Column(String(32), nullable=True)
+    # Null while the first request is still executing
+    status_code = Column(Integer, nullable=True)
+    content_type = Column(String(100), nullable=True)
+    response_body = Column(Text, nullable=True)
+    created_at = Column(DateTime, default=datetime.datetime.utcnow)
+    expires_at = Column(DateTime, nullable=False, index=True)
+    
+    __table_args__ = (
+        Index('ix_idempotency_records_user_id_key', 'user_id', 'key', unique=True),
+    )
+
+class RevokedToken(Base):
+    __tablename__ = 'revoked_tokens'
+    
+    id = Column(Integer, primary_key=True)
+    # JWT id of a single revoked token, or 'user:<id>' to revoke every token of a user issued before revoked_at
+    jti = Column(String(64), nullable=False, unique=True, index=True)
+    user_id = Column(Integer, nullable=False, index=True)
+    revoked_at = Column(DateTime, nullable=False, default=datetime.datetime.utcnow)
+    # Once the revoked tokens would have expired anyway the row can be dropped
+    expires_at = Column(DateTime, nullable=False, index=True)
+
+class WebhookEvent(Base):
+    __tablename__ = 'webhook_events'
+    
+    id = Column(Integer, primary_key=True)
+    # Stripe's event id; redeliveries of the same event are rejected by the unique index
+    event_id = Column(String(255), nullable=False, unique=True)
+    event_type = Column(String(100), nullable=False)
+    payload = Column(Text, nullable=False)
+    # pending -> done, or dead once retries are exhausted
+    status = Column(String(20), nullable=False, default='pending')
+    attempts = Column(Integer, nullable=False, default=0)
+    # Next time a worker may pick the event up; also pushed forward while a worker holds it
+    available_at = Column(DateTime, nullable=False, default=datetime.datetime.utcnow)
+    last_error = Column(Text, nullable=True)
+    received_at = Column(DateTime, default=datetime.datetime.utcnow)
+    processed_at = Column(DateTime, nullable=True)
+    
+    __table_args__ = (
+        Index('ix_webhook_events_status_available_at', 'status', 'available_at'),
+    )
+
+class WebhookDeadLetter(Base):
+    __tablename__ = 'webhook_dead_letters'
+    
+    id = Column(Integer, primary_key=True)
+    event_id = Column(String(255), nullable=False, index=True)
+    event_type = Column(String(100), nullable=False)
+    payload = Column(Text, nullable=False)
+    attempts = Column(Integer, nullable=False)
+    last_error = Column(Text, nullable=True)
+    failed_at = Column(DateTime, default=datetime.datetime.utcnow)
+
+class PaymentConflict(Base):
+    __tablename__ = 'payment_conflicts'
+    
+    id = Column(Integer, primary_key=True)
+    # Stripe checkout session that was paid for but could not be turned into a rental
+    payment_reference = Column(String(255), nullable=False, unique=True)
+    user_id = Column(Integer, ForeignKey('users.id'), nullable=False)
+    art_piece_id = Column(Integer, ForeignKey('art_pieces.id'), nullable=False)
+    amount = Column(Float, nullable=False)
+    reason = Column(String(255), nullable=False)
+    created_at = Column(DateTime, default=datetime.datetime.utcnow)
+    # Set once the payment was refunded or the rental granted by hand
+    resolved_at = Column(DateTime, nullable=True)
+
+class UsageCounter(Base):
+    __tablename__ = 'usage_counters'
+    
+    id = Column(Integer, primary_key=True)
+    user_id = Column(Integer, ForeignKey('users.id'), nullable=False)
+    # Calendar month (UTC) as YYYY-MM
+    period = Column(String(7), nullable=False)
+    rental_count = Column(Integer, nullable=False, default=0)
+    
+    __table_args__ = (
+        Index('ix_usage_counters_user_id_period', 'user_id', 'period', unique=True),
+    )
@@ -0,0 +1,132 @@
+import os
+import sys
+import hmac
+import time
+import base64
+import hashlib
+import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+SCHEME = 'scrypt'
+
+class PasswordHasherBusy(Exception):
+    """Raised when too many hashes are already queued; callers should answer 503"""
+
+
+def _b64encode(raw):
+    return base64.b64encode(raw).decode('ascii')
+
+def _b64decode(text):
+    return base64.b64decode(text.encode('ascii'))
+
+
+class PasswordHasher:
+    """scrypt password hashing on a dedicated bounded thread pool.
+
+    Hashes are stored as scrypt$n$r$p$salt$hash, so the cost can be raised
+    later: verify() reports hashes made with other parameters (or legacy
+    plaintext values) as needing a rehash. hashlib.scrypt releases the GIL,
+    so `workers` caps the cores spent on logins while API threads keep running,
+    and at most `max_pending` hashes may wait for a worker.
+    """
+
+    def __init__(self, n=2 ** 14, r=8, p=1, dklen=32, workers=None, max_pending=64):
+        self.n = n
+        self.r = r
+        self.p = p
+        self.dklen = dklen
+        self.workers = workers or max(1, (os.cpu_count() or 2) // 2)
+        self.executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='password-hash')
+        self._slots = threading.BoundedSemaphore(self.workers + max_pending)
+
+    def _derive(self, password, salt, n, r, p, dklen):
+        return hashlib.scrypt(password.encode('utf-8'), salt=salt, n=n, r=r, p=p,
+                              dklen=dklen, maxmem=256 * r * n + 1024 * 1024)
+
+    def _run(self, fn, *args):
+        """Run fn on the hashing pool and wait for it, refusing work beyond the queue bound"""
+        if not self._slots.acquire(blocking=False):
+            raise PasswordHasherBusy("Password hashing queue is full")
+        try:
+            return self.executor.submit(fn, *args).result()
+        finally:
+            self._slots.release()
+
+    def _hash_now(self, password):
+        salt = os.urandom(16)
+        derived = self._derive(password, salt, self.n, self.r, self.p, self.dklen)
+        return f"{SCHEME}${self.n}${self.r}${self.p}${_b64encode(salt)}${_b64encode(derived)}"
+
+    def _verify_now(self, password, stored):
+        try:
+            scheme, n, r, p, salt, expected = stored.split('$')
+            n, r, p = int(n), int(r), int(p)
+            salt, expected = _b64decode(salt), _b64decode(expected)
+        except ValueError:
+            return False, False
+        if scheme != SCHEME:
+            return False, False
+        derived = self._derive(password, salt, n, r, p, len(expected))
+        ok = hmac.compare_digest(derived, expected)
+        return ok, ok and (n, r, p, len(expected)) != (self.n, self.r, self.p, self.dklen)
+
+    def hash(self, password):
+        """Return an encoded hash of password"""
+        return self._run(self._hash_now, password)
+
+    def verify(self, password, stored):
+        """Return (matches, needs_rehash) for a stored hash"""
+        if not stored.startswith(SCHEME + '$'):
+            # Accounts created before hashing hold the plaintext; upgrade them on their next login
+            ok = hmac.compare_digest(stored.encode('utf-8'), password.encode('utf-8'))
+            return ok, ok
+        return self._run(self._verify_now, password, stored)
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False)
+
+
+def benchmark(hasher, seconds=3.0, threads=None):
+    """Verifications per second through the pool with `threads` concurrent callers"""
+    stored = hasher._hash_now('correct horse battery staple 1')
+    threads = threads or hasher.workers
+    deadline = time.perf_counter() + seconds
+    counts = [0] * threads
+
+    def caller(index):
+        while time.perf_counter() < deadline:
+            hasher.verify('correct horse battery staple 1', stored)
+            counts[index] += 1
+
+    started = time.perf_counter()
+    callers = [threading.Thread(target=caller, args=(i,)) for i in range(threads)]
+    for thread in callers:
+        thread.start()
+    for thread in callers:
+        thread.join()
+    elapsed = time.perf_counter() - started
+    return sum(counts) / elapsed
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark scrypt login throughput")
+    parser.add_argument('--n', type=int, default=2 ** 14, help="scrypt CPU/memory cost (power of two)")
+    parser.add_argument('--r', type=int, default=8)
+    parser.add_argument('--p', type=int, default=1)
+    parser.add_argument('--seconds', type=float, default=3.0)
+    args = parser.parse_args(argv)
+
+    single = PasswordHasher(args.n, args.r, args.p, workers=1)
+    per_core = benchmark(single, args.seconds)
+    single.shutdown()
+
+    pooled = PasswordHasher(args.n, args.r, args.p)
+    total = benchmark(pooled, args.seconds)
+    pooled.shutdown()
+
+    print(f"scrypt n={args.n} r={args.r} p={args.p}: {1000 / per_core:.1f} ms per hash")
+    print(f"{per_core:.1f} logins/s per core, {total:.1f} logins/s with {pooled.workers} hashing workers")
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -2,6 +2,10 @@ import stripe
 from flask import request, jsonify, redirect, url_for
 import os
 import json
+import datetime
+from response_cache import cached_response
+from webhook_queue import WebhookQueue
+from price_quotes import InvalidQuote, parse_duration_days
 
 class PaymentProcessor:
     def __init__(self, app, rental_system):
@@ -17,6 +21,16 @@ class PaymentProcessor:
         # In production, this would be stored securely and loaded from environment variables
         self.webhook_secret = "whsec_saMPLEsaMPLEsaMPLEsaMPLEsaMPLEsaMPLE"
         
+        # Verified webhooks are queued and applied by background workers
+        self.webhook_queue = WebhookQueue(
+            rental_system,
+            handlers={'checkout.session.completed': self._handle_checkout_completed},
+            workers=app.config.get('WEBHOOK_WORKERS', 2)
+        )
+        app.config['WEBHOOK_QUEUE'] = self.webhook_queue
+        if not app.config.get('TESTING'):
+            self.webhook_queue.start()
+        
         # Set up routes
         self.setup_routes()
     
@@ -28,10 +42,13 @@ class PaymentProcessor:
             data = request.json
             art_id = data.get('art_id')
             user_id = data.get('user_id')
-            duration_days = data.get('duration_days', 1)
             
             if not art_id or not user_id:
                 return jsonify({"error": "Missing required parameters"}), 400
+            try:
+                duration_days = parse_duration_days(data.get('duration_days', 1))
+            except ValueError as e:
+                return jsonify({"error": str(e)}), 400
             
             # Get art details from database
             session = self.rental_system.Session()
@@ -43,9 +60,25 @@ class PaymentProcessor:
                 session.close()
                 return jsonify({"error": "Art piece not found"}), 404
             
-            # Calculate price (simplified for now)
-            base_price = 5.0  # Base price per day in USD
-            price = base_price * duration_days
+            # Refuse before taking payment rather than charging for a rental the webhook cannot create
+            start_date = datetime.datetime.utcnow()
+            end_date = start_date + datetime.timedelta(days=duration_days)
+            if self.rental_system.availability.is_rented(art.id, int(user_id), start_date, end_date):
+                session.close()
+                return jsonify({"error": "Art piece already rented for this period"}), 409
+            
+            # Honour the quote the customer was shown, or quote the rental now
+            quotes = self.rental_system.quotes
+            try:
+                if data.get('quote'):
+                    quote = data['quote']
+                    price = quotes.verify(quote, art_id, duration_days)
+                else:
+                    issued = quotes.quote(art.id, duration_days)
+                    quote, price = issued['quote'], issued['price']
+            except InvalidQuote as e:
+                session.close()
+                return jsonify({"error": str(e)}), 400
             
             # Create a Stripe Checkout Session
             try:
@@ -60,7 +93,7 @@ class PaymentProcessor:
                                     'description': f"{duration_days} day rental of {art.style} art in {art.color_palette} colors with {art.theme} theme",
                                     'images': [f"https://example.com/api/art/{art_id}/preview"],  # This would be a real URL in production
                                 },
-                                'unit_amount': int(price * 100),  # Stripe uses cents
+                                'unit_amount': int(round(price * 100)),  # Stripe uses cents
                             },
                             'quantity': 1,
                         }
@@ -71,7 +104,9 @@ class PaymentProcessor:
                     metadata={
                         'art_id': art_id,
                         'user_id': user_id,
-                        'duration_days': duration_days
+                        'duration_days': duration_days,
+                        # The webhook charges the rental at this quote even if it expires during payment
+                        'quote': quote
                     }
                 )
                 session.close()
@@ -97,21 +132,14 @@ class PaymentProcessor:
                 # Invalid signature
                 return jsonify({"error": "Invalid signature"}), 400
             
-            # Handle the checkout.session.completed event
-            if event['type'] == 'checkout.session.completed':
-                session = event['data']['object']
-                
-                # Retrieve metadata
-                art_id = session['metadata']['art_id']
-                user_id = session['metadata']['user_id']
-                duration_days = int(session['metadata']['duration_days'])
-                
-                # Create the rental in the database
-                self._create_rental(art_id, user_id, duration_days)
+            # Acknowledge once the event is stored; Stripe redelivers anything not answered with a 2xx
+            if not self.webhook_queue.enqueue(event['id'], event['type'], payload):
+                return jsonify({"status": "duplicate"})
             
             return jsonify({"status": "success"})
         
         @self.app.route('/api/payment/subscription-plans', methods=['GET'])
+        @cached_response(scope=lambda: 'public', ttl=3600)
         def get_subscription_plans():
             """Return available subscription plans"""
             plans = [
@@ -188,7 +216,7 @@ class PaymentProcessor:
                                     'name': f"ArtLens.io {plan['name']} Subscription",
                                     'description': f"Monthly subscription to ArtLens.io {plan['name']} plan",
                                 },
-                                'unit_amount': int(plan['price'] * 100),  # Stripe uses cents
+                                'unit_amount': int(round(plan['price'] * 100)),  # Stripe uses cents
                                 'recurring': {
                                     'interval': 'month',
                                 }
@@ -209,17 +237,54 @@ class PaymentProcessor:
             except Exception as e:
                 return jsonify({"error": str(e)}), 500
     
-    def _create_rental(self, art_id, user_id, duration_days):
-        """Create a rental after successful payment"""
-        session = self.rental_system.Session()
+    def _handle_checkout_completed(self, session, event):
+        """Queue handler for checkout.session.completed events"""
+        checkout = event['data']['object']
+        if checkout.get('mode') == 'subscription':
+            self._create_subscription(session, checkout)
+            return
+        
+        # Retrieve metadata
+        art_id = checkout['metadata']['art_id']
+        user_id = checkout['metadata']['user_id']
+        duration_days = int(checkout['metadata']['duration_days'])
+        
+        # Record the price the customer accepted at checkout
+        quote = checkout['metadata'].get('quote')
+        if quote:
+            price = self.rental_system.quotes.verify(quote, art_id, duration_days, allow_expired=True)
+        else:
+            price = self.rental_system.quotes.price_for(int(art_id), duration_days)
+        
+        # Create the rental in the database
+        self._create_rental(session, art_id, user_id, duration_days, price, checkout['id'])
+    
+    def _create_rental(self, session, art_id, user_id, duration_days, price, payment_reference=None):
+        """Add the rental for a successful payment to session; the caller commits"""
+        # A checkout session pays for one rental (or one recorded conflict), however many events report it
+        if payment_reference and (session.query(self.rental_system.Rental.id).filter(
+            self.rental_system.Rental.payment_reference == payment_reference
+        ).first() or session.query(self.rental_system.PaymentConflict.id).filter(
+            self.rental_system.PaymentConflict.payment_reference == payment_reference
+        ).first()):
+            return False
         
         # Calculate rental period
         start_date = datetime.datetime.utcnow()
         end_date = start_date + datetime.timedelta(days=duration_days)
         
-        # Calculate price (simplified for now)
-        base_price = 5.0  # Base price per day
-        price = base_price * duration_days
+        # Rentals overlapping one this user already holds are not created. The payment was
+        # already captured, so it is recorded for a refund instead of being dropped
+        if not self.rental_system.availability.reserve(session, int(art_id), int(user_id), start_date, end_date):
+            if payment_reference:
+                session.add(self.rental_system.PaymentConflict(
+                    payment_reference=payment_reference,
+                    user_id=int(user_id),
+                    art_piece_id=int(art_id),
+                    amount=price,
+                    reason="Art piece already rented for this period"
+                ))
+            return False
         
         # Create rental
         new_rental = self.rental_system.Rental(
@@ -228,13 +293,30 @@ class PaymentProcessor:
             start_date=start_date,
             end_date=end_date,
             price=price,
-            is_active=True
+            is_active=True,
+            payment_reference=payment_reference
         )
         
         session.add(new_rental)
-        session.commit()
-        session.close()
+        return True
+
+    def _create_subscription(self, session, checkout):
+        """Add the subscription a completed subscription checkout paid for; the caller commits"""
+        Subscription = self.rental_system.Subscription
+        if session.query(Subscription.id).filter(Subscription.payment_reference == checkout['id']).first():
+            return False
         
+        # Monthly plans; Stripe bills renewals separately
+        start_date = datetime.datetime.utcnow()
+        session.add(Subscription(
+            user_id=int(checkout['metadata']['user_id']),
+            plan_id=checkout['metadata']['plan_id'],
+            start_date=start_date,
+            end_date=start_date + datetime.timedelta(days=30),
+            price=(checkout.get('amount_total') or 0) / 100,
+            is_active=True,
+            payment_reference=checkout['id']
+        ))
         return True
 
 # Function to initialize payment processor
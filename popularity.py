@@ -0,0 +1,144 @@
+import sys
+import json
+import argparse
+import datetime
+from sqlalchemy import event, inspect, func, select, update, case
+
+def _non_negative(expr):
+    """Clamp a counter expression at zero"""
+    return case((expr < 0, 0), else_=expr)
+
+class PopularityCounters:
+    """Keep ArtPiece rental counters in step with Rental writes"""
+
+    def __init__(self, rental_system):
+        self.rental_system = rental_system
+
+    def register(self, session_factory):
+        """Hook the counters into every session created by `session_factory`"""
+        event.listen(session_factory, 'after_flush', self._after_flush)
+
+    def _after_flush(self, session, flush_context):
+        """Apply counter deltas for flushed rentals inside the same transaction"""
+        Rental = self.rental_system.Rental
+        deltas = {}
+
+        def delta(art_id):
+            if art_id not in deltas:
+                deltas[art_id] = {'rental_count': 0, 'active_rental_count': 0, 'last_rented_at': None}
+            return deltas[art_id]
+
+        for obj in session.new:
+            if isinstance(obj, Rental):
+                d = delta(obj.art_piece_id)
+                d['rental_count'] += 1
+                if obj.is_active is not False:
+                    d['active_rental_count'] += 1
+                if d['last_rented_at'] is None or obj.start_date > d['last_rented_at']:
+                    d['last_rented_at'] = obj.start_date
+
+        for obj in session.dirty:
+            if isinstance(obj, Rental):
+                history = inspect(obj).attrs.is_active.history
+                if history.deleted and history.added and bool(history.deleted[0]) != bool(history.added[0]):
+                    delta(obj.art_piece_id)['active_rental_count'] += 1 if history.added[0] else -1
+
+        for obj in session.deleted:
+            if isinstance(obj, Rental):
+                d = delta(obj.art_piece_id)
+                d['rental_count'] -= 1
+                if obj.is_active:
+                    d['active_rental_count'] -= 1
+
+        if deltas:
+            connection = session.connection()
+            for art_id, d in deltas.items():
+                self._apply_delta(connection, art_id, d)
+
+    def _apply_delta(self, connection, art_id, d):
+        """Increment counters in place so concurrent writers don't lose updates"""
+        table = self.rental_system.ArtPiece.__table__
+        values = {}
+        if d['rental_count']:
+            values['rental_count'] = table.c.rental_count + d['rental_count']
+        if d['active_rental_count']:
+            values['active_rental_count'] = _non_negative(table.c.active_rental_count + d['active_rental_count'])
+        if d['last_rented_at'] is not None:
+            values['last_rented_at'] = case(
+                (table.c.last_rented_at == None, d['last_rented_at']),
+                (table.c.last_rented_at < d['last_rented_at'], d['last_rented_at']),
+                else_=table.c.last_rented_at
+            )
+        if values:
+            connection.execute(update(table).where(table.c.id == art_id).values(**values))
+
+    def expire_rentals(self, now=None):
+        """Deactivate rentals past their end date and decrement active counters in one transaction"""
+        now = now or datetime.datetime.utcnow()
+        Rental = self.rental_system.Rental
+        art_table = self.rental_system.ArtPiece.__table__
+        session = self.rental_system.Session()
+
+        expiring = (Rental.is_active == True, Rental.end_date <= now)
+        per_art = session.query(Rental.art_piece_id, func.count(Rental.id)).filter(
+            *expiring
+        ).group_by(Rental.art_piece_id).all()
+
+        # Bulk update bypasses the flush hooks, so counters are adjusted explicitly here
+        session.query(Rental).filter(*expiring).update({Rental.is_active: False}, synchronize_session=False)
+        for art_id, count in per_art:
+            session.execute(update(art_table).where(art_table.c.id == art_id).values(
+                active_rental_count=_non_negative(art_table.c.active_rental_count - count)
+            ))
+
+        session.commit()
+        session.close()
+        return sum(count for _, count in per_art)
+
+    def rebuild(self):
+        """Recompute every art piece's counters from live rentals plus archived rollups in one statement"""
+        rentals = self.rental_system.Rental.__table__
+        rollups = self.rental_system.ArtRentalRollup.__table__
+        art_table = self.rental_system.ArtPiece.__table__
+
+        def correlated(expr, *conditions):
+            return select(expr).where(rentals.c.art_piece_id == art_table.c.id, *conditions).scalar_subquery()
+
+        def archived(column):
+            return select(column).where(rollups.c.art_piece_id == art_table.c.id).scalar_subquery()
+
+        live_last = correlated(func.max(rentals.c.start_date))
+        archived_last = archived(rollups.c.last_rented_at)
+
+        with self.rental_system.engine.begin() as conn:
+            result = conn.execute(update(art_table).values(
+                rental_count=correlated(func.count(rentals.c.id)) + func.coalesce(archived(rollups.c.rental_count), 0),
+                active_rental_count=correlated(func.count(rentals.c.id), rentals.c.is_active == True),
+                # The later of the two: a long live rental can have started before an archived one
+                last_rented_at=case(
+                    (live_last.is_(None), archived_last),
+                    (archived_last.is_(None), live_last),
+                    (archived_last > live_last, archived_last),
+                    else_=live_last
+                )
+            ))
+        return result.rowcount
+
+def main(argv=None):
+    """Command line entry point: python popularity.py expire|rebuild"""
+    parser = argparse.ArgumentParser(description="Maintain ArtLens popularity counters")
+    parser.add_argument('command', choices=['expire', 'rebuild'])
+    parser.add_argument('--database-url', default="sqlite:///./artlens.db")
+    args = parser.parse_args(argv)
+
+    from rental_system import RentalSystem
+    rental_system = RentalSystem(None, database_url=args.database_url)
+
+    if args.command == 'expire':
+        print(json.dumps({'expired': rental_system.expire_rentals()}))
+    else:
+        print(json.dumps({'art_pieces': rental_system.rebuild_popularity_counters()}))
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
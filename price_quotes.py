@@ -0,0 +1,216 @@
+import os
+import hmac
+import json
+import time
+import base64
+import secrets
+import hashlib
+import datetime
+from ttl_cache import TTLCache
+
+# List price per rental day in USD, before dynamic pricing adjusts it
+BASE_PRICE = 5.0
+
+# Signing key for apps in TESTING mode without a configured secret; never valid across processes
+_TESTING_SECRET = secrets.token_bytes(32)
+
+class InvalidQuote(Exception):
+    """Raised for quotes that are forged, expired or issued for a different rental"""
+
+
+def parse_duration_days(value):
+    """Rental duration from a request body as a positive int; raises ValueError otherwise"""
+    # JSON clients may send 3, 3.0 or "3"; anything else is not a whole number of days
+    if isinstance(value, bool) or (isinstance(value, float) and not value.is_integer()):
+        raise ValueError("duration_days must be a whole number of days")
+    try:
+        duration_days = int(value)
+    except (TypeError, ValueError):
+        raise ValueError("duration_days must be a whole number of days")
+    if duration_days < 1:
+        raise ValueError("duration_days must be at least 1")
+    return duration_days
+
+
+def _b64encode(raw):
+    return base64.urlsafe_b64encode(raw).rstrip(b'=').decode('ascii')
+
+def _b64decode(text):
+    return base64.urlsafe_b64decode(text + '=' * (-len(text) % 4))
+
+
+class PriceQuotes:
+    """Signed, short-lived rental prices shared by the pricing page, checkout and rent paths.
+
+    A quote is computed once with DynamicPricing and reused for every request
+    asking about the same (art, duration, demand bucket), where the bucket holds
+    the inputs that move the price: evening demand and the popularity level.
+    The signed token lets checkout, the payment webhook and the rent endpoint
+    charge the quoted price without pricing the rental again.
+    """
+
+    def __init__(self, rental_system, secret=None, ttl=900, cache_size=10000):
+        self.rental_system = rental_system
+        self._pricing = None
+        # Every worker must sign with the same key, so it has to come from the deployment's configuration
+        self._secret = secret or os.environ.get('ARTLENS_PRICE_QUOTE_SECRET')
+        self.ttl = ttl  # seconds a quote can be honoured
+        # Quotes are handed out for a third of their lifetime, so each one has at least 2/3 of ttl left
+        self.cache = TTLCache(maxsize=cache_size, ttl=ttl / 3, clock=time.time)
+
+    @property
+    def secret(self):
+        # Quotes set the charged price, so an unconfigured secret is only acceptable in tests
+        if self._secret:
+            return self._secret.encode('utf-8')
+        app = getattr(self.rental_system, 'app', None)
+        if app is not None and app.config.get('TESTING'):
+            return _TESTING_SECRET
+        raise RuntimeError("ARTLENS_PRICE_QUOTE_SECRET must be set to sign price quotes")
+
+    def check_secret(self):
+        """Raise at startup, rather than on the first rental, if no signing secret is configured"""
+        self.secret
+
+    @property
+    def pricing(self):
+        # Registered by setup_autonomous_features, or set directly by services without
+        # a Flask app; without either, rentals cost the base price
+        if self._pricing is not None:
+            return self._pricing
+        app = getattr(self.rental_system, 'app', None)
+        return app.config.get('DYNAMIC_PRICING') if app is not None else None
+    
+    @pricing.setter
+    def pricing(self, pricing):
+        self._pricing = pricing
+    
+    @staticmethod
+    def bucket_of(rental_count, now=None):
+        """(evening, popularity level): the same inputs DynamicPricing uses, local evening hours and rentals up to 10"""
+        hour = (now or datetime.datetime.now()).hour
+        return (17 <= hour <= 23, min(10, rental_count or 0))
+
+    def demand_buckets(self, art_ids, now=None):
+        """(evening, popularity level) per existing art id, from one query"""
+        ArtPiece = self.rental_system.ArtPiece
+        session = self.rental_system.Session()
+        rows = session.query(ArtPiece.id, ArtPiece.rental_count).filter(ArtPiece.id.in_(set(art_ids))).all()
+        session.close()
+        now = now or datetime.datetime.now()
+        return {row.id: self.bucket_of(row.rental_count, now) for row in rows}
+
+    def demand_bucket(self, art_id, now=None):
+        """(evening, popularity level) for an art piece, or None if it does not exist"""
+        return self.demand_buckets([int(art_id)], now).get(int(art_id))
+
+    def _calculate(self, art_id, duration_days):
+        pricing = self.pricing
+        if pricing is None:
+            return round(BASE_PRICE * duration_days, 2)
+        return pricing.calculate_price(art_id, duration_days)
+
+    def _sign(self, payload):
+        return _b64encode(hmac.new(self.secret, payload.encode('ascii'), hashlib.sha256).digest())
+
+    def issue(self, art_id, duration_days, price):
+        """Signed quote for a rental at `price`"""
+        body = {
+            'art_id': int(art_id),
+            'duration_days': int(duration_days),
+            'price': price,
+            'currency': 'usd',
+            'expires_at': int(time.time()) + self.ttl
+        }
+        payload = _b64encode(json.dumps(body, sort_keys=True, separators=(',', ':')).encode('utf-8'))
+        return dict(body, quote=f"{payload}.{self._sign(payload)}")
+
+    def quote(self, art_id, duration_days):
+        """Current quote for renting art_id for duration_days, or None if the art does not exist"""
+        art_id, duration_days = int(art_id), int(duration_days)
+        bucket = self.demand_bucket(art_id)
+        if bucket is None:
+            return None
+        key = (art_id, duration_days, bucket)
+        quote = self.cache.get(key)
+        if quote is None:
+            quote = self.issue(art_id, duration_days, self._calculate(art_id, duration_days))
+            self.cache.set(key, quote)
+        return quote
+
+    def quote_art(self, art, duration_days):
+        """Current quote for an ArtPiece the caller already loaded, e.g. through an async session"""
+        duration_days = int(duration_days)
+        key = (art.id, duration_days, self.bucket_of(art.rental_count))
+        quote = self.cache.get(key)
+        if quote is None:
+            pricing = self.pricing
+            if pricing is None:
+                price = round(BASE_PRICE * duration_days, 2)
+            else:
+                attributes = (art.style, art.color_palette, art.theme, art.rental_count or 0)
+                price = pricing.price_attributes([attributes], duration_days)[0]
+            quote = self.issue(art.id, duration_days, price)
+            self.cache.set(key, quote)
+        return quote
+    
+    def quote_many(self, art_ids, duration_days):
+        """Quotes for several pieces in the order of art_ids, None for missing ones.
+        
+        Pieces without a cached quote are priced together with one
+        DynamicPricing.calculate_prices call.
+        """
+        art_ids = [int(art_id) for art_id in art_ids]
+        duration_days = int(duration_days)
+        buckets = self.demand_buckets(art_ids)
+        quotes = {}
+        missing = []
+        for art_id in dict.fromkeys(art_ids):
+            if art_id not in buckets:
+                continue
+            quote = self.cache.get((art_id, duration_days, buckets[art_id]))
+            if quote is None:
+                missing.append(art_id)
+            else:
+                quotes[art_id] = quote
+        
+        if missing:
+            pricing = self.pricing
+            if pricing is None:
+                prices = [round(BASE_PRICE * duration_days, 2)] * len(missing)
+            else:
+                prices = pricing.calculate_prices(missing, duration_days)
+            for art_id, price in zip(missing, prices):
+                quotes[art_id] = self.issue(art_id, duration_days, price)
+                self.cache.set((art_id, duration_days, buckets[art_id]), quotes[art_id])
+        return [quotes.get(art_id) for art_id in art_ids]
+
+    def verify(self, token, art_id, duration_days, allow_expired=False):
+        """Price of a quote token for this rental, raising InvalidQuote otherwise.
+
+        allow_expired is for payments completed after checkout accepted the quote.
+        """
+        try:
+            payload, signature = token.split('.')
+            valid = hmac.compare_digest(signature.encode('utf-8'), self._sign(payload).encode('ascii'))
+        except (AttributeError, ValueError):
+            raise InvalidQuote("Malformed price quote")
+        if not valid:
+            raise InvalidQuote("Invalid price quote")
+        body = json.loads(_b64decode(payload))
+        if body['art_id'] != int(art_id) or body['duration_days'] != int(duration_days):
+            raise InvalidQuote("Price quote is for a different rental")
+        if not allow_expired and body['expires_at'] < time.time():
+            raise InvalidQuote("Price quote has expired")
+        return body['price']
+
+    def price_for(self, art_id, duration_days, token=None):
+        """Price to charge: the quoted one when a token is given, the current quote otherwise"""
+        if token:
+            return self.verify(token, art_id, duration_days)
+        quote = self.quote(art_id, duration_days)
+        return quote['price'] if quote else round(BASE_PRICE * duration_days, 2)
+
+    def clear(self):
+        """Drop cached quotes, e.g. after the pricing model was retrained"""
+        self.cache.clear()
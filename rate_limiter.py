@@ -0,0 +1,241 @@
+import json
+import math
+import time
+import sqlite3
+import threading
+from collections import namedtuple
+from ttl_cache import TTLCache
+
+# Outcome of one rate limit check; reset_at is a Unix timestamp
+Decision = namedtuple('Decision', ['allowed', 'limit', 'remaining', 'reset_at', 'retry_after'])
+
+
+class TokenBucket:
+    """Burst limiter: `capacity` tokens refilled continuously at `rate` tokens per second.
+
+    A request costing more than the whole bucket is charged `capacity`, so it
+    needs a full bucket instead of being refused forever.
+    """
+
+    def __init__(self, capacity, rate):
+        self.capacity = capacity
+        self.rate = rate
+
+    def ttl(self):
+        # Once full again the state carries no information and may be evicted
+        return math.ceil(self.capacity / self.rate) + 1
+
+    def apply(self, state, now, cost):
+        """Return (new_state, Decision) for a request costing `cost` tokens"""
+        cost = min(cost, self.capacity)
+        tokens, updated_at = state if state else (self.capacity, now)
+        tokens = min(self.capacity, tokens + (now - updated_at) * self.rate)
+
+        allowed = tokens >= cost
+        if allowed:
+            tokens -= cost
+        retry_after = 0 if allowed else math.ceil((cost - tokens) / self.rate)
+        reset_at = now + (self.capacity - tokens) / self.rate
+        return [tokens, now], Decision(allowed, self.capacity, int(tokens), math.ceil(reset_at), retry_after)
+
+    def refund(self, state, now, cost):
+        """Return (new_state, None) with `cost` tokens given back, for a request another limit denied"""
+        cost = min(cost, self.capacity)
+        tokens, updated_at = state if state else (self.capacity, now)
+        return [min(self.capacity, tokens + (now - updated_at) * self.rate + cost), now], None
+
+
+class SlidingWindow:
+    """Quota limiter: at most `limit` units per `window` seconds.
+
+    Uses the sliding window counter approximation of a request log: the
+    previous fixed window's count is weighted by how much of it still
+    overlaps the sliding window, so each check is O(1) in time and space.
+    """
+
+    def __init__(self, limit, window):
+        self.limit = limit
+        self.window = window
+
+    def ttl(self):
+        return 2 * self.window
+
+    def apply(self, state, now, cost):
+        index = int(now // self.window)
+        window_index, previous, current = state if state else (index, 0, 0)
+        if index != window_index:
+            previous = current if index == window_index + 1 else 0
+            current = 0
+
+        elapsed = (now - index * self.window) / self.window
+        used = previous * (1 - elapsed) + current
+
+        allowed = used + cost <= self.limit
+        if allowed:
+            current += cost
+            used += cost
+        reset_at = (index + 1) * self.window
+        retry_after = 0 if allowed else math.ceil(reset_at - now)
+        remaining = max(0, int(self.limit - used))
+        return [index, previous, current], Decision(allowed, self.limit, remaining, int(reset_at), retry_after)
+
+
+class MemoryBackend:
+    """Per-process storage with TTL eviction and a size bound"""
+
+    def __init__(self, maxsize=100000):
+        self.cache = TTLCache(maxsize=maxsize, clock=time.time)
+
+    def update(self, key, fn, ttl):
+        return self.cache.update(key, fn, ttl)
+
+
+class SQLiteBackend:
+    """Storage shared by every worker process on the host through one SQLite file"""
+
+    def __init__(self, path, purge_every=1000):
+        self.path = path
+        self.purge_every = purge_every
+        self._local = threading.local()
+        self._updates = 0
+        conn = self._connection()
+        conn.execute("CREATE TABLE IF NOT EXISTS rate_limits (key TEXT PRIMARY KEY, state TEXT, expires_at REAL)")
+
+    def _connection(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def update(self, key, fn, ttl):
+        conn = self._connection()
+        now = time.time()
+        # BEGIN IMMEDIATE takes the write lock up front, making read-modify-write atomic across processes
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute("SELECT state, expires_at FROM rate_limits WHERE key = ?", (key,)).fetchone()
+            state = json.loads(row[0]) if row and row[1] > now else None
+            new_state, result = fn(state)
+            conn.execute(
+                "INSERT OR REPLACE INTO rate_limits (key, state, expires_at) VALUES (?, ?, ?)",
+                (key, json.dumps(new_state), now + ttl)
+            )
+            self._updates += 1
+            if self._updates % self.purge_every == 0:
+                conn.execute("DELETE FROM rate_limits WHERE expires_at <= ?", (now,))
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        return result
+
+
+class RedisBackend:
+    """Storage in Redis (or anything speaking its protocol) using WATCH/MULTI optimistic transactions.
+
+    `client` needs the redis-py pipeline interface: pipeline(), watch(), get(),
+    multi(), set(key, value, ex=...) and execute(). `watch_error` is the
+    exception execute() raises when a watched key changed; it defaults to
+    redis-py's WatchError.
+    """
+
+    def __init__(self, client, prefix='ratelimit:', max_retries=10, watch_error=None):
+        if watch_error is None:
+            from redis.exceptions import WatchError as watch_error
+        self.client = client
+        self.prefix = prefix
+        self.max_retries = max_retries
+        self.watch_error = watch_error
+
+    def update(self, key, fn, ttl):
+        key = self.prefix + key
+        for _ in range(self.max_retries):
+            pipe = self.client.pipeline()
+            try:
+                pipe.watch(key)
+                raw = pipe.get(key)
+                state = json.loads(raw) if raw else None
+                new_state, result = fn(state)
+                pipe.multi()
+                pipe.set(key, json.dumps(new_state), ex=int(math.ceil(ttl)))
+                pipe.execute()
+                return result
+            except self.watch_error:
+                # Another client changed the key between WATCH and EXEC; retry
+                continue
+            finally:
+                pipe.reset()
+        raise RuntimeError(f"Rate limit state for {key} is too contended")
+
+
+def create_backend(url):
+    """Build a backend from 'memory://', 'sqlite:///path/to/file.db' or 'redis://host:port/db'"""
+    if url.startswith('memory://'):
+        return MemoryBackend()
+    if url.startswith('sqlite:///'):
+        return SQLiteBackend(url[len('sqlite:///'):])
+    if url.startswith('redis://'):
+        import redis
+        return RedisBackend(redis.Redis.from_url(url))
+    raise ValueError(f"Unsupported rate limit storage: {url}")
+
+
+class RateLimiter:
+    """Per-tier rate limiting: a burst token bucket in front of a daily sliding window quota"""
+
+    def __init__(self, backend, daily_limits, burst_limits, clock=time.time):
+        self.backend = backend
+        self.clock = clock
+        self.windows = {
+            tier: SlidingWindow(limit, 86400)
+            for tier, limit in daily_limits.items() if limit != float('inf')
+        }
+        self.buckets = {
+            tier: TokenBucket(capacity, per_minute / 60.0)
+            for tier, (capacity, per_minute) in ((t, b) for t, b in burst_limits.items() if b)
+        }
+
+    def check(self, identity, tier, cost=1):
+        """Consume `cost` units for `identity`; returns the Decision for the binding limit"""
+        now = self.clock()
+        decision = None
+
+        bucket = self.buckets.get(tier)
+        if bucket:
+            decision = self._apply(f"burst:{identity}", bucket, now, cost)
+            if not decision.allowed:
+                return decision
+
+        window = self.windows.get(tier)
+        if window:
+            decision = self._apply(f"daily:{identity}", window, now, cost)
+            if not decision.allowed and bucket:
+                # Requests denied by the quota do not use up burst capacity
+                self.backend.update(f"burst:{identity}", lambda state: bucket.refund(state, now, cost), bucket.ttl())
+
+        return decision
+
+    def charge(self, identity, tier, cost=1):
+        """Consume `cost` units of the daily quota only, e.g. for rows of a response already being streamed"""
+        window = self.windows.get(tier)
+        if window:
+            return self._apply(f"daily:{identity}", window, self.clock(), cost)
+        return None
+
+    def _apply(self, key, limiter, now, cost):
+        return self.backend.update(key, lambda state: limiter.apply(state, now, cost), limiter.ttl())
+
+    @staticmethod
+    def headers(decision):
+        """X-RateLimit-* response headers for a decision"""
+        headers = {
+            'X-RateLimit-Limit': str(decision.limit),
+            'X-RateLimit-Remaining': str(decision.remaining),
+            'X-RateLimit-Reset': str(decision.reset_at),
+        }
+        if not decision.allowed:
+            headers['Retry-After'] = str(decision.retry_after)
+        return headers
@@ -0,0 +1,286 @@
+import os
+import sys
+import json
+import heapq
+import argparse
+import tempfile
+import itertools
+from sqlalchemy import select, literal, union_all
+
+class JsonlPaymentSource:
+    """Checkout sessions exported to a JSONL file, one Stripe object per line"""
+
+    def __init__(self, path):
+        self.path = path
+
+    def __iter__(self):
+        with open(self.path, 'r', encoding='utf-8') as f:
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+
+
+class StripePaymentSource:
+    """Checkout sessions paged from the Stripe API; `api` may be any object shaped like the stripe module"""
+
+    def __init__(self, api=None, page_size=100, created_gte=None):
+        if api is None:
+            import stripe as api
+        self.api = api
+        self.page_size = page_size
+        self.created_gte = created_gte
+
+    def __iter__(self):
+        params = {'limit': self.page_size}
+        if self.created_gte:
+            params['created'] = {'gte': self.created_gte}
+        starting_after = None
+        while True:
+            page = self.api.checkout.Session.list(starting_after=starting_after, **params) \
+                if starting_after else self.api.checkout.Session.list(**params)
+            for session in page['data']:
+                yield session
+            if not page['has_more'] or not page['data']:
+                return
+            starting_after = page['data'][-1]['id']
+
+
+def _int_or_none(value):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+def normalize_payment(session):
+    """Fields of a Stripe checkout session that the reconciliation compares"""
+    if hasattr(session, 'to_dict'):
+        # API objects are not dicts in current stripe-python releases
+        session = session.to_dict()
+    metadata = session.get('metadata') or {}
+    return {
+        'reference': session['id'],
+        'mode': session.get('mode', 'payment'),
+        'paid': session.get('payment_status') == 'paid',
+        'amount': session.get('amount_total'),
+        'user_id': _int_or_none(metadata.get('user_id')),
+        'art_id': _int_or_none(metadata.get('art_id')),
+        'plan_id': metadata.get('plan_id')
+    }
+
+
+def external_sort(records, key, run_size=100000, tmp_dir=None):
+    """Sort JSON-serializable records by key in bounded memory.
+
+    Records are sorted in runs of `run_size`; when there is more than one run,
+    each is spilled to a temporary JSONL file and the runs are merged lazily.
+    """
+    runs = []
+    try:
+        while True:
+            run = sorted(itertools.islice(records, run_size), key=key)
+            if not run:
+                break
+            if len(run) < run_size and not runs:
+                # Everything fit in one run; no need to touch the disk
+                yield from run
+                return
+            f = tempfile.TemporaryFile('w+', encoding='utf-8', dir=tmp_dir)
+            for record in run:
+                f.write(json.dumps(record) + '\n')
+            f.seek(0)
+            runs.append(f)
+        yield from heapq.merge(*[(json.loads(line) for line in f) for f in runs], key=key)
+    finally:
+        for f in runs:
+            f.close()
+
+
+class PaymentReconciler:
+    """Merge-join checkout sessions against local rentals and subscriptions by payment reference.
+
+    Both sides are streamed in reference order: payments through an external
+    sort, local rows through an ordered query over rentals, archived rentals
+    and subscriptions. Memory stays bounded by `run_size` and the query's batch
+    size. Mismatches are appended to a JSONL report. A checkpoint with the last
+    reconciled reference and the report length is saved every
+    `checkpoint_every` payments, so an interrupted run resumes where it stopped.
+    """
+
+    def __init__(self, rental_system, source, report_path, checkpoint_path=None,
+                 checkpoint_every=10000, run_size=100000, batch_size=5000):
+        self.rental_system = rental_system
+        self.source = source
+        self.report_path = report_path
+        self.checkpoint_path = checkpoint_path
+        self.checkpoint_every = checkpoint_every
+        self.run_size = run_size
+        self.batch_size = batch_size
+
+    def _load_checkpoint(self):
+        # A checkpoint is only usable together with the report it points into
+        if self.checkpoint_path and os.path.exists(self.checkpoint_path) and os.path.exists(self.report_path):
+            with open(self.checkpoint_path, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        return {'last_reference': None, 'report_offset': 0, 'counts': {}}
+
+    def _save_checkpoint(self, checkpoint):
+        if not self.checkpoint_path:
+            return
+        # Written aside and renamed so a crash never leaves a torn checkpoint
+        tmp_path = f"{self.checkpoint_path}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(checkpoint, f)
+        os.replace(tmp_path, self.checkpoint_path)
+
+    def _local_rows(self, after):
+        """(reference, kind, user_id, art_id, plan_id, amount in cents) ordered by reference"""
+        rentals = self.rental_system.Rental.__table__
+        archive = self.rental_system.RentalArchive.__table__
+        subscriptions = self.rental_system.Subscription.__table__
+
+        def rental_rows(table, kind):
+            return select(table.c.payment_reference.label('reference'), literal(kind).label('kind'),
+                          table.c.user_id, table.c.art_piece_id.label('art_id'),
+                          literal(None).label('plan_id'), table.c.price)
+
+        query = union_all(
+            rental_rows(rentals, 'rental').where(rentals.c.payment_reference != None),
+            rental_rows(archive, 'rental').where(archive.c.payment_reference != None),
+            select(subscriptions.c.payment_reference.label('reference'), literal('subscription').label('kind'),
+                   subscriptions.c.user_id, literal(None).label('art_id'), subscriptions.c.plan_id,
+                   subscriptions.c.price).where(subscriptions.c.payment_reference != None)
+        ).subquery()
+        reference = query.c.reference
+        if self.rental_system.engine.dialect.name == 'postgresql':
+            # Byte order, matching how Python compares the payment side
+            reference = reference.collate('C')
+        statement = select(query).order_by(reference)
+        if after is not None:
+            statement = statement.where(reference > after)
+
+        with self.rental_system.engine.connect() as conn:
+            result = conn.execution_options(yield_per=self.batch_size).execute(statement)
+            for rows in result.partitions():
+                for ref, kind, user_id, art_id, plan_id, price in rows:
+                    yield ref, {'kind': kind, 'user_id': user_id, 'art_id': art_id, 'plan_id': plan_id,
+                                'amount': int(round(price * 100)) if price is not None else None}
+
+    def _payments(self, after):
+        payments = (normalize_payment(session) for session in self.source)
+        if after is not None:
+            payments = (payment for payment in payments if payment['reference'] > after)
+        return external_sort(payments, key=lambda payment: payment['reference'], run_size=self.run_size)
+
+    @staticmethod
+    def compare(reference, payment, rows):
+        """Mismatches between one checkout session (or None) and the local rows sharing its reference"""
+        if payment is None:
+            return [{'type': 'unknown_payment', 'reference': reference, 'records': rows}]
+        if not payment['paid']:
+            return [{'type': 'unpaid_payment', 'reference': reference, 'records': rows}] if rows else []
+        if not rows:
+            return [{'type': 'missing_record', 'reference': reference, 'payment': payment}]
+        if len(rows) > 1:
+            return [{'type': 'duplicate_record', 'reference': reference, 'payment': payment, 'records': rows}]
+
+        row = rows[0]
+        mismatches = []
+        expected_kind = 'subscription' if payment['mode'] == 'subscription' else 'rental'
+        fields = ['user_id'] + (['plan_id'] if expected_kind == 'subscription' else ['art_id'])
+        differing = [name for name in fields if payment[name] is not None and payment[name] != row[name]]
+        if row['kind'] != expected_kind or differing:
+            mismatches.append({'type': 'metadata_mismatch', 'reference': reference, 'fields': differing,
+                               'payment': payment, 'record': row})
+        if payment['amount'] is not None and row['amount'] != payment['amount']:
+            mismatches.append({'type': 'amount_mismatch', 'reference': reference,
+                               'payment': payment, 'record': row})
+        return mismatches
+
+    def _merge(self, payments, local):
+        """Yield (reference, payment or None, local rows) in reference order"""
+        groups = ((ref, [row for _, row in rows]) for ref, rows in itertools.groupby(local, key=lambda r: r[0]))
+        payment = next(payments, None)
+        group = next(groups, None)
+        last = None
+        while payment is not None or group is not None:
+            if group is not None and (payment is None or group[0] < payment['reference']):
+                reference, item = group[0], (None, group[1])
+                group = next(groups, None)
+            elif group is not None and group[0] == payment['reference']:
+                reference, item = group[0], (payment, group[1])
+                group = next(groups, None)
+                payment = next(payments, None)
+            else:
+                reference, item = payment['reference'], (payment, [])
+                payment = next(payments, None)
+            if last is not None and reference <= last:
+                if item[0] is not None and item[0]['reference'] == last:
+                    # The source listed the same checkout session twice
+                    continue
+                raise ValueError(f"Records are not in reference order at {reference!r}")
+            last = reference
+            yield (reference,) + item
+
+    def run(self):
+        """Reconcile everything after the checkpoint; returns counts per outcome"""
+        checkpoint = self._load_checkpoint()
+        counts = checkpoint['counts']
+        after = checkpoint['last_reference']
+
+        with open(self.report_path, 'r+' if after is not None else 'w', encoding='utf-8') as report:
+            # Drop mismatches written after the last checkpoint; they are found again below
+            report.seek(checkpoint['report_offset'])
+            report.truncate()
+
+            since_checkpoint = 0
+            for reference, payment, rows in self._merge(self._payments(after), self._local_rows(after)):
+                outcomes = ['payments' if payment else 'local_only']
+                mismatches = self.compare(reference, payment, rows)
+                for mismatch in mismatches:
+                    report.write(json.dumps(mismatch, default=str) + '\n')
+                    outcomes.append(mismatch['type'])
+                if not mismatches:
+                    outcomes.append('matched')
+                for outcome in outcomes:
+                    counts[outcome] = counts.get(outcome, 0) + 1
+
+                since_checkpoint += 1
+                if since_checkpoint >= self.checkpoint_every:
+                    report.flush()
+                    self._save_checkpoint({'last_reference': reference, 'report_offset': report.tell(),
+                                           'counts': counts})
+                    since_checkpoint = 0
+
+        # A finished run leaves no checkpoint, so the next one starts from the beginning
+        if self.checkpoint_path and os.path.exists(self.checkpoint_path):
+            os.remove(self.checkpoint_path)
+        return counts
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Reconcile Stripe checkout sessions against rentals and subscriptions")
+    parser.add_argument('--source', required=True, help="JSONL export of checkout sessions, or 'stripe' for the API")
+    parser.add_argument('--report', default='reconciliation.jsonl', help="Where mismatches are written")
+    parser.add_argument('--checkpoint', default='reconciliation.checkpoint.json',
+                        help="Progress file used to resume an interrupted run")
+    parser.add_argument('--created-since', type=int, help="Only sessions created at or after this Unix time")
+    parser.add_argument('--database-url', default="sqlite:///./artlens.db")
+    args = parser.parse_args(argv)
+
+    from rental_system import RentalSystem
+    rental_system = RentalSystem(None, database_url=args.database_url)
+
+    if args.source == 'stripe':
+        import stripe
+        stripe.api_key = os.environ.get('STRIPE_API_KEY', stripe.api_key)
+        source = StripePaymentSource(stripe, created_gte=args.created_since)
+    else:
+        source = JsonlPaymentSource(args.source)
+
+    counts = PaymentReconciler(rental_system, source, args.report, args.checkpoint).run()
+    print(json.dumps(counts))
+    # Non-zero exit lets a scheduler alert on mismatches
+    return 1 if any(name not in ('payments', 'local_only', 'matched') for name in counts) else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
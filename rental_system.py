@@ -2,16 +2,33 @@ from flask import Flask
 from flask_cors import CORS
 from sqlalchemy import create_engine, func
 from sqlalchemy.orm import sessionmaker
-from database.models import Base, User, ArtPiece, Rental, UserPreference, Subscription
+from database.models import (Base, User, ArtPiece, Rental, UserPreference, Subscription,
+                             RentalArchive, UserRentalRollup, ArtRentalRollup, ApiKey,
+                             IdempotencyRecord, RevokedToken, WebhookEvent, WebhookDeadLetter,
+                             UsageCounter, PaymentConflict, CacheGeneration)
 import os
+import time
 import datetime
 import json
 from art_generator import generate_art
+from catalog_io import CatalogTransfer
+from popularity import PopularityCounters
+from facet_index import FacetIndex
+from availability import AvailabilityIndex
+from archival import RentalArchiver
+from api_keys import ApiKeyStore
+from idempotency import IdempotencyStore
+from price_quotes import PriceQuotes
+from entitlements import Entitlements
+
+DEFAULT_DATABASE_URL = "sqlite:///./artlens.db"
 
 class RentalSystem:
-    def __init__(self, app, database_url="sqlite:///./artlens.db"):
+    def __init__(self, app, database_url=DEFAULT_DATABASE_URL):
         self.app = app
         self.database_url = database_url
+        # Set by metrics.setup_metrics when the app is instrumented
+        self.metrics = None
         self.setup_database()
         self.func = func  # Expose SQLAlchemy func for queries
         
@@ -21,6 +38,33 @@ class RentalSystem:
         Base.metadata.create_all(self.engine)
         self.Session = sessionmaker(bind=self.engine)
         
+        # Denormalized rental counters on ArtPiece, updated with every Rental flush
+        self.popularity = PopularityCounters(self)
+        self.popularity.register(self.Session)
+        
+        # In-memory facet bitsets, loaded once and kept current on ArtPiece commits
+        self.facet_index = FacetIndex(self)
+        self.facet_index.register(self.Session)
+        self.facet_index.rebuild()
+        
+        # Interval index of active rentals for overlap and availability checks
+        self.availability = AvailabilityIndex(self)
+        self.availability.register(self.Session)
+        self.availability.rebuild()
+        
+        # Hashed API keys with a lookup cache in front
+        self.api_keys = ApiKeyStore(self)
+        
+        # Stored responses for retried POSTs carrying an Idempotency-Key
+        self.idempotency = IdempotencyStore(self)
+        
+        # Signed price quotes, priced once per art, duration and demand bucket
+        self.quotes = PriceQuotes(self)
+        
+        # Subscription limits backed by monthly usage counters kept in step with Rental inserts
+        self.entitlements = Entitlements(self)
+        self.entitlements.register(self.Session)
+        
         # Storage paths
         self.storage_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "storage")
         if not os.path.exists(self.storage_path):
@@ -47,14 +91,100 @@ class RentalSystem:
     def Subscription(self):
         return Subscription
     
+    @property
+    def RentalArchive(self):
+        return RentalArchive
+    
+    @property
+    def UserRentalRollup(self):
+        return UserRentalRollup
+    
+    @property
+    def ArtRentalRollup(self):
+        return ArtRentalRollup
+    
+    @property
+    def ApiKey(self):
+        return ApiKey
+    
+    @property
+    def CacheGeneration(self):
+        return CacheGeneration
+    
+    @property
+    def IdempotencyRecord(self):
+        return IdempotencyRecord
+    
+    @property
+    def RevokedToken(self):
+        return RevokedToken
+    
+    @property
+    def WebhookEvent(self):
+        return WebhookEvent
+    
+    @property
+    def WebhookDeadLetter(self):
+        return WebhookDeadLetter
+    
+    @property
+    def UsageCounter(self):
+        return UsageCounter
+    
+    @property
+    def PaymentConflict(self):
+        return PaymentConflict
+    
     @property
     def datetime(self):
         return datetime
 
+    def generate_art(self, style, color_palette, theme):
+        """Render a new art image and return its filename"""
+        if self.metrics is None:
+            return generate_art(style, color_palette, theme)
+        start = time.perf_counter()
+        try:
+            return generate_art(style, color_palette, theme)
+        finally:
+            self.metrics.observe_render(style, time.perf_counter() - start)
+
+    def export_catalog(self, path, fmt=None, include_rentals=False, batch_size=5000, progress=None):
+        """Stream the art catalog (and optionally rentals) to a JSONL or CSV file"""
+        transfer = CatalogTransfer(self, batch_size=batch_size, progress=progress)
+        return transfer.export_catalog(path, fmt, include_rentals)
+
+    def import_catalog(self, path, fmt=None, include_rentals=False, batch_size=5000,
+                       progress=None, keep_ids=True):
+        """Bulk load a catalog file written by export_catalog"""
+        transfer = CatalogTransfer(self, batch_size=batch_size, progress=progress)
+        return transfer.import_catalog(path, fmt, include_rentals, keep_ids)
+    
+    def expire_rentals(self, now=None):
+        """Deactivate rentals that have ended, keeping popularity counters in sync"""
+        return self.popularity.expire_rentals(now)
+    
+    def rebuild_popularity_counters(self):
+        """Recompute ArtPiece popularity counters from rental history"""
+        return self.popularity.rebuild()
+    
+    def rebuild_usage_counters(self):
+        """Recompute monthly subscription usage counters from rental history"""
+        return self.entitlements.rebuild()
+    
+    def archive_rentals(self, retention_days=90, batch_size=1000, max_batches=None):
+        """Move rentals that ended more than retention_days ago into the archive table"""
+        archiver = RentalArchiver(self, retention_days=retention_days, batch_size=batch_size)
+        return archiver.archive(max_batches=max_batches)
+    
+    def iter_rental_history(self, user_id=None, art_id=None, batch_size=1000):
+        """Stream live and archived rentals together, oldest first"""
+        return RentalArchiver(self).iter_rental_history(user_id=user_id, art_id=art_id, batch_size=batch_size)
+
 # Create a Flask app and initialize rental system
-def create_app():
+def create_app(database_url=DEFAULT_DATABASE_URL):
     app = Flask(__name__)
     CORS(app)
-    rental_system = RentalSystem(app)
+    rental_system = RentalSystem(app, database_url)
     app.config['RENTAL_SYSTEM'] = rental_system
     return app
@@ -0,0 +1,231 @@
+import os
+import time
+import sqlite3
+import tempfile
+import threading
+from functools import wraps
+from flask import request, current_app, make_response, g
+from ttl_cache import TTLCache
+from session_hooks import on_commit
+
+class MemoryBackend:
+    """Responses cached in this process only"""
+
+    def __init__(self, maxsize=5000):
+        self.cache = TTLCache(maxsize=maxsize)
+        self.versions = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        return self.cache.get(key)
+
+    def set(self, key, value, ttl):
+        self.cache.set(key, value, ttl)
+
+    def get_versions(self, tags):
+        return [self.versions.get(tag, 0) for tag in tags]
+
+    def bump(self, tags):
+        with self._lock:
+            for tag in tags:
+                self.versions[tag] = self.versions.get(tag, 0) + 1
+
+    def stats(self):
+        return {'size': len(self.cache), 'maxsize': self.cache.maxsize, 'evictions': self.cache.evictions}
+
+
+class SharedMemoryBackend:
+    """Responses shared by every worker on the host through an SQLite file on tmpfs (/dev/shm)"""
+
+    def __init__(self, name='artlens_response_cache', maxsize=50000, trim_every=500):
+        directory = '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir()
+        self.path = os.path.join(directory, f"{name}.db")
+        self.maxsize = maxsize
+        self.trim_every = trim_every
+        self.evictions = 0
+        self._sets = 0
+        self._local = threading.local()
+        conn = self._connection()
+        conn.execute("CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, status INTEGER, "
+                     "content_type TEXT, body BLOB, expires_at REAL, used_at REAL)")
+        conn.execute("CREATE INDEX IF NOT EXISTS ix_responses_used_at ON responses (used_at)")
+        conn.execute("CREATE TABLE IF NOT EXISTS tag_versions (tag TEXT PRIMARY KEY, version INTEGER)")
+
+    def _connection(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=OFF")
+            self._local.conn = conn
+        return conn
+
+    def get(self, key):
+        conn = self._connection()
+        now = time.time()
+        row = conn.execute("SELECT status, content_type, body FROM responses WHERE key = ? AND expires_at > ?",
+                           (key, now)).fetchone()
+        if row:
+            conn.execute("UPDATE responses SET used_at = ? WHERE key = ?", (now, key))
+        return row
+
+    def set(self, key, value, ttl):
+        conn = self._connection()
+        now = time.time()
+        conn.execute("INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?)", (key, *value, now + ttl, now))
+        self._sets += 1
+        if self._sets % self.trim_every == 0:
+            self._trim(conn, now)
+
+    def _trim(self, conn, now):
+        # Drop expired entries, then the least recently used ones beyond maxsize
+        removed = conn.execute("DELETE FROM responses WHERE expires_at <= ?", (now,)).rowcount
+        removed += conn.execute(
+            "DELETE FROM responses WHERE key IN (SELECT key FROM responses ORDER BY used_at DESC LIMIT -1 OFFSET ?)",
+            (self.maxsize,)
+        ).rowcount
+        self.evictions += removed
+
+    def get_versions(self, tags):
+        if not tags:
+            return []
+        rows = dict(self._connection().execute(
+            f"SELECT tag, version FROM tag_versions WHERE tag IN ({','.join('?' * len(tags))})", tags
+        ).fetchall())
+        return [rows.get(tag, 0) for tag in tags]
+
+    def bump(self, tags):
+        conn = self._connection()
+        conn.executemany(
+            "INSERT INTO tag_versions VALUES (?, 1) ON CONFLICT(tag) DO UPDATE SET version = version + 1",
+            [(tag,) for tag in tags]
+        )
+
+    def stats(self):
+        size = self._connection().execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+        return {'size': size, 'maxsize': self.maxsize, 'evictions': self.evictions}
+
+
+def create_backend(url):
+    """Build a backend from 'memory://' or 'shm://name'"""
+    if url.startswith('memory://'):
+        return MemoryBackend()
+    if url.startswith('shm://'):
+        return SharedMemoryBackend(url[len('shm://'):] or 'artlens_response_cache')
+    raise ValueError(f"Unsupported response cache storage: {url}")
+
+
+class ResponseCache:
+    """Caches serialized GET responses, invalidated by bumping tag versions on commits.
+
+    A cache key combines the request path and query, the caller's auth scope and
+    the current version of every tag the response depends on. A commit touching
+    an ArtPiece or Rental bumps the matching tags, so stale entries are simply
+    never looked up again and age out through TTL and LRU eviction.
+    """
+
+    def __init__(self, rental_system, backend=None, ttl=300):
+        self.rental_system = rental_system
+        self.backend = backend or MemoryBackend()
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+
+    def register(self, session_factory):
+        """Invalidate on ArtPiece and Rental commits made through session_factory"""
+        def art_changed(added, updated, deleted):
+            self.backend.bump(['art'] + [f"art:{art_id}" for art_id in updated + deleted])
+
+        def rentals_changed(added, updated, deleted):
+            self.backend.bump({f"user:{user_id}" for user_id in added + updated + deleted})
+
+        on_commit(session_factory, self.rental_system.ArtPiece, lambda art: art.id, art_changed)
+        on_commit(session_factory, self.rental_system.Rental, lambda rental: rental.user_id, rentals_changed)
+
+    def bump(self, tags):
+        """Invalidate every entry depending on one of `tags`"""
+        if tags:
+            self.backend.bump(list(tags))
+
+    def key(self, scope, tags):
+        versions = self.backend.get_versions(tags)
+        query = '&'.join(sorted(f"{k}={v}" for k, v in request.args.items(multi=True)))
+        tag_part = ','.join(f"{tag}@{version}" for tag, version in zip(tags, versions))
+        return f"{scope}|{request.path}?{query}|{tag_part}"
+
+    def get(self, key):
+        value = self.backend.get(key)
+        if value is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return value
+
+    def set(self, key, response, ttl=None):
+        self.backend.set(key, (response.status_code, response.content_type, response.get_data()), ttl or self.ttl)
+
+    def stats(self):
+        """Hit rate of this process plus backend size"""
+        total = self.hits + self.misses
+        stats = {
+            'backend': type(self.backend).__name__,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / total if total else 0.0
+        }
+        stats.update(self.backend.stats())
+        return stats
+
+
+def invalidate(rental_system, tags):
+    """Bump tags for writes that bypass the commit hooks, e.g. Core bulk statements.
+
+    Only the cache of the app this rental system serves is reached; a command
+    line run without an app leaves other processes to the cache TTL.
+    """
+    app = getattr(rental_system, 'app', None)
+    cache = app.config.get('RESPONSE_CACHE') if app is not None else None
+    if cache is not None:
+        cache.bump(tags)
+
+def _auth_scope():
+    # Responses fetched with an API key are never served to callers with a different scope
+    api_key = g.get('api_key')
+    return f"user:{api_key['user_id']}:{api_key['tier']}" if api_key else 'public'
+
+def cached_response(tags=None, ttl=None, scope=_auth_scope):
+    """Cache a GET view's 200 responses in app.config['RESPONSE_CACHE'].
+
+    `tags(**view_kwargs)` lists what the response depends on, e.g. ['art:12'];
+    `scope()` names who may share the entry.
+    """
+    def decorator(f):
+        @wraps(f)
+        def decorated_function(*args, **kwargs):
+            cache = current_app.config.get('RESPONSE_CACHE')
+            if cache is None or request.method != 'GET':
+                return f(*args, **kwargs)
+
+            key = cache.key(scope(), sorted(tags(**kwargs)) if tags else [])
+            cached = cache.get(key)
+            if cached is not None:
+                status, content_type, body = cached
+                response = current_app.response_class(body, status=status, content_type=content_type)
+                response.headers['X-Cache'] = 'HIT'
+                return response
+
+            response = make_response(f(*args, **kwargs))
+            if response.status_code == 200:
+                cache.set(key, response, ttl)
+            response.headers['X-Cache'] = 'MISS'
+            return response
+        return decorated_function
+    return decorator
+
+def setup_response_cache(app, rental_system):
+    """Create the response cache selected by RESPONSE_CACHE_STORAGE and hook it to commits"""
+    if 'RESPONSE_CACHE' not in app.config:
+        backend = create_backend(app.config.get('RESPONSE_CACHE_STORAGE', 'memory://'))
+        app.config['RESPONSE_CACHE'] = ResponseCache(rental_system, backend, app.config.get('RESPONSE_CACHE_TTL', 300))
+        app.config['RESPONSE_CACHE'].register(rental_system.Session)
+    return app.config['RESPONSE_CACHE']
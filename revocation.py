@@ -0,0 +1,174 @@
+import math
+import time
+import hashlib
+import datetime
+import threading
+from sqlalchemy import select, delete
+from ttl_cache import TTLCache
+
+def _epoch(value):
+    """Unix time of a naive UTC datetime"""
+    return value.replace(tzinfo=datetime.timezone.utc).timestamp()
+
+class BloomFilter:
+    """Fixed-size set membership with no false negatives and a bounded false positive rate"""
+
+    def __init__(self, capacity, error_rate=0.001):
+        capacity = max(1, capacity)
+        self.size = max(64, int(-capacity * math.log(error_rate) / (math.log(2) ** 2)))
+        self.hashes = max(1, round(self.size / capacity * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+
+    def _positions(self, item):
+        # Double hashing: k positions from the two halves of one digest
+        digest = hashlib.blake2b(item.encode('utf-8'), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:], 'little') | 1
+        return [(h1 + i * h2) % self.size for i in range(self.hashes)]
+
+    def add(self, item):
+        for position in self._positions(item):
+            self.bits[position >> 3] |= 1 << (position & 7)
+
+    def __contains__(self, item):
+        return all(self.bits[position >> 3] & (1 << (position & 7)) for position in self._positions(item))
+
+
+class RevocationList:
+    """Revoked JWTs, checked against an in-memory Bloom filter before the database.
+
+    Rows live in RevokedToken: one per logged-out token (keyed by its jti) and
+    one per user whose tokens were all revoked, e.g. after a password change
+    ('user:<id>', covering tokens issued before revoked_at). Nearly every
+    request misses the filter and costs no query; a hit is confirmed with one
+    indexed lookup, whose answer is cached. The filter is rebuilt from the table
+    every `refresh_interval` seconds, which picks up revocations made by other
+    workers and drops rows whose tokens have expired anyway. Refreshes run in
+    one background thread at a time while requests keep using the old filter.
+    """
+
+    def __init__(self, rental_system, capacity=10000, error_rate=0.001, refresh_interval=30):
+        self.rental_system = rental_system
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.refresh_interval = refresh_interval
+        self.lookups = 0
+        # Confirmed lookups: revocation time (Unix) or False for filter false positives
+        self.confirmed = TTLCache(maxsize=capacity, ttl=refresh_interval)
+        self._lock = threading.Lock()
+        # Held for the duration of a rebuild, so at most one runs per process
+        self._rebuild_lock = threading.Lock()
+        self._filter = BloomFilter(capacity, error_rate)
+        self._built_at = None
+        # Keys revoked in this process while a rebuild reads the table
+        self._since_snapshot = None
+
+    @staticmethod
+    def user_key(user_id):
+        return f"user:{user_id}"
+
+    def rebuild(self, now=None):
+        """Purge lapsed rows and reload the filter from the table; returns the number of entries"""
+        with self._lock:
+            self._since_snapshot = []
+        self.purge_expired(now)
+        RevokedToken = self.rental_system.RevokedToken
+        session = self.rental_system.Session()
+        keys = session.execute(select(RevokedToken.jti)).scalars().all()
+        session.close()
+
+        # Sized with headroom so revocations added before the next rebuild keep the error rate
+        bloom = BloomFilter(max(self.capacity, 2 * len(keys)), self.error_rate)
+        for key in keys:
+            bloom.add(key)
+        with self._lock:
+            # Revocations stored after the table was read would otherwise be lost with the old filter
+            for key in self._since_snapshot or ():
+                bloom.add(key)
+            self._since_snapshot = None
+            self._filter = bloom
+            self._built_at = time.monotonic()
+            self.confirmed.clear()
+        return len(keys)
+
+    def purge_expired(self, now=None):
+        """Delete rows whose tokens have expired; returns how many were removed"""
+        now = now or datetime.datetime.utcnow()
+        RevokedToken = self.rental_system.RevokedToken
+        session = self.rental_system.Session()
+        removed = session.execute(delete(RevokedToken).where(RevokedToken.expires_at <= now)).rowcount
+        session.commit()
+        session.close()
+        return removed
+
+    def _current_filter(self):
+        if self._built_at is None:
+            # Nothing to serve yet: the first caller builds and concurrent ones wait for it
+            with self._rebuild_lock:
+                if self._built_at is None:
+                    self.rebuild()
+        elif time.monotonic() - self._built_at > self.refresh_interval and self._rebuild_lock.acquire(blocking=False):
+            threading.Thread(target=self._refresh, name="revocation-refresh", daemon=True).start()
+        return self._filter
+
+    def _refresh(self):
+        try:
+            self.rebuild()
+        except Exception:
+            # Keep serving the old filter; the next stale check tries again
+            pass
+        finally:
+            self._rebuild_lock.release()
+
+    def _revoked_at(self, key):
+        """Revocation time of a filter hit, from the cache or one indexed query"""
+        revoked_at = self.confirmed.get(key)
+        if revoked_at is None:
+            self.lookups += 1
+            RevokedToken = self.rental_system.RevokedToken
+            session = self.rental_system.Session()
+            row = session.execute(
+                select(RevokedToken.revoked_at).where(RevokedToken.jti == key)
+            ).scalar_one_or_none()
+            session.close()
+            revoked_at = _epoch(row) if row is not None else False
+            self.confirmed.set(key, revoked_at)
+        return revoked_at
+
+    def is_revoked(self, claims):
+        """True if the token with these verified claims was revoked"""
+        bloom = self._current_filter()
+        jti = claims.get('jti')
+        if jti and jti in bloom and self._revoked_at(jti) is not False:
+            return True
+        user_key = self.user_key(claims['user_id'])
+        if user_key in bloom:
+            revoked_at = self._revoked_at(user_key)
+            # Tokens without iat predate revocation support and are always covered
+            return revoked_at is not False and claims.get('iat', 0) < revoked_at
+        return False
+
+    def _store(self, key, user_id, expires_at, now):
+        RevokedToken = self.rental_system.RevokedToken
+        session = self.rental_system.Session()
+        row = session.execute(select(RevokedToken).where(RevokedToken.jti == key)).scalar_one_or_none()
+        if row is None:
+            session.add(RevokedToken(jti=key, user_id=user_id, revoked_at=now, expires_at=expires_at))
+        else:
+            row.revoked_at = now
+            row.expires_at = max(row.expires_at, expires_at)
+        session.commit()
+        session.close()
+        with self._lock:
+            self._filter.add(key)
+            if self._since_snapshot is not None:
+                self._since_snapshot.append(key)
+            self.confirmed.pop(key)
+
+    def revoke(self, jti, user_id, expires_at):
+        """Revoke one token until its expiry (a naive UTC datetime)"""
+        self._store(jti, user_id, expires_at, datetime.datetime.utcnow())
+
+    def revoke_user(self, user_id, expires_at, now=None):
+        """Revoke every token of a user issued before now; expires_at is when the newest of them lapses"""
+        self._store(self.user_key(user_id), user_id, expires_at, now or datetime.datetime.utcnow())
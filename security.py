@@ -1,13 +1,38 @@
 import os
 import hashlib
 import secrets
-from flask import request, jsonify, g
+from flask import request, jsonify, g, send_file
 from functools import wraps
 import jwt
 from datetime import datetime, timedelta
 import re
+import time
+from urllib.parse import urlencode
+import hmac
+import base64
+from ttl_cache import TTLCache
+from api_keys import KEY_PREFIX
+from passwords import PasswordHasher, PasswordHasherBusy
+from revocation import RevocationList
 
 class SecurityManager:
+    # Routes served without authentication; a trailing '*' matches everything below a prefix
+    PUBLIC_ROUTES = (
+        '/',
+        '/api/health',
+        '/api/metrics',
+        '/api/user/register',
+        '/api/user/login',
+        '/api/payment/webhook',
+        '/api/payment/subscription-plans',
+        # Signed art URLs carry their own authorization
+        '/api/media/*',
+    )
+    
+    # Image variants served through signed URLs
+    ART_VARIANTS = ('preview', 'full')
+    PREVIEW_SIZE = (256, 256)
+    
     def __init__(self, app, rental_system):
         self.app = app
         self.rental_system = rental_system
@@ -16,6 +41,33 @@ class SecurityManager:
         self.jwt_secret = "your_jwt_secret_key_here"
         self.token_expiry = 24  # hours
         
+        # Authentication is only enforced when REQUIRE_JWT is set
+        self.require_jwt = app.config.get('REQUIRE_JWT', False)
+        
+        # Route policies are compiled once instead of scanned on every request
+        self._public_exact, self._public_prefixes = self._compile_route_policies(self.PUBLIC_ROUTES)
+        
+        # scrypt hashing on its own bounded pool; PASSWORD_SCRYPT_N raises or lowers the cost
+        self.password_hasher = PasswordHasher(
+            n=app.config.get('PASSWORD_SCRYPT_N', 2 ** 14),
+            workers=app.config.get('PASSWORD_HASH_WORKERS')
+        )
+        
+        # Key for signed art URLs, kept separate from the JWT secret
+        self.url_signing_key = app.config.get('ART_URL_SECRET') or hmac.new(
+            self.jwt_secret.encode('utf-8'), b'art-url-signing', hashlib.sha256
+        ).digest()
+        self.art_url_ttl = app.config.get('ART_URL_TTL', 900)  # seconds
+        
+        # Verified claims keyed by token digest, each kept no longer than its token is valid
+        self.claims_cache = TTLCache(maxsize=10000, ttl=300, clock=time.time)
+        
+        # Revoked tokens (logout, password change) behind a Bloom filter rebuilt from the database
+        self.revocations = RevocationList(rental_system)
+        self.revocations.rebuild()
+        
+        app.config['SECURITY_MANAGER'] = self
+        
         # Set up security routes and middleware
         self.setup_security()
     
@@ -25,46 +77,34 @@ class SecurityManager:
         @self.app.before_request
         def before_request():
             """Middleware to check authentication for protected routes"""
-            # Skip authentication for public routes
-            public_paths = [
-                '/',
-                '/api/health',
-                '/api/user/register',
-                '/api/user/login',
-            ]
-            
-            # Allow all GET requests for now in the test environment
-            if request.method == 'GET':
-                return None
-                
-            if any(request.path.startswith(path) for path in public_paths):
-                return None
+            # Verify bearer JWTs up front so views can rely on g.user_id; API keys are left to require_api_key
+            token = self._bearer_token()
+            if token and not token.startswith(KEY_PREFIX):
+                try:
+                    claims = self.verify_token(token)
+                    if self.revocations.is_revoked(claims):
+                        if self.require_jwt:
+                            return jsonify({"error": "Token revoked"}), 401
+                    else:
+                        g.user_id = claims['user_id']
+                        g.jwt_claims = claims
+                except jwt.ExpiredSignatureError:
+                    if self.require_jwt:
+                        return jsonify({"error": "Token expired"}), 401
+                except jwt.InvalidTokenError:
+                    if self.require_jwt:
+                        return jsonify({"error": "Invalid token"}), 401
             
-            # Check for API key authentication
-            if request.path.startswith('/api/'):
-                auth_header = request.headers.get('Authorization')
-                if auth_header and auth_header.startswith('Bearer '):
-                    # API key authentication is handled by the API service
-                    return None
+            # For testing purposes, authentication is bypassed unless REQUIRE_JWT is set
+            if not self.require_jwt or self.is_public(request.path):
+                return None
             
-            # For testing purposes, bypass authentication
-            # In production, this would be removed
-            return None
+            # API key authentication is handled by the API service
+            if token and token.startswith(KEY_PREFIX) and request.path.startswith('/api/'):
+                return None
             
-            # Check for JWT authentication
-            auth_header = request.headers.get('Authorization')
-            if not auth_header or not auth_header.startswith('Bearer '):
+            if 'user_id' not in g:
                 return jsonify({"error": "Authentication required"}), 401
-            
-            token = auth_header.split('Bearer ')[1]
-            
-            try:
-                payload = jwt.decode(token, self.jwt_secret, algorithms=['HS256'])
-                g.user_id = payload['user_id']
-            except jwt.ExpiredSignatureError:
-                return jsonify({"error": "Token expired"}), 401
-            except jwt.InvalidTokenError:
-                return jsonify({"error": "Invalid token"}), 401
         
         @self.app.route('/api/user/login', methods=['POST'])
         def login():
@@ -86,12 +126,24 @@ class SecurityManager:
                 session.close()
                 return jsonify({"error": "Invalid credentials"}), 401
             
-            # In production, we would use proper password hashing and verification
-            # For now, we're using plain text comparison for simplicity
-            if user.password_hash != password:
+            try:
+                valid, needs_rehash = self.password_hasher.verify(password, user.password_hash)
+            except PasswordHasherBusy:
+                session.close()
+                return jsonify({"error": "Too many login attempts in progress, try again shortly"}), 503
+            
+            if not valid:
                 session.close()
                 return jsonify({"error": "Invalid credentials"}), 401
             
+            # Upgrade plaintext or outdated hashes while we have the password
+            if needs_rehash:
+                try:
+                    user.password_hash = self.password_hasher.hash(password)
+                    session.commit()
+                except PasswordHasherBusy:
+                    session.rollback()
+            
             # Generate JWT token
             token = self._generate_token(user.id)
             
@@ -133,12 +185,17 @@ class SecurityManager:
                 session.close()
                 return jsonify({"error": "Username or email already exists"}), 409
             
+            try:
+                password_hash = self.password_hasher.hash(password)
+            except PasswordHasherBusy:
+                session.close()
+                return jsonify({"error": "Too many requests in progress, try again shortly"}), 503
+            
             # Create new user
-            # In production, we would hash the password
             new_user = self.rental_system.User(
                 username=username,
                 email=email,
-                password_hash=password  # In production, this would be hashed
+                password_hash=password_hash
             )
             
             session.add(new_user)
@@ -180,18 +237,114 @@ class SecurityManager:
                 session.close()
                 return jsonify({"error": "User not found"}), 404
             
-            # Verify old password
-            if user.password_hash != old_password:  # In production, would use proper verification
+            try:
+                # Verify old password
+                valid, _ = self.password_hasher.verify(old_password, user.password_hash)
+                if not valid:
+                    session.close()
+                    return jsonify({"error": "Incorrect password"}), 401
+                
+                # Update password
+                user.password_hash = self.password_hasher.hash(new_password)
+            except PasswordHasherBusy:
                 session.close()
-                return jsonify({"error": "Incorrect password"}), 401
-            
-            # Update password
-            user.password_hash = new_password  # In production, would hash the password
+                return jsonify({"error": "Too many requests in progress, try again shortly"}), 503
             
             session.commit()
             session.close()
             
-            return jsonify({"status": "success", "message": "Password updated successfully"})
+            # Sign out every session holding an older token; the caller continues with a fresh one
+            self.revocations.revoke_user(g.user_id, datetime.utcnow() + timedelta(hours=self.token_expiry))
+            
+            return jsonify({
+                "status": "success",
+                "message": "Password updated successfully",
+                "token": self._generate_token(g.user_id)
+            })
+        
+        @self.app.route('/api/user/logout', methods=['POST'])
+        def logout():
+            """Revoke the JWT the request was made with"""
+            claims = g.get('jwt_claims')
+            if claims is None:
+                return jsonify({"error": "Authentication required"}), 401
+            
+            if 'jti' in claims:
+                self.revocations.revoke(claims['jti'], claims['user_id'], datetime.utcfromtimestamp(claims['exp']))
+            else:
+                # Tokens issued before jti was added can only be revoked together
+                self.revocations.revoke_user(claims['user_id'], datetime.utcfromtimestamp(claims['exp']))
+            
+            return jsonify({"status": "success", "message": "Logged out"})
+        
+        @self.app.route('/api/art/<int:art_id>/access-url', methods=['GET'])
+        def get_art_access_url(art_id):
+            """Mint a signed, expiring URL for an art image"""
+            user_id = self._current_user_id()
+            if user_id is None:
+                return jsonify({"error": "Authentication required"}), 401
+            
+            variant = request.args.get('variant', 'full')
+            if variant not in self.ART_VARIANTS:
+                return jsonify({"error": "Invalid variant"}), 400
+            
+            session = self.rental_system.Session()
+            art = session.get(self.rental_system.ArtPiece, art_id)
+            if not art:
+                session.close()
+                return jsonify({"error": "Art piece not found"}), 404
+            file_path = art.file_path
+            
+            # Previews are open to any signed-in user; the full image needs a current rental
+            expires = int(time.time()) + self.art_url_ttl
+            if variant == 'full':
+                Rental = self.rental_system.Rental
+                rental_end = session.query(self.rental_system.func.max(Rental.end_date)).filter(
+                    Rental.user_id == user_id,
+                    Rental.art_piece_id == art_id,
+                    Rental.is_active == True,
+                    Rental.start_date <= datetime.utcnow(),
+                    Rental.end_date > datetime.utcnow()
+                ).scalar()
+                if rental_end is None:
+                    session.close()
+                    return jsonify({"error": "No active rental for this art piece"}), 403
+                # The URL never outlives the rental
+                expires = min(expires, int((rental_end - datetime(1970, 1, 1)).total_seconds()))
+            session.close()
+            
+            return jsonify({
+                "url": self.sign_art_url(art_id, user_id, variant, expires, file_path),
+                "expires_at": datetime.utcfromtimestamp(expires).isoformat()
+            })
+        
+        @self.app.route('/api/media/art/<int:art_id>/<variant>', methods=['GET'])
+        def deliver_art(art_id, variant):
+            """Serve an art image from a signed URL without touching the database"""
+            try:
+                user_id = int(request.args['u'])
+                expires = int(request.args['e'])
+                file_path = request.args['f']
+                signature = request.args['s']
+            except (KeyError, ValueError):
+                return jsonify({"error": "Invalid art URL"}), 403
+            
+            expected = self._art_signature(art_id, user_id, variant, expires, file_path)
+            if variant not in self.ART_VARIANTS or not hmac.compare_digest(signature, expected):
+                return jsonify({"error": "Invalid art URL"}), 403
+            if expires <= time.time():
+                return jsonify({"error": "Art URL expired"}), 410
+            
+            path = self._art_file(file_path)
+            if path is None:
+                return jsonify({"error": "Art file not found"}), 404
+            if variant == 'preview':
+                path = self._preview_file(art_id, path)
+            
+            response = send_file(path)
+            # Browsers may reuse the image until the URL expires; shared caches must not
+            response.headers['Cache-Control'] = f"private, max-age={max(0, expires - int(time.time()))}"
+            return response
         
         @self.app.route('/', methods=['GET'])
         def index():
@@ -211,10 +364,102 @@ class SecurityManager:
                 "timestamp": datetime.utcnow().isoformat()
             })
     
+    @staticmethod
+    def _compile_route_policies(routes):
+        """Split routes into a set of exact paths and one anchored regex of prefixes"""
+        exact = {route for route in routes if not route.endswith('*')}
+        prefixes = [re.escape(route[:-1]) for route in routes if route.endswith('*')]
+        # Longest prefixes first, so the alternation prefers the most specific match
+        prefixes.sort(key=len, reverse=True)
+        pattern = re.compile('^(?:' + '|'.join(prefixes) + ')') if prefixes else None
+        return frozenset(exact), pattern
+    
+    def is_public(self, path):
+        """Whether path may be served without authentication"""
+        if path in self._public_exact:
+            return True
+        return bool(self._public_prefixes and self._public_prefixes.match(path))
+    
+    def _bearer_token(self):
+        auth_header = request.headers.get('Authorization', '')
+        if not auth_header.startswith('Bearer '):
+            return None
+        return auth_header[len('Bearer '):]
+    
+    def verify_token(self, token):
+        """Return the claims of a valid JWT, raising jwt.InvalidTokenError otherwise.
+        
+        The HMAC check runs once per token; later calls are answered from the
+        claims cache until the token expires.
+        """
+        digest = hashlib.sha256(token.encode('utf-8')).digest()
+        claims = self.claims_cache.get(digest)
+        if claims is not None:
+            return claims
+        
+        claims = jwt.decode(token, self.jwt_secret, algorithms=['HS256'])
+        ttl = claims['exp'] - time.time() if 'exp' in claims else self.claims_cache.ttl
+        if ttl > 0:
+            self.claims_cache.set(digest, claims, min(ttl, self.claims_cache.ttl))
+        return claims
+    
+    def _current_user_id(self):
+        """User behind the request's JWT (verified in before_request) or API key"""
+        if 'user_id' in g:
+            return g.user_id
+        token = self._bearer_token()
+        key_record = self.rental_system.api_keys.authenticate(token) if token else None
+        return key_record['user_id'] if key_record else None
+    
+    def _art_signature(self, art_id, user_id, variant, expires, file_path):
+        message = f"{art_id}:{user_id}:{variant}:{expires}:{file_path}".encode('utf-8')
+        digest = hmac.new(self.url_signing_key, message, hashlib.sha256).digest()
+        return base64.urlsafe_b64encode(digest).rstrip(b'=').decode('ascii')
+    
+    def sign_art_url(self, art_id, user_id, variant, expires, file_path):
+        """URL for an art image, valid for this user until `expires` (Unix time)"""
+        query = urlencode({
+            'u': user_id,
+            'e': expires,
+            'f': file_path,
+            's': self._art_signature(art_id, user_id, variant, expires, file_path)
+        })
+        return f"/api/media/art/{art_id}/{variant}?{query}"
+    
+    def _art_file(self, file_path):
+        """Locate a stored art image: absolute, under storage/, or next to the app"""
+        candidates = [file_path] if os.path.isabs(file_path) else [
+            os.path.join(self.rental_system.storage_path, file_path),
+            os.path.join(os.path.dirname(os.path.abspath(__file__)), file_path)
+        ]
+        for candidate in candidates:
+            if os.path.isfile(candidate):
+                return candidate
+        return None
+    
+    def _preview_file(self, art_id, path):
+        """Downscaled copy of an art image, rendered once and kept under storage/previews"""
+        preview_dir = os.path.join(self.rental_system.storage_path, 'previews')
+        source_digest = hashlib.sha256(path.encode('utf-8')).hexdigest()[:12]
+        preview_path = os.path.join(preview_dir, f"{art_id}_{source_digest}_{os.path.basename(path)}")
+        if not os.path.exists(preview_path):
+            from PIL import Image
+            os.makedirs(preview_dir, exist_ok=True)
+            image = Image.open(path)
+            image.thumbnail(self.PREVIEW_SIZE)
+            # Write then rename so concurrent requests never serve a partial file
+            tmp_path = f"{preview_path}.{os.getpid()}.tmp"
+            image.save(tmp_path, format=image.format or 'PNG')
+            os.replace(tmp_path, preview_path)
+        return preview_path
+    
     def _generate_token(self, user_id):
         """Generate JWT token for user"""
         payload = {
             'user_id': user_id,
+            # Unique id so the token can be revoked on its own, and the issue time for user-wide revocation
+            'jti': secrets.token_hex(16),
+            'iat': time.time(),
             'exp': datetime.utcnow() + timedelta(hours=self.token_expiry)
         }
         return jwt.encode(payload, self.jwt_secret, algorithm='HS256')
@@ -0,0 +1,31 @@
+from sqlalchemy import event
+
+def on_commit(session_factory, model, snapshot, callback):
+    """Call callback(added, updated, deleted) once a transaction touching `model` rows commits.
+
+    Objects are captured with snapshot(obj) at flush time, while their state is
+    still loaded, so the callback never triggers lazy loads on expired instances.
+    Changes from rolled back transactions are discarded.
+    """
+    key = object()
+
+    def after_flush(session, flush_context):
+        pending = session.info.get(key)
+        for index, objects in enumerate((session.new, session.dirty, session.deleted)):
+            for obj in objects:
+                if isinstance(obj, model):
+                    if pending is None:
+                        pending = session.info[key] = ([], [], [])
+                    pending[index].append(snapshot(obj))
+
+    def after_commit(session):
+        pending = session.info.pop(key, None)
+        if pending:
+            callback(*pending)
+
+    def after_rollback(session):
+        session.info.pop(key, None)
+
+    event.listen(session_factory, 'after_flush', after_flush)
+    event.listen(session_factory, 'after_commit', after_commit)
+    event.listen(session_factory, 'after_rollback', after_rollback)
@@ -1,7 +1,11 @@
 import unittest
+import io
 import json
 import os
 import sys
+import tempfile
+import datetime
+import time
 from flask import Flask
 from rental_system import create_app, RentalSystem
 from api_service import setup_api
@@ -9,6 +13,46 @@ from autonomous_features import setup_autonomous_features
 from security import setup_security
 from payment_processor import setup_payment_processor
 
+class WatchError(Exception):
+    """Raised by FakeRedis when a watched key changed before EXEC"""
+
+class FakeRedis:
+    """Just enough of the redis-py pipeline interface for the rate limiter"""
+    def __init__(self):
+        self.data = {}
+        self.versions = {}
+
+    def pipeline(self):
+        return FakeRedisPipeline(self)
+
+class FakeRedisPipeline:
+    def __init__(self, redis):
+        self.redis = redis
+        self.reset()
+
+    def watch(self, key):
+        self.watched[key] = self.redis.versions.get(key, 0)
+
+    def get(self, key):
+        return self.redis.data.get(key)
+
+    def multi(self):
+        self.queued = []
+
+    def set(self, key, value, ex=None):
+        self.queued.append((key, value))
+
+    def execute(self):
+        if any(self.redis.versions.get(k, 0) != v for k, v in self.watched.items()):
+            raise WatchError()
+        for key, value in self.queued:
+            self.redis.data[key] = value
+            self.redis.versions[key] = self.redis.versions.get(key, 0) + 1
+
+    def reset(self):
+        self.watched = {}
+        self.queued = []
+
 class TestArtLensAPI(unittest.TestCase):
     def setUp(self):
         """Set up test environment"""
@@ -195,6 +239,80 @@ class TestArtLensAPI(unittest.TestCase):
         self.assertGreaterEqual(price, 28.0)  # At least 7 days * 5.0 * 0.8 (min multiplier)
         self.assertLessEqual(price, 52.5)     # At most 7 days * 5.0 * 1.5 (max multiplier)
     
+    def test_batch_pricing(self):
+        """Test vectorized batch pricing against per-item prices"""
+        dynamic_pricing = self.app.config['DYNAMIC_PRICING']
+        
+        session = self.rental_system.Session()
+        styles = ['geometric', 'pixel', 'gradient', 'fractal', 'expressionist']
+        arts = [self.rental_system.ArtPiece(title=f"Priced {i}", file_path=f"priced_{i}.png", style=styles[i % 5],
+                                            color_palette='pastel', theme='ocean', rental_count=i)
+                for i in range(60)]
+        session.add_all(arts)
+        session.commit()
+        art_ids = [art.id for art in arts]
+        session.close()
+        
+        durations = [1 + i % 7 for i in range(60)]
+        prices = dynamic_pricing.calculate_prices(art_ids + [999999], durations + [2])
+        self.assertEqual(prices[:-1], [dynamic_pricing.calculate_price(a, d) for a, d in zip(art_ids, durations)])
+        # Missing pieces cost the base price
+        self.assertEqual(prices[-1], 10.0)
+        
+        # The batch endpoint prices a whole page with one call
+        api_key, _ = self.rental_system.api_keys.create(self.test_user_id, 'premium')
+        headers = {'Authorization': f"Bearer {api_key}"}
+        ids = ','.join(str(art_id) for art_id in art_ids[:50])
+        response = self.client.get(f'/api/art/quotes?ids={ids}&duration_days=3', headers=headers)
+        items = json.loads(response.data)['items']
+        self.assertEqual([item['price'] for item in items], dynamic_pricing.calculate_prices(art_ids[:50], 3))
+        self.assertEqual(items[7], self.rental_system.quotes.quote(art_ids[7], 3))
+        
+        # Durations are validated where requests come in rather than failing inside pricing
+        rent = {'user_id': self.test_user_id, 'art_id': art_ids[0]}
+        for duration, status in (('x', 400), (2.5, 400), (0, 400), ('3', 200), (3.0, 409)):
+            response = self.client.post('/api/rent', json=dict(rent, duration_days=duration), headers=headers)
+            self.assertEqual(response.status_code, status)
+        expected_price = dynamic_pricing.calculate_price(art_ids[1], 2)
+        response = self.client.post('/api/rent', json=dict(rent, art_id=art_ids[1], duration_days='2'), headers=headers)
+        self.assertEqual(json.loads(response.data)['price'], expected_price)
+    
+    def test_distilled_pricing(self):
+        """Test the price lookup table against the pricing forest"""
+        dynamic_pricing = self.app.config['DYNAMIC_PRICING']
+        report = dynamic_pricing.distillation_report(samples=500, timed=10)
+        # Every bucketed input is in the table, so lookups match the forest exactly
+        self.assertEqual(report['cells'], 6 * 6 * 6 * 11 * 2)
+        self.assertEqual(report['max_abs_error'], 0.0)
+        
+        session = self.rental_system.Session()
+        arts = [self.rental_system.ArtPiece(title="Popular", file_path="popular.png", style='fractal',
+                                            color_palette='neon', theme='space', rental_count=25),
+                self.rental_system.ArtPiece(title="Unusual", file_path="unusual.png", style='cubist',
+                                            color_palette='sepia', theme='ocean', rental_count=3)]
+        session.add_all(arts)
+        session.commit()
+        art_ids = [art.id for art in arts]
+        session.close()
+        
+        for art_id in art_ids:
+            features = dynamic_pricing.scaler.transform(dynamic_pricing._get_art_features(art_id))
+            multiplier = max(0.8, min(1.5, dynamic_pricing.model.predict(features)[0]))
+            self.assertEqual(dynamic_pricing.calculate_price(art_id, 3), round(5.0 * multiplier * 3, 2))
+        
+        # The saved table is loaded by the next instance instead of being distilled again
+        reloaded = type(dynamic_pricing)(self.rental_system)
+        self.assertTrue((reloaded.price_table == dynamic_pricing.price_table).all())
+        
+        # A table saved by another worker is reloaded on the next price, dropping quotes priced from the old one
+        reloaded.price_table = reloaded.price_table * 0 + 1
+        self.rental_system.quotes.quote(art_ids[0], 3)
+        self.assertEqual(self.rental_system.quotes.cache.stats()['size'], 1)
+        dynamic_pricing.distill()
+        reloaded.calculate_price(art_ids[0], 3)
+        self.assertTrue((reloaded.price_table == dynamic_pricing.price_table).all())
+        self.assertEqual(self.rental_system.quotes.cache.stats()['size'], 0)
+    
     def test_content_curation(self):
         """Test content curation"""
         # Get the content curation module
@@ -304,5 +422,1380 @@ class TestArtLensAPI(unittest.TestCase):
         self.assertGreaterEqual(len(posts), 1)
         self.assertIn('scheduled_time', posts[0])
 
+    def test_catalog_export_import(self):
+        """Test streaming catalog export and batched import"""
+        session = self.rental_system.Session()
+        for style in ['geometric', 'pixel', 'gradient']:
+            session.add(self.rental_system.ArtPiece(
+                title=f"Export {style.capitalize()}",
+                file_path=f"{style}.png",
+                style=style,
+                color_palette='vibrant',
+                theme='nature'
+            ))
+        session.commit()
+        art_count = session.query(self.rental_system.ArtPiece).count()
+        rented = session.query(self.rental_system.ArtPiece).filter_by(style='pixel').first()
+        now = datetime.datetime.utcnow()
+        session.add(self.rental_system.Rental(user_id=self.test_user_id, art_piece_id=rented.id, start_date=now,
+                                              end_date=now + datetime.timedelta(days=2), price=10.0, is_active=True))
+        session.commit()
+        rented_id = rented.id
+        session.close()
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            for fmt in ['jsonl', 'csv']:
+                path = os.path.join(tmp_dir, f"catalog.{fmt}")
+                counts = self.rental_system.export_catalog(path, batch_size=2, include_rentals=True)
+                self.assertEqual(counts['art_pieces'], art_count)
+
+                # Import into a fresh database
+                target = RentalSystem(None, database_url=f"sqlite:///{tmp_dir}/import_{fmt}.db")
+                progress = []
+                counts = target.import_catalog(path, batch_size=2,
+                                               progress=lambda table, done: progress.append(done))
+                self.assertEqual(counts['art_pieces'], art_count)
+                self.assertEqual(progress[-1], art_count)
+
+                session = target.Session()
+                titles = [art.title for art in session.query(target.ArtPiece).all()]
+                session.close()
+                self.assertIn("Export Pixel", titles)
+                self.assertEqual(target.facet_index.count(style='pixel'), 1)
+
+                # Rentals keep their art ids, and the state their hooks maintain is rebuilt
+                with self.assertRaises(ValueError):
+                    target.import_catalog(path, include_rentals=True, keep_ids=False)
+                target = RentalSystem(None, database_url=f"sqlite:///{tmp_dir}/rentals_{fmt}.db")
+                counts = target.import_catalog(path, batch_size=2, include_rentals=True)
+                self.assertEqual(counts['rentals'], 1)
+                self.assertTrue(target.availability.is_rented(rented_id, self.test_user_id, now,
+                                                              now + datetime.timedelta(days=1)))
+                self.assertEqual(target.entitlements.status(self.test_user_id)['rentals_used'], 1)
+                session = target.Session()
+                self.assertEqual(session.get(target.ArtPiece, rented_id).active_rental_count, 1)
+                session.close()
+
+            # Imports through the app's own rental system invalidate its cached listings
+            versions = self.app.config['RESPONSE_CACHE'].backend
+            before = versions.get_versions(['art'])[0]
+            self.rental_system.import_catalog(os.path.join(tmp_dir, 'catalog.jsonl'), keep_ids=False)
+            self.assertGreater(versions.get_versions(['art'])[0], before)
+
+    def test_list_art_pagination(self):
+        """Test keyset-paginated catalog listing"""
+        key_response = self.client.post('/api/generate-key', json={
+            'user_id': self.test_user_id,
+            'tier': 'enterprise'
+        })
+        api_key = json.loads(key_response.data)['api_key']
+        headers = {'Authorization': f'Bearer {api_key}'}
+
+        session = self.rental_system.Session()
+        for i in range(5):
+            session.add(self.rental_system.ArtPiece(
+                title=f"Listing {i}",
+                file_path=f"listing_{i}.png",
+                style='pixel' if i % 2 else 'fractal',
+                color_palette='ocean',
+                theme='space'
+            ))
+        session.commit()
+        session.close()
+
+        # Walk every page of pixel art two items at a time
+        seen = []
+        cursor = None
+        while True:
+            params = {'style': 'pixel', 'limit': 2}
+            if cursor:
+                params['cursor'] = cursor
+            response = self.client.get('/api/art/', query_string=params, headers=headers)
+            self.assertEqual(response.status_code, 200)
+            data = json.loads(response.data)
+            self.assertLessEqual(len(data['items']), 2)
+            seen.extend(item['id'] for item in data['items'])
+            cursor = data['next_cursor']
+            if not cursor:
+                break
+
+        self.assertEqual(len(seen), len(set(seen)))
+        self.assertGreaterEqual(len(seen), 2)
+
+        response = self.client.get('/api/art/?cursor=not-a-cursor', headers=headers)
+        self.assertEqual(response.status_code, 400)
+
+    def test_popularity_counters(self):
+        """Test rental counters maintained on art pieces"""
+        datetime = self.rental_system.datetime
+        now = datetime.datetime.utcnow()
+
+        session = self.rental_system.Session()
+        art = self.rental_system.ArtPiece(
+            title="Popular Art",
+            file_path="popular.png",
+            style='fractal',
+            color_palette='ocean',
+            theme='space'
+        )
+        session.add(art)
+        session.commit()
+        art_id = art.id
+
+        # One rental already over, one still running
+        for end_date in [now - datetime.timedelta(days=1), now + datetime.timedelta(days=7)]:
+            session.add(self.rental_system.Rental(
+                user_id=self.test_user_id,
+                art_piece_id=art_id,
+                start_date=now - datetime.timedelta(days=2),
+                end_date=end_date,
+                price=10.0,
+                is_active=True
+            ))
+        session.commit()
+        session.close()
+
+        session = self.rental_system.Session()
+        art = session.query(self.rental_system.ArtPiece).get(art_id)
+        self.assertEqual(art.rental_count, 2)
+        self.assertEqual(art.active_rental_count, 2)
+        self.assertIsNotNone(art.last_rented_at)
+        session.close()
+
+        # Expiring rentals decrements the active counter only
+        self.assertGreaterEqual(self.rental_system.expire_rentals(), 1)
+        session = self.rental_system.Session()
+        art = session.query(self.rental_system.ArtPiece).get(art_id)
+        self.assertEqual(art.rental_count, 2)
+        self.assertEqual(art.active_rental_count, 1)
+
+        # Reconciliation repairs drifted counters
+        art.rental_count = 0
+        session.commit()
+        self.rental_system.rebuild_popularity_counters()
+        art = session.query(self.rental_system.ArtPiece).get(art_id)
+        self.assertEqual(art.rental_count, 2)
+        self.assertEqual(art.active_rental_count, 1)
+        session.close()
+
+    def test_facet_index(self):
+        """Test in-memory facet filtering and counts"""
+        facet_index = self.rental_system.facet_index
+        # Unique palette so rows left by other tests don't affect the counts
+        palette = f"facet-{os.urandom(4).hex()}"
+
+        session = self.rental_system.Session()
+        for style, theme in [('pixel', 'space'), ('pixel', 'urban'), ('fractal', 'space')]:
+            session.add(self.rental_system.ArtPiece(
+                title=f"Facet {style} {theme}",
+                file_path=f"{style}_{theme}.png",
+                style=style,
+                color_palette=palette,
+                theme=theme
+            ))
+        session.commit()
+        session.close()
+
+        # Committed inserts are indexed incrementally
+        self.assertEqual(facet_index.count(style='pixel', color_palette=palette, theme='space'), 1)
+        self.assertEqual(facet_index.count(style=['pixel', 'fractal'], color_palette=palette, theme='space'), 2)
+
+        # A rebuild from the database gives the same answer
+        ids = list(facet_index.ids(style='pixel', color_palette=palette))
+        facet_index.rebuild()
+        self.assertEqual(list(facet_index.ids(style='pixel', color_palette=palette)), ids)
+        self.assertEqual(len(ids), 2)
+
+        counts = facet_index.facet_counts(color_palette=palette)
+        self.assertEqual(counts['theme']['space'], 2)
+        self.assertEqual(counts['style']['pixel'], 2)
+
+        # Rows written by another worker appear once the index is refreshed
+        with self.rental_system.engine.begin() as conn:
+            conn.execute(self.rental_system.ArtPiece.__table__.insert().values(
+                title="Facet other worker", file_path="other_worker.png",
+                style='pixel', color_palette=palette, theme='space'
+            ))
+        self.assertEqual(facet_index.count(style='pixel', color_palette=palette), 2)
+        refresh_interval = facet_index.refresh_interval
+        facet_index.refresh_interval = 0
+        try:
+            facet_index.count(style='pixel', color_palette=palette)
+            deadline = time.time() + 5
+            while facet_index.count(style='pixel', color_palette=palette) != 3 and time.time() < deadline:
+                time.sleep(0.05)
+        finally:
+            facet_index.refresh_interval = refresh_interval
+        self.assertEqual(facet_index.count(style='pixel', color_palette=palette), 3)
+
+    def test_rental_availability(self):
+        """Test overlap checks against the rental interval index"""
+        datetime = self.rental_system.datetime
+        availability = self.rental_system.availability
+        now = datetime.datetime.utcnow()
+        day = datetime.timedelta(days=1)
+
+        session = self.rental_system.Session()
+        art = self.rental_system.ArtPiece(
+            title="Availability Art",
+            file_path="availability.png",
+            style='gradient',
+            color_palette='pastel',
+            theme='ocean'
+        )
+        session.add(art)
+        session.commit()
+        art_id = art.id
+        session.add(self.rental_system.Rental(
+            user_id=self.test_user_id,
+            art_piece_id=art_id,
+            start_date=now,
+            end_date=now + 3 * day,
+            price=15.0,
+            is_active=True
+        ))
+        session.commit()
+        session.close()
+
+        self.assertTrue(availability.is_rented(art_id, self.test_user_id, now + 2 * day, now + 4 * day))
+        self.assertFalse(availability.is_rented(art_id, self.test_user_id, now + 3 * day, now + 4 * day))
+        self.assertTrue(availability.is_rented_now(art_id))
+        self.assertEqual(availability.free_pieces([art_id]), [])
+
+        # A fresh index loaded from the database agrees
+        availability.rebuild()
+        self.assertTrue(availability.is_rented(art_id, self.test_user_id, now, now + day))
+
+        # A rental committed by another worker is missing from this index, but the check
+        # inside the write transaction still refuses an overlapping one
+        key_response = self.client.post('/api/generate-key', json={
+            'user_id': self.test_user_id,
+            'tier': 'enterprise'
+        })
+        headers = {'Authorization': f"Bearer {json.loads(key_response.data)['api_key']}"}
+        with self.rental_system.engine.begin() as conn:
+            other_art_id = conn.execute(self.rental_system.ArtPiece.__table__.insert().values(
+                title="Other Worker Art", file_path="other.png", style='gradient', color_palette='pastel',
+                theme='ocean', created_at=now, rental_count=0, active_rental_count=0
+            )).inserted_primary_key[0]
+            conn.execute(self.rental_system.Rental.__table__.insert().values(
+                user_id=self.test_user_id, art_piece_id=other_art_id, start_date=now - day,
+                end_date=now + 10 * day, price=50.0, is_active=True
+            ))
+        self.assertFalse(availability.is_rented(other_art_id, self.test_user_id, now, now + day))
+        rent = {'user_id': self.test_user_id, 'art_id': other_art_id, 'duration_days': 1}
+        response = self.client.post('/api/rent', json=rent, headers=headers)
+        self.assertEqual(response.status_code, 409)
+        response = self.client.post('/api/rent/batch', json={'items': [rent]}, headers=headers)
+        self.assertEqual(json.loads(response.data)['items'][0]['status'], 409)
+
+    def test_rental_archival(self):
+        """Test moving old rentals to the archive with rollups"""
+        datetime = self.rental_system.datetime
+        now = datetime.datetime.utcnow()
+
+        session = self.rental_system.Session()
+        art = self.rental_system.ArtPiece(
+            title="Archived Art",
+            file_path="archived.png",
+            style='expressionist',
+            color_palette='earthy',
+            theme='urban'
+        )
+        session.add(art)
+        session.commit()
+        art_id = art.id
+        # The 300-day-old rental was never expired and still counts as active
+        for days_ago in [400, 300, 1]:
+            session.add(self.rental_system.Rental(
+                user_id=self.test_user_id,
+                art_piece_id=art_id,
+                start_date=now - datetime.timedelta(days=days_ago + 1),
+                end_date=now - datetime.timedelta(days=days_ago),
+                price=5.0,
+                is_active=days_ago == 300
+            ))
+        session.commit()
+        session.close()
+
+        user_version = self.app.config['RESPONSE_CACHE'].backend.get_versions([f"user:{self.test_user_id}"])[0]
+        self.assertGreaterEqual(self.rental_system.archive_rentals(retention_days=90, batch_size=1), 2)
+
+        session = self.rental_system.Session()
+        live = session.query(self.rental_system.Rental).filter(
+            self.rental_system.Rental.art_piece_id == art_id
+        ).count()
+        archived = session.query(self.rental_system.RentalArchive).filter(
+            self.rental_system.RentalArchive.art_piece_id == art_id
+        ).count()
+        rollup = session.query(self.rental_system.ArtRentalRollup).get(art_id)
+        self.assertEqual(live, 1)
+        self.assertEqual(archived, 2)
+        self.assertEqual(rollup.rental_count, 2)
+        self.assertEqual(rollup.total_revenue, 10.0)
+        # Archiving released the active rental and invalidated the user's cached responses
+        self.assertEqual(session.query(self.rental_system.ArtPiece).get(art_id).active_rental_count, 0)
+        self.assertGreater(self.app.config['RESPONSE_CACHE'].backend.get_versions([f"user:{self.test_user_id}"])[0],
+                           user_version)
+        self.assertEqual(session.query(self.rental_system.RentalArchive).filter(
+            self.rental_system.RentalArchive.is_active == True
+        ).count(), 0)
+        session.close()
+
+        # Counters rebuilt after archival still include archived rentals
+        self.rental_system.rebuild_popularity_counters()
+        session = self.rental_system.Session()
+        self.assertEqual(session.query(self.rental_system.ArtPiece).get(art_id).rental_count, 3)
+        session.close()
+
+        # A long live rental can have started before one that is already archived
+        session = self.rental_system.Session()
+        art = self.rental_system.ArtPiece(title="Long Rental", file_path="long.png",
+                                          style='expressionist', color_palette='earthy', theme='urban')
+        session.add(art)
+        session.flush()
+        long_art_id = art.id
+        archived_start = now - datetime.timedelta(days=201)
+        session.add_all([
+            self.rental_system.Rental(user_id=self.test_user_id, art_piece_id=long_art_id, price=5.0,
+                                      start_date=archived_start, end_date=now - datetime.timedelta(days=200),
+                                      is_active=False),
+            self.rental_system.Rental(user_id=self.test_user_id, art_piece_id=long_art_id, price=50.0,
+                                      start_date=now - datetime.timedelta(days=500),
+                                      end_date=now + datetime.timedelta(days=30), is_active=True)
+        ])
+        session.commit()
+        session.close()
+        self.assertGreaterEqual(self.rental_system.archive_rentals(retention_days=90), 1)
+        self.rental_system.rebuild_popularity_counters()
+        session = self.rental_system.Session()
+        self.assertEqual(session.query(self.rental_system.ArtPiece).get(long_art_id).last_rented_at, archived_start)
+        session.close()
+
+    def test_async_api(self):
+        """Test the asyncio rental system through the ASGI app"""
+        import asyncio
+        from sqlalchemy import select
+        from async_api import create_asgi_app
+
+        from unittest import mock
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            # Quotes are signed with the deployment's secret; there is no built-in fallback
+            from price_quotes import PriceQuotes
+            with mock.patch.dict(os.environ):
+                os.environ.pop('ARTLENS_PRICE_QUOTE_SECRET', None)
+                with self.assertRaises(RuntimeError):
+                    PriceQuotes(object()).check_secret()
+            with mock.patch.dict(os.environ, {'ARTLENS_PRICE_QUOTE_SECRET': 'async-test-secret'}):
+                app = create_asgi_app(f"sqlite+aiosqlite:///{tmp_dir}/async.db",
+                                      authenticate=lambda key: {'user_id': 1, 'tier': 'free'})
+
+            async def call(method, path, body=None):
+                sent = []
+                messages = [{'type': 'http.request', 'body': json.dumps(body).encode() if body else b''}]
+
+                async def receive():
+                    return messages.pop(0)
+
+                async def send(message):
+                    sent.append(message)
+
+                scope = {'type': 'http', 'method': method, 'path': path, 'query_string': b'',
+                         'headers': [(b'authorization', b'Bearer test-key')]}
+                await app(scope, receive, send)
+                return sent[0]['status'], json.loads(sent[1]['body'])
+
+            async def scenario():
+                rental_system = app.rental_system
+                await rental_system.setup_database()
+                async with rental_system.Session() as session:
+                    session.add(rental_system.User(username="asyncuser", email="async@example.com",
+                                                   password_hash="password123"))
+                    await session.commit()
+
+                status, art = await call('POST', '/api/generate-art', {'style': 'pixel'})
+                self.assertEqual(status, 200)
+                status, page = await call('GET', '/api/art/')
+                self.assertEqual([item['id'] for item in page['items']], [art['id']])
+
+                # Priced with the same quote service and pricing model as the Flask app
+                quote = rental_system.quotes.quote_art(await rental_system.get_art(art['id']), 2)
+                status, _ = await call('POST', '/api/rent', {'user_id': 1, 'art_id': art['id'],
+                                                            'duration_days': 2, 'quote': quote['quote'] + 'x'})
+                self.assertEqual(status, 400)
+                rent = {'user_id': '1', 'art_id': art['id'], 'duration_days': 2}
+                status, rental = await call('POST', '/api/rent', rent)
+                self.assertEqual(status, 200)
+                self.assertEqual(rental['price'], quote['price'])
+                status, _ = await call('POST', '/api/rent', rent)
+                self.assertEqual(status, 409)
+
+                # Async rentals count against and are limited by the user's plan
+                async with rental_system.Session() as session:
+                    counter = (await session.execute(select(rental_system.UsageCounter))).scalar_one()
+                    self.assertEqual(counter.rental_count, 1)
+                    now = datetime.datetime.utcnow()
+                    session.add(rental_system.Subscription(user_id=1, plan_id='basic', price=9.99, start_date=now,
+                                                           end_date=now + datetime.timedelta(days=30)))
+                    await session.commit()
+                status, denied = await call('POST', '/api/rent', rent)
+                self.assertEqual(status, 403)
+                self.assertEqual(denied['entitlement']['plan'], 'basic')
+
+                status, rentals = await call('GET', '/api/user/rentals')
+                self.assertEqual(len(rentals), 1)
+                await rental_system.close()
+
+            asyncio.run(scenario())
+
+    def test_rate_limiter(self):
+        """Test burst and daily rate limits on every storage backend"""
+        from rate_limiter import RateLimiter, MemoryBackend, SQLiteBackend, RedisBackend
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            backends = [
+                MemoryBackend(),
+                SQLiteBackend(os.path.join(tmp_dir, 'rate_limits.db')),
+                RedisBackend(FakeRedis(), watch_error=WatchError)
+            ]
+            for backend in backends:
+                clock = [1000.0]
+                limiter = RateLimiter(backend, {'free': 20}, {'free': (5, 60)}, clock=lambda: clock[0])
+
+                # Burst of 5, then throttled until tokens refill at one per second
+                decisions = [limiter.check('user-1', 'free') for _ in range(8)]
+                self.assertEqual(sum(d.allowed for d in decisions), 5)
+                self.assertGreaterEqual(decisions[-1].retry_after, 1)
+
+                clock[0] += 10
+                self.assertTrue(limiter.check('user-1', 'free').allowed)
+
+                # The daily quota still applies once bursts are spread out
+                allowed = 0
+                for _ in range(40):
+                    clock[0] += 2
+                    allowed += limiter.check('user-1', 'free').allowed
+                self.assertEqual(allowed, 20 - 6)
+
+                headers = RateLimiter.headers(limiter.check('user-1', 'free'))
+                self.assertEqual(headers['X-RateLimit-Remaining'], '0')
+                self.assertIn('Retry-After', headers)
+
+                # Requests refused by the daily quota give their burst tokens back
+                limiter = RateLimiter(backend, {'free': 2}, {'free': (5, 60)}, clock=lambda: clock[0])
+                self.assertEqual([limiter.check('user-2', 'free').allowed for _ in range(4)],
+                                 [True, True, False, False])
+                tokens, _ = backend.update('burst:user-2', lambda state: (state, state), 60)
+                self.assertEqual(tokens, 3)
+
+                # A cost above the burst capacity is charged the whole bucket, not refused forever
+                limiter = RateLimiter(backend, {'free': 20}, {'free': (5, 60)}, clock=lambda: clock[0])
+                self.assertTrue(limiter.check('user-3', 'free', cost=11).allowed)
+                denied = limiter.check('user-3', 'free')
+                self.assertFalse(denied.allowed)
+                clock[0] += denied.retry_after
+                decision = limiter.check('user-3', 'free')
+                self.assertTrue(decision.allowed)
+                self.assertEqual(decision.remaining, 20 - 12)
+
+            # Only an actual WATCH conflict is retried
+            class Unavailable(Exception):
+                pass
+            class FailingPipeline(FakeRedisPipeline):
+                def execute(self):
+                    raise Unavailable()
+            failing = FakeRedis()
+            failing.pipeline = lambda: FailingPipeline(failing)
+            with self.assertRaises(Unavailable):
+                RedisBackend(failing, watch_error=WatchError).update('k', lambda state: (state, None), 60)
+
+    def test_api_key_store(self):
+        """Test hashed API key storage, caching and revocation"""
+        key_response = self.client.post('/api/generate-key', json={
+            'user_id': self.test_user_id,
+            'tier': 'basic'
+        })
+        data = json.loads(key_response.data)
+        api_key = data['api_key']
+        headers = {'Authorization': f'Bearer {api_key}'}
+
+        # Only a salted hash is persisted
+        session = self.rental_system.Session()
+        stored = session.get(self.rental_system.ApiKey, data['key_id'])
+        self.assertNotIn(api_key, (stored.key_hash, stored.salt, stored.prefix))
+        session.close()
+
+        # A cold cache falls back to the database
+        self.rental_system.api_keys.cache.clear()
+        response = self.client.get('/api/keys', headers=headers)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(json.loads(response.data)[0]['tier'], 'basic')
+        self.assertEqual(self.rental_system.api_keys.authenticate(api_key)['user_id'], self.test_user_id)
+        self.assertIsNone(self.rental_system.api_keys.authenticate(api_key[:-1] + 'x'))
+
+        # Another worker has the key cached when this one revokes it
+        from api_keys import ApiKeyStore
+        other_worker = ApiKeyStore(self.rental_system, generation_interval=0.2)
+        self.assertEqual(other_worker.authenticate(api_key)['tier'], 'basic')
+        self.assertEqual(other_worker.authenticate(api_key)['tier'], 'basic')
+        self.assertEqual(other_worker.cache.stats()['hits'], 1)
+
+        response = self.client.delete(f"/api/keys/{data['key_id']}", headers=headers)
+        self.assertEqual(response.status_code, 200)
+        response = self.client.get('/api/keys', headers=headers)
+        self.assertEqual(response.status_code, 401)
+        # Cache hits skip the database, so the other worker only sees the revocation on its next generation poll
+        self.assertEqual(other_worker.authenticate(api_key)['tier'], 'basic')
+        time.sleep(0.25)
+        self.assertIsNone(other_worker.authenticate(api_key))
+
+    def test_batch_endpoints(self):
+        """Test batch art lookup, generation and rental"""
+        key_response = self.client.post('/api/generate-key', json={
+            'user_id': self.test_user_id,
+            'tier': 'free'
+        })
+        headers = {'Authorization': f"Bearer {json.loads(key_response.data)['api_key']}"}
+
+        response = self.client.post('/api/generate-art/batch', json={'items': [
+            {'style': 'pixel', 'color_palette': 'pastel', 'theme': 'space'},
+            'not a spec',
+            {'style': 'fractal', 'color_palette': 'ocean', 'theme': 'ocean'}
+        ]}, headers=headers)
+        self.assertEqual(response.status_code, 200)
+        items = json.loads(response.data)['items']
+        self.assertIn('error', items[1])
+        art_ids = [items[0]['id'], items[2]['id']]
+
+        # Results keep request order, including missing ids
+        response = self.client.get('/api/art/batch', query_string={'ids': f"{art_ids[1]},999999,{art_ids[0]}"},
+                                   headers=headers)
+        items = json.loads(response.data)['items']
+        self.assertEqual([items[0]['id'], items[2]['id']], [art_ids[1], art_ids[0]])
+        self.assertEqual(items[1]['error'], 'Art piece not found')
+
+        # Rentals are charged the current signed quote, whatever DynamicPricing makes of it
+        expected_price = self.rental_system.quotes.quote(art_ids[0], 2)['price']
+        response = self.client.post('/api/rent/batch', json={'items': [
+            {'user_id': self.test_user_id, 'art_id': art_ids[0], 'duration_days': 2},
+            {'user_id': self.test_user_id, 'art_id': art_ids[0], 'duration_days': 1},
+            {'user_id': self.test_user_id, 'art_id': 999999}
+        ]}, headers=headers)
+        items = json.loads(response.data)['items']
+        self.assertEqual(items[0]['price'], expected_price)
+        self.assertEqual([items[1]['status'], items[2]['status']], [409, 404])
+
+        # Each batch item counted against the free tier's daily quota of 100
+        self.assertEqual(response.headers['X-RateLimit-Remaining'], '91')
+
+        # A batch larger than the free burst capacity of 10 still goes through on a full bucket
+        other_key = json.loads(self.client.post('/api/generate-key', json={
+            'user_id': self.test_user_id + 1000,
+            'tier': 'free'
+        }).data)['api_key']
+        response = self.client.get('/api/art/batch', query_string={'ids': ','.join([str(art_ids[0])] * 11)},
+                                   headers={'Authorization': f'Bearer {other_key}'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.headers['X-RateLimit-Remaining'], '89')
+
+    def test_response_cache(self):
+        """Test cached read responses and commit-driven invalidation"""
+        from response_cache import ResponseCache, SharedMemoryBackend
+
+        key_response = self.client.post('/api/generate-key', json={
+            'user_id': self.test_user_id,
+            'tier': 'enterprise'
+        })
+        headers = {'Authorization': f"Bearer {json.loads(key_response.data)['api_key']}"}
+
+        session = self.rental_system.Session()
+        art = self.rental_system.ArtPiece(title="Cached", file_path="cached.png",
+                                          style='pixel', color_palette='ocean', theme='space')
+        session.add(art)
+        session.commit()
+        art_id = art.id
+
+        for name, backend in (('memory', None), ('shm', SharedMemoryBackend(f"artlens_test_{os.getpid()}"))):
+            cache = ResponseCache(self.rental_system, backend)
+            cache.register(self.rental_system.Session)
+            self.app.config['RESPONSE_CACHE'] = cache
+
+            first = self.client.get(f'/api/art/{art_id}', headers=headers)
+            second = self.client.get(f'/api/art/{art_id}', headers=headers)
+            self.assertEqual((first.headers['X-Cache'], second.headers['X-Cache']), ('MISS', 'HIT'), name)
+            self.assertEqual(first.data, second.data)
+
+            # Editing the piece invalidates its cached response
+            art.title = f"Renamed {name}"
+            session.commit()
+            response = self.client.get(f'/api/art/{art_id}', headers=headers)
+            self.assertEqual(response.headers['X-Cache'], 'MISS')
+            self.assertEqual(json.loads(response.data)['title'], f"Renamed {name}")
+
+            self.client.get('/api/payment/subscription-plans')
+            response = self.client.get('/api/payment/subscription-plans')
+            self.assertEqual(response.headers['X-Cache'], 'HIT')
+            self.assertEqual(cache.stats()['hit_rate'], 0.4)
+            if backend:
+                for suffix in ('', '-wal', '-shm'):
+                    if os.path.exists(backend.path + suffix):
+                        os.remove(backend.path + suffix)
+        session.close()
+
+    def test_ndjson_streaming(self):
+        """Test NDJSON streaming for rentals, listings and exports"""
+        key_response = self.client.post('/api/generate-key', json={
+            'user_id': self.test_user_id,
+            'tier': 'enterprise'
+        })
+        api_key = json.loads(key_response.data)['api_key']
+        headers = {'Authorization': f'Bearer {api_key}', 'Accept': 'application/x-ndjson'}
+
+        session = self.rental_system.Session()
+        now = datetime.datetime.utcnow()
+        for i in range(3):
+            art = self.rental_system.ArtPiece(title=f"Stream {i}", file_path=f"stream_{i}.png",
+                                              style='gradient', color_palette='earthy', theme='urban')
+            session.add(art)
+            session.flush()
+            session.add(self.rental_system.Rental(user_id=self.test_user_id, art_piece_id=art.id,
+                                                  start_date=now, end_date=now + datetime.timedelta(days=1),
+                                                  price=5.0, is_active=True))
+        session.commit()
+        session.close()
+
+        def lines(response):
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response.mimetype, 'application/x-ndjson')
+            return [json.loads(line) for line in response.data.decode().splitlines()]
+
+        rentals = lines(self.client.get('/api/user/rentals', headers=headers))
+        self.assertEqual([r['title'] for r in rentals][-3:], ["Stream 0", "Stream 1", "Stream 2"])
+
+        # Without a limit the whole filtered listing is streamed, not one page
+        listing = lines(self.client.get('/api/art/', query_string={'style': 'gradient'}, headers=headers))
+        self.assertGreaterEqual(len(listing), 3)
+        self.assertTrue(all(item['style'] == 'gradient' for item in listing))
+
+        exported = lines(self.client.get('/api/art/export', headers=headers))
+        self.assertTrue(all(record['table'] == 'art_pieces' for record in exported))
+        self.assertFalse(any('file_path' in record for record in exported))
+
+        # Streams are charged to the daily quota per page of rows emitted
+        from api_service import MAX_PAGE_SIZE
+        session = self.rental_system.Session()
+        session.add_all([self.rental_system.ArtPiece(title=f"Filler {i}", file_path=f"filler_{i}.png",
+                                                     style='pixel', color_palette='pastel', theme='space')
+                         for i in range(2 * MAX_PAGE_SIZE)])
+        session.commit()
+        session.close()
+
+        def quota_used(tier, user_id, path):
+            key = json.loads(self.client.post('/api/generate-key', json={
+                'user_id': user_id,
+                'tier': tier
+            }).data)['api_key']
+            records = lines(self.client.get(path, headers={'Authorization': f'Bearer {key}',
+                                                           'Accept': 'application/x-ndjson'}))
+            remaining = self.client.get('/api/art/', headers={'Authorization': f'Bearer {key}'})
+            return records, 1000 - int(remaining.headers['X-RateLimit-Remaining']) - 1
+
+        for offset, path in enumerate(('/api/art/export', '/api/art/')):
+            records, used = quota_used('basic', self.test_user_id + 2000 + offset, path)
+            self.assertFalse(any('file_path' in record for record in records))
+            self.assertGreater(len(records), 2 * MAX_PAGE_SIZE)
+            self.assertEqual(used, -(-len(records) // MAX_PAGE_SIZE))
+
+        # Once the quota runs out the stream ends with an error line
+        limiter = self.app.config['RATE_LIMITER']
+        limiter.charge(self.test_user_id + 3000, 'free', 99)
+        free_key = json.loads(self.client.post('/api/generate-key', json={
+            'user_id': self.test_user_id + 3000,
+            'tier': 'free'
+        }).data)['api_key']
+        records = lines(self.client.get('/api/art/export', headers={
+            'Authorization': f'Bearer {free_key}', 'Accept': 'application/x-ndjson'}))
+        self.assertEqual(len(records), MAX_PAGE_SIZE + 1)
+        self.assertEqual(records[-1], {"error": "Rate limit exceeded"})
+
+        history = lines(self.client.get('/api/user/rentals/history', headers=headers))
+        self.assertGreaterEqual(len(history), 3)
+
+        # Plain JSON clients keep the previous response shape
+        response = self.client.get('/api/user/rentals', headers={'Authorization': f'Bearer {api_key}'})
+        self.assertIsInstance(json.loads(response.data), list)
+
+    def test_metrics_endpoint(self):
+        """Test request, database and render metrics in Prometheus format"""
+        from metrics import setup_metrics
+        setup_metrics(self.app, self.rental_system)
+
+        self.client.get('/api/health')
+        self.client.get('/api/art/999999', headers={'Authorization': 'Bearer art_unknown'})
+        self.rental_system.generate_art('pixel', 'pastel', 'space')
+
+        response = self.client.get('/api/metrics')
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.content_type.startswith('text/plain'))
+        body = response.data.decode()
+
+        self.assertIn('artlens_http_requests_total{method="GET",route="/api/health",status="200"} 1', body)
+        self.assertIn('artlens_http_requests_total{method="GET",route="/api/art/<int:art_id>",status="401"} 1', body)
+        self.assertIn('artlens_http_request_duration_seconds_bucket{method="GET",route="/api/health",le="+Inf"} 1',
+                      body)
+        self.assertIn('artlens_art_render_duration_seconds_count{style="pixel"} 1', body)
+        self.assertIn('artlens_db_queries_total{operation="SELECT"}', body)
+        # The metrics request itself is still in flight while rendering
+        self.assertIn('artlens_http_requests_in_flight 1', body)
+
+    def test_idempotency_keys(self):
+        """Test replayed and concurrent requests sharing an Idempotency-Key"""
+        import threading
+
+        key_response = self.client.post('/api/generate-key', json={
+            'user_id': self.test_user_id,
+            'tier': 'enterprise'
+        })
+        api_key = json.loads(key_response.data)['api_key']
+
+        # Slow renders make the duplicate arrive while the first request runs
+        renders = []
+        generate_art = self.rental_system.generate_art
+        def slow_generate_art(*args):
+            renders.append(args)
+            time.sleep(0.2)
+            return generate_art(*args)
+        self.rental_system.generate_art = slow_generate_art
+
+        headers = {'Authorization': f'Bearer {api_key}', 'Idempotency-Key': 'render-1'}
+        spec = {'style': 'pixel', 'color_palette': 'pastel', 'theme': 'space'}
+        responses = []
+        def post():
+            client = self.app.test_client()
+            responses.append(client.post('/api/generate-art', json=spec, headers=headers))
+        threads = [threading.Thread(target=post) for _ in range(2)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(len(renders), 1)
+        self.assertEqual([r.status_code for r in responses], [200, 200])
+        self.assertEqual(json.loads(responses[0].data)['id'], json.loads(responses[1].data)['id'])
+        self.assertEqual(sorted(r.headers.get('Idempotent-Replayed', '') for r in responses), ['', 'true'])
+
+        # Reusing the key for a different request is rejected
+        response = self.client.post('/api/generate-art', json=dict(spec, theme='ocean'), headers=headers)
+        self.assertEqual(response.status_code, 422)
+
+        # Rentals replay the stored response instead of being charged twice
+        art_id = json.loads(responses[0].data)['id']
+        headers['Idempotency-Key'] = 'rent-1'
+        rent = {'user_id': self.test_user_id, 'art_id': art_id, 'duration_days': 1}
+        first = self.client.post('/api/rent', json=rent, headers=headers)
+        second = self.client.post('/api/rent', json=rent, headers=headers)
+        self.assertEqual(first.data, second.data)
+
+        # Expired records are purged
+        later = datetime.datetime.utcnow() + datetime.timedelta(days=2)
+        self.assertEqual(self.rental_system.idempotency.purge_expired(later), 2)
+
+        # A claim whose request died is taken over once its lease runs out
+        store = self.rental_system.idempotency
+        store.lease = 0.2
+        outcome, dead_claim = store.claim(self.test_user_id, 'dead-1', 'hash')
+        self.assertEqual(outcome, 'new')
+        with store._lock:
+            store._events.pop(dead_claim[1])
+        outcome, retry_claim = store.claim(self.test_user_id, 'dead-1', 'hash')
+        self.assertEqual(outcome, 'new')
+
+        # The request that lost its claim cannot store its response over the retry's
+        self.assertFalse(store.complete(dead_claim, 201, 'application/json', '{"stale": true}'))
+        self.assertTrue(store.complete(retry_claim, 200, 'application/json', '{}'))
+
+        # Completed responses outlive the lease
+        time.sleep(0.3)
+        self.assertEqual(store.claim(self.test_user_id, 'dead-1', 'hash'), ('replay', (200, 'application/json', '{}')))
+
+        # A request running longer than the lease keeps its claim while it is held
+        store.wait_timeout = 0.5
+        outcome, slow_claim = store.claim(self.test_user_id, 'slow-1', 'hash')
+        with store.hold(slow_claim):
+            self.assertEqual(store.claim(self.test_user_id, 'slow-1', 'hash'), ('timeout', None))
+        self.assertTrue(store.complete(slow_claim, 200, 'application/json', '{}'))
+
+    def test_traffic_capture_replay(self):
+        """Test capturing requests and replaying them with per-route reports"""
+        from traffic import TrafficCapture, Replayer, AppTarget, load_capture, compare_reports, main as traffic_main
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = os.path.join(tmp_dir, 'traffic.jsonl')
+            capture = TrafficCapture(path, sample_rate=1.0)
+            capture.instrument_app(self.app)
+
+            key_response = self.client.post('/api/generate-key', json={
+                'user_id': self.test_user_id,
+                'tier': 'enterprise'
+            })
+            api_key = json.loads(key_response.data)['api_key']
+            headers = {'Authorization': f'Bearer {api_key}'}
+            for art_id in (1, 2):
+                self.client.get(f'/api/art/{art_id}', headers=headers)
+            self.client.get('/api/health')
+            self.client.post('/api/user/login', json={'username': 'testuser', 'password': 'password123'})
+            self.client.get('/api/media/art/1/preview?u=1&e=1&s=secret-signature')
+            capture.close()
+
+            records = load_capture(path)
+            self.assertEqual([r['method'] for r in records], ['POST', 'GET', 'GET', 'GET', 'POST', 'GET'])
+            # Credentials are not written to the capture file
+            captured = open(path).read()
+            for secret in (api_key, 'password123', 'secret-signature'):
+                self.assertNotIn(secret, captured)
+            self.assertTrue(records[4]['redacted'])
+            records = records[1:4]
+
+            replayer = Replayer(AppTarget(self.app), concurrency=2, rate=200, headers=headers)
+            report = replayer.run(records * 5)
+            routes = report['routes']
+            self.assertEqual(routes['GET /api/art/<id>']['requests'], 10)
+            self.assertEqual(routes['ALL']['requests'], 15)
+            self.assertEqual(routes['GET /api/health']['error_rate'], 0)
+            self.assertLessEqual(routes['ALL']['p50_ms'], routes['ALL']['p99_ms'])
+
+            comparison = compare_reports(report, report)
+            self.assertFalse(any(entry['regression'] for entry in comparison.values()))
+
+        # In-process replays need a scratch database, never the application one
+        for argv in (['--synthetic', '1'], ['--synthetic', '1', '--database-url', 'sqlite:///artlens.db']):
+            with self.assertRaises(SystemExit):
+                traffic_main(argv)
+
+    def test_security_policies(self):
+        """Test compiled route policies and cached JWT verification with REQUIRE_JWT"""
+        app = create_app()
+        app.config['REQUIRE_JWT'] = True
+        rental_system = app.config['RENTAL_SYSTEM']
+        setup_api(app, rental_system)
+        security = setup_security(app, rental_system)
+        client = app.test_client()
+
+        self.assertTrue(security.is_public('/api/health'))
+        self.assertFalse(security.is_public('/api/healthz'))
+        self.assertFalse(security.is_public('/api/user/change-password'))
+
+        self.assertEqual(client.get('/api/health').status_code, 200)
+        response = client.post('/api/user/change-password', json={'old_password': 'x', 'new_password': 'y'})
+        self.assertEqual(response.status_code, 401)
+
+        login_response = client.post('/api/user/login', json={
+            'username': 'testuser',
+            'password': 'password123'
+        })
+        token = json.loads(login_response.data)['token']
+        response = client.post('/api/user/change-password',
+                               json={'old_password': 'password123', 'new_password': 'password456'},
+                               headers={'Authorization': f'Bearer {token}'})
+        self.assertEqual(response.status_code, 200)
+
+        # The password change revoked the old token; the signature check was served from the claims cache
+        response = client.post('/api/user/change-password',
+                               json={'old_password': 'password456', 'new_password': 'password123'},
+                               headers={'Authorization': f'Bearer {token}'})
+        self.assertEqual(response.status_code, 401)
+        self.assertEqual(security.claims_cache.stats()['hits'], 1)
+        self.assertEqual(security.claims_cache.stats()['misses'], 1)
+
+        response = client.post('/api/user/change-password', json={},
+                               headers={'Authorization': f'Bearer {token[:-2]}xx'})
+        self.assertEqual(response.status_code, 401)
+
+    def test_token_revocation(self):
+        """Test logout and password changes revoking JWTs behind the Bloom filter"""
+        from revocation import BloomFilter
+
+        app = create_app()
+        app.config['REQUIRE_JWT'] = True
+        rental_system = app.config['RENTAL_SYSTEM']
+        setup_api(app, rental_system)
+        security = setup_security(app, rental_system)
+        client = app.test_client()
+
+        def login():
+            response = client.post('/api/user/login', json={'username': 'testuser', 'password': 'password123'})
+            return {'Authorization': f"Bearer {json.loads(response.data)['token']}"}
+
+        def access(headers):
+            return client.get('/api/art/1/access-url?variant=preview', headers=headers).status_code
+
+        phone, laptop = login(), login()
+        self.assertEqual(access(phone), 404)
+        # Unrevoked tokens are cleared by the filter alone
+        self.assertEqual(security.revocations.lookups, 0)
+
+        self.assertEqual(client.post('/api/user/logout', headers=phone).status_code, 200)
+        self.assertEqual(access(phone), 401)
+        self.assertEqual(access(laptop), 404)
+
+        # A password change signs out every older token and hands back a fresh one
+        response = client.post('/api/user/change-password', headers=laptop,
+                               json={'old_password': 'password123', 'new_password': 'password456'})
+        fresh = {'Authorization': f"Bearer {json.loads(response.data)['token']}"}
+        self.assertEqual(access(laptop), 401)
+        self.assertEqual(access(fresh), 404)
+
+        # Another worker rebuilding from the table sees the same revocations
+        other = security.revocations.__class__(rental_system)
+        self.assertEqual(other.rebuild(), 2)
+        self.assertTrue(other.is_revoked(security.verify_token(phone['Authorization'][7:])))
+        self.assertFalse(other.is_revoked(security.verify_token(fresh['Authorization'][7:])))
+
+        # Stale filters are refreshed by one background thread while requests keep the old one
+        other.refresh_interval = 0
+        stale = other._filter
+        with other._rebuild_lock:
+            # A refresh is already running, so this request neither rebuilds nor waits
+            self.assertIs(other._current_filter(), stale)
+        other._current_filter()
+        with other._rebuild_lock:
+            # Acquired once the background refresh has swapped in the new filter
+            self.assertIsNot(other._filter, stale)
+        other.refresh_interval = 30
+
+        # Rows are dropped once their tokens would have expired anyway
+        later = datetime.datetime.utcnow() + datetime.timedelta(hours=security.token_expiry + 1)
+        self.assertEqual(other.purge_expired(later), 2)
+
+        bloom = BloomFilter(1000, 0.01)
+        for i in range(1000):
+            bloom.add(f"jti-{i}")
+        self.assertTrue(all(f"jti-{i}" in bloom for i in range(1000)))
+        false_positives = sum(1 for i in range(10000) if f"other-{i}" in bloom)
+        self.assertLess(false_positives, 300)
+
+    def test_password_hashing(self):
+        """Test scrypt hashes, legacy upgrade on login and rehash on cost changes"""
+        from passwords import PasswordHasher
+
+        # The test user was stored with a plaintext password; logging in upgrades it
+        response = self.client.post('/api/user/login', json={'username': 'testuser', 'password': 'password123'})
+        self.assertEqual(response.status_code, 200)
+        session = self.rental_system.Session()
+        stored = session.get(self.rental_system.User, self.test_user_id).password_hash
+        session.close()
+        self.assertTrue(stored.startswith('scrypt$16384$8$1$'))
+        self.assertNotIn('password123', stored)
+
+        response = self.client.post('/api/user/login', json={'username': 'testuser', 'password': 'password123'})
+        self.assertEqual(response.status_code, 200)
+        response = self.client.post('/api/user/login', json={'username': 'testuser', 'password': 'password124'})
+        self.assertEqual(response.status_code, 401)
+
+        cheap = PasswordHasher(n=2 ** 10, workers=1)
+        stronger = PasswordHasher(n=2 ** 11, workers=1)
+        stored = cheap.hash('s3cret-pass')
+        self.assertEqual(cheap.verify('s3cret-pass', stored), (True, False))
+        self.assertEqual(stronger.verify('s3cret-pass', stored), (True, True))
+        self.assertEqual(stronger.verify('wrong-pass', stored), (False, False))
+        cheap.shutdown()
+        stronger.shutdown()
+
+    def test_signed_art_urls(self):
+        """Test minting and serving signed, expiring art URLs"""
+        from PIL import Image
+        from sqlalchemy import event
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            # Previews are rendered under storage_path
+            self.rental_system.storage_path = tmp_dir
+            image_path = os.path.join(tmp_dir, 'signed.png')
+            Image.new('RGB', (600, 400), (200, 40, 90)).save(image_path)
+
+            now = datetime.datetime.utcnow()
+            session = self.rental_system.Session()
+            art = self.rental_system.ArtPiece(title="Signed", file_path=image_path,
+                                              style='gradient', color_palette='vibrant', theme='abstract')
+            session.add(art)
+            session.flush()
+            session.add(self.rental_system.Rental(user_id=self.test_user_id, art_piece_id=art.id,
+                                                  start_date=now, end_date=now + datetime.timedelta(minutes=5),
+                                                  price=5.0, is_active=True))
+            session.commit()
+            art_id = art.id
+            session.close()
+
+            login_response = self.client.post('/api/user/login', json={
+                'username': 'testuser',
+                'password': 'password123'
+            })
+            headers = {'Authorization': f"Bearer {json.loads(login_response.data)['token']}"}
+
+            response = self.client.get(f'/api/art/{art_id}/access-url', headers=headers)
+            self.assertEqual(response.status_code, 200)
+            data = json.loads(response.data)
+            # Capped at the rental's end rather than the default 15 minutes
+            self.assertLessEqual(datetime.datetime.fromisoformat(data['expires_at']),
+                                 now + datetime.timedelta(minutes=5))
+
+            # Delivery verifies the signature without a single SQL statement
+            statements = []
+            listener = lambda *args: statements.append(args[2])
+            event.listen(self.rental_system.engine, 'before_cursor_execute', listener)
+            response = self.client.get(data['url'])
+            event.remove(self.rental_system.engine, 'before_cursor_execute', listener)
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response.mimetype, 'image/png')
+            self.assertEqual(statements, [])
+
+            preview = json.loads(self.client.get(f'/api/art/{art_id}/access-url?variant=preview',
+                                                 headers=headers).data)
+            response = self.client.get(preview['url'])
+            self.assertEqual(Image.open(io.BytesIO(response.data)).size, (256, 171))
+
+            # Tampering with any signed field invalidates the URL
+            self.assertEqual(self.client.get(data['url'].replace('/full?', '/preview?')).status_code, 403)
+            self.assertEqual(self.client.get(data['url'].replace('u=', 'u=9')).status_code, 403)
+
+            security = self.app.config['SECURITY_MANAGER']
+            expired = security.sign_art_url(art_id, self.test_user_id, 'full', int(time.time()) - 1, image_path)
+            self.assertEqual(self.client.get(expired).status_code, 410)
+
+            # Without a rental only previews can be minted
+            session = self.rental_system.Session()
+            unrented = self.rental_system.ArtPiece(title="Unrented", file_path=image_path,
+                                                   style='gradient', color_palette='vibrant', theme='abstract')
+            session.add(unrented)
+            session.commit()
+            unrented_id = unrented.id
+            session.close()
+            response = self.client.get(f'/api/art/{unrented_id}/access-url', headers=headers)
+            self.assertEqual(response.status_code, 403)
+            response = self.client.get(f'/api/art/{unrented_id}/access-url?variant=preview', headers=headers)
+            self.assertEqual(response.status_code, 200)
+
+    def test_webhook_queue(self):
+        """Test webhook events being queued, deduplicated, retried and dead-lettered"""
+        import hmac
+        import hashlib
+
+        queue = self.app.config['WEBHOOK_QUEUE']
+        session = self.rental_system.Session()
+        art = self.rental_system.ArtPiece(title="Queued Art", file_path="queued.png",
+                                          style='pixel', color_palette='pastel', theme='urban')
+        session.add(art)
+        session.commit()
+        art_id = art.id
+        session.close()
+
+        def send(event_id, event_type='checkout.session.completed', checkout_id='cs_test_1', secret=None):
+            payload = json.dumps({
+                'id': event_id,
+                'object': 'event',
+                'type': event_type,
+                'data': {'object': {'id': checkout_id, 'metadata': {
+                    'art_id': art_id, 'user_id': self.test_user_id, 'duration_days': 2
+                }}}
+            })
+            timestamp = int(time.time())
+            signature = hmac.new((secret or 'whsec_saMPLEsaMPLEsaMPLEsaMPLEsaMPLEsaMPLE').encode(),
+                                 f"{timestamp}.{payload}".encode(), hashlib.sha256).hexdigest()
+            return self.client.post('/api/payment/webhook', data=payload, content_type='application/json',
+                                    headers={'Stripe-Signature': f"t={timestamp},v1={signature}"})
+
+        def rentals():
+            session = self.rental_system.Session()
+            found = session.query(self.rental_system.Rental).filter(
+                self.rental_system.Rental.payment_reference == 'cs_test_1'
+            ).count()
+            session.close()
+            return found
+
+        self.assertEqual(send('evt_1', secret='whsec_wrong').status_code, 400)
+        self.assertEqual(json.loads(send('evt_1').data)['status'], 'success')
+        self.assertEqual(json.loads(send('evt_1').data)['status'], 'duplicate')
+
+        # Acknowledged before processing; the rental appears once a worker drains the queue
+        self.assertEqual(rentals(), 0)
+        self.assertEqual(queue.drain(), 1)
+        self.assertEqual(rentals(), 1)
+
+        # A different event reporting the same checkout does not rent twice
+        send('evt_2')
+        queue.drain()
+        self.assertEqual(rentals(), 1)
+
+        # A paid checkout overlapping the rental is recorded for a refund, once
+        send('evt_4', checkout_id='cs_test_2')
+        send('evt_5', checkout_id='cs_test_2')
+        self.assertEqual(queue.drain(), 2)
+        session = self.rental_system.Session()
+        conflicts = session.query(self.rental_system.PaymentConflict).all()
+        self.assertEqual([c.payment_reference for c in conflicts], ['cs_test_2'])
+        session.close()
+        self.assertEqual(queue.stats()['dead'], 0)
+
+        # Checkout refuses the overlapping rental before taking payment
+        response = self.client.post('/api/payment/create-checkout-session', json={
+            'art_id': art_id, 'user_id': self.test_user_id, 'duration_days': 1
+        })
+        self.assertEqual(response.status_code, 409)
+
+        attempts = []
+        def flaky(session, event):
+            attempts.append(event['id'])
+            raise RuntimeError("downstream unavailable")
+        queue.handlers['test.flaky'] = flaky
+        queue.max_attempts = 2
+        send('evt_3', event_type='test.flaky')
+
+        self.assertEqual(queue.drain(), 1)
+        # Backed off: not due again until later
+        self.assertEqual(queue.drain(), 0)
+        later = datetime.datetime.utcnow() + datetime.timedelta(hours=1)
+        self.assertEqual(queue.drain(later), 1)
+        self.assertEqual(attempts, ['evt_3', 'evt_3'])
+        self.assertEqual(queue.stats(), {'pending': 0, 'done': 4, 'dead': 1, 'dead_letters': 1})
+
+        # Dead letters can be sent back through the queue once the cause is fixed
+        queue.handlers['test.flaky'] = lambda session, event: None
+        session = self.rental_system.Session()
+        letter_id = session.query(self.rental_system.WebhookDeadLetter.id).scalar()
+        session.close()
+        self.assertTrue(queue.requeue_dead_letter(letter_id))
+        queue.drain()
+        self.assertEqual(queue.stats(), {'pending': 0, 'done': 5, 'dead': 0, 'dead_letters': 0})
+
+    def test_price_quotes(self):
+        """Test signed price quotes priced once and honoured by rent and the payment webhook"""
+        from price_quotes import InvalidQuote
+
+        class CountingPricing:
+            calls = 0
+            def calculate_price(self, art_id, duration_days):
+                CountingPricing.calls += 1
+                return round(6.25 * duration_days, 2)
+        self.app.config['DYNAMIC_PRICING'] = CountingPricing()
+        quotes = self.rental_system.quotes
+
+        session = self.rental_system.Session()
+        arts = [self.rental_system.ArtPiece(title=f"Quoted {i}", file_path=f"quoted_{i}.png",
+                                            style='fractal', color_palette='ocean', theme='space') for i in range(2)]
+        session.add_all(arts)
+        session.commit()
+        art_id, webhook_art_id = arts[0].id, arts[1].id
+        session.close()
+
+        login_response = self.client.post('/api/user/login', json={'username': 'testuser', 'password': 'password123'})
+        headers = {'Authorization': f"Bearer {json.loads(login_response.data)['token']}"}
+
+        # Page views share one priced quote
+        first = json.loads(self.client.get(f'/api/art/{art_id}/quote?duration_days=2', headers=headers).data)
+        second = json.loads(self.client.get(f'/api/art/{art_id}/quote?duration_days=2', headers=headers).data)
+        self.assertEqual(first, second)
+        self.assertEqual(first['price'], 12.5)
+        self.assertEqual(CountingPricing.calls, 1)
+        self.assertEqual(self.client.get('/api/art/999999/quote', headers=headers).status_code, 404)
+
+        tampered = first['quote'][:-3] + ('AAA' if not first['quote'].endswith('AAA') else 'BBB')
+        for quote, duration in ((tampered, 2), (first['quote'], 3)):
+            response = self.client.post('/api/rent', headers=headers, json={
+                'user_id': self.test_user_id, 'art_id': art_id, 'duration_days': duration, 'quote': quote
+            })
+            self.assertEqual(response.status_code, 400)
+
+        response = self.client.post('/api/rent', headers=headers, json={
+            'user_id': self.test_user_id, 'art_id': art_id, 'duration_days': 2, 'quote': first['quote']
+        })
+        self.assertEqual(json.loads(response.data)['price'], 12.5)
+
+        # Expired quotes are refused at rent time but still honoured for payments already made
+        quotes.ttl = -10
+        expired = quotes.issue(webhook_art_id, 3, 9.99)['quote']
+        quotes.ttl = 900
+        with self.assertRaises(InvalidQuote):
+            quotes.verify(expired, webhook_art_id, 3)
+
+        queue = self.app.config['WEBHOOK_QUEUE']
+        queue.enqueue('evt_quote', 'checkout.session.completed', {'id': 'evt_quote', 'data': {'object': {
+            'id': 'cs_quote', 'metadata': {'art_id': webhook_art_id, 'user_id': self.test_user_id,
+                                           'duration_days': 3, 'quote': expired}
+        }}})
+        queue.drain()
+        session = self.rental_system.Session()
+        rental = session.query(self.rental_system.Rental).filter(
+            self.rental_system.Rental.payment_reference == 'cs_quote'
+        ).one()
+        self.assertEqual(rental.price, 9.99)
+        session.close()
+        self.assertEqual(CountingPricing.calls, 1)
+
+    def test_subscription_entitlements(self):
+        """Test plan limits enforced from materialized monthly usage counters"""
+        entitlements = self.rental_system.entitlements
+        now = datetime.datetime.utcnow()
+
+        session = self.rental_system.Session()
+        arts = [self.rental_system.ArtPiece(title=f"Plan {i}", file_path=f"plan_{i}.png",
+                                            style='gradient', color_palette='earthy', theme='abstract') for i in range(5)]
+        session.add_all(arts)
+        session.add(self.rental_system.Subscription(
+            user_id=self.test_user_id, plan_id='basic', price=9.99,
+            start_date=now - datetime.timedelta(days=1), end_date=now + datetime.timedelta(days=29)
+        ))
+        # Last month's rentals count against last month only
+        session.add(self.rental_system.Rental(
+            user_id=self.test_user_id, art_piece=arts[4], price=5.0, is_active=False,
+            start_date=now - datetime.timedelta(days=40), end_date=now - datetime.timedelta(days=39)
+        ))
+        session.commit()
+        art_ids = [art.id for art in arts]
+        session.close()
+
+        login_response = self.client.post('/api/user/login', json={'username': 'testuser', 'password': 'password123'})
+        headers = {'Authorization': f"Bearer {json.loads(login_response.data)['token']}"}
+
+        def rent(art_id, duration_days=1):
+            return self.client.post('/api/rent', headers=headers, json={
+                'user_id': self.test_user_id, 'art_id': art_id, 'duration_days': duration_days
+            })
+
+        # Basic allows one-day rentals only
+        response = rent(art_ids[0], duration_days=3)
+        self.assertEqual(response.status_code, 403)
+        self.assertEqual(json.loads(response.data)['entitlement']['max_duration_days'], 1)
+
+        response = rent(art_ids[0])
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(json.loads(response.data)['resolution'], 'standard')
+
+        # The batch may only use what is left of the allowance
+        response = self.client.post('/api/rent/batch', headers=headers, json={'items': [
+            {'user_id': self.test_user_id, 'art_id': art_id} for art_id in art_ids[1:4]
+        ]})
+        statuses = [item.get('status', 200) for item in json.loads(response.data)['items']]
+        self.assertEqual(statuses, [200, 200, 403])
+
+        # Checks after the first are answered from the cache, updated as rentals commit
+        misses = entitlements.cache.stats()['misses']
+        status = json.loads(self.client.get('/api/user/entitlements', headers=headers).data)
+        self.assertEqual((status['plan'], status['rentals_used'], status['rentals_remaining']), ('basic', 3, 0))
+        self.assertEqual(entitlements.cache.stats()['misses'], misses)
+        self.assertEqual(rent(art_ids[4]).status_code, 403)
+
+        # Counters rebuilt from history match the ones kept by the flush hook
+        session = self.rental_system.Session()
+        UsageCounter = self.rental_system.UsageCounter
+        kept = sorted(session.query(UsageCounter.user_id, UsageCounter.period, UsageCounter.rental_count).all())
+        session.close()
+        self.assertEqual(self.rental_system.rebuild_usage_counters(), 2)
+        session = self.rental_system.Session()
+        rebuilt = sorted(session.query(UsageCounter.user_id, UsageCounter.period, UsageCounter.rental_count).all())
+        session.close()
+        self.assertEqual(kept, rebuilt)
+
+        # Another worker takes the last rental after this one cached the usage; the conditional
+        # counter update in the rental transaction still refuses it
+        counters = UsageCounter.__table__
+        def set_usage(count):
+            with self.rental_system.engine.begin() as conn:
+                conn.execute(counters.update().where(counters.c.user_id == self.test_user_id,
+                                                     counters.c.period == now.strftime('%Y-%m')).values(rental_count=count))
+        set_usage(2)
+        entitlements.cache.clear()
+        self.assertTrue(entitlements.check(self.test_user_id, 1)[0])
+        set_usage(3)
+        response = rent(art_ids[4])
+        self.assertEqual(response.status_code, 403)
+        self.assertEqual(json.loads(response.data)['error'], 'Monthly rental limit of the basic plan reached')
+        session = self.rental_system.Session()
+        self.assertEqual(session.query(UsageCounter.rental_count).filter(
+            UsageCounter.user_id == self.test_user_id, UsageCounter.period == now.strftime('%Y-%m')
+        ).scalar(), 3)
+        self.assertEqual(session.query(self.rental_system.Rental).filter(
+            self.rental_system.Rental.art_piece_id == art_ids[4]).count(), 1)
+        session.close()
+
+    def test_payment_reconciliation(self):
+        """Test merge-joining checkout sessions against rentals and subscriptions, with resume"""
+        from reconciliation import PaymentReconciler, JsonlPaymentSource, StripePaymentSource
+
+        now = datetime.datetime.utcnow()
+        session = self.rental_system.Session()
+        art = self.rental_system.ArtPiece(title="Reconciled", file_path="reconciled.png",
+                                          style='pixel', color_palette='vibrant', theme='space')
+        session.add(art)
+        session.flush()
+        for reference, price in (('cs_a', 10.0), ('cs_b', 5.0), ('cs_b', 5.0), ('cs_c', 10.0), ('cs_local', 5.0)):
+            session.add(self.rental_system.Rental(
+                user_id=self.test_user_id, art_piece_id=art.id, price=price, payment_reference=reference,
+                start_date=now - datetime.timedelta(days=60), end_date=now - datetime.timedelta(days=59)
+            ))
+        session.add(self.rental_system.Subscription(
+            user_id=self.test_user_id, plan_id='basic', price=9.99, payment_reference='cs_sub',
+            start_date=now, end_date=now + datetime.timedelta(days=30)
+        ))
+        art_id = art.id
+        session.commit()
+        session.close()
+
+        def checkout(reference, amount, paid=True, mode='payment'):
+            metadata = {'user_id': str(self.test_user_id)}
+            metadata.update({'plan_id': 'basic'} if mode == 'subscription' else {'art_id': str(art_id)})
+            return {'id': reference, 'mode': mode, 'amount_total': amount, 'metadata': metadata,
+                    'payment_status': 'paid' if paid else 'unpaid'}
+        sessions = [checkout('cs_sub', 999, mode='subscription'), checkout('cs_missing', 500),
+                    checkout('cs_c', 999), checkout('cs_a', 1000), checkout('cs_unpaid', 500, paid=False),
+                    checkout('cs_b', 500)]
+        expected = {'payments': 6, 'local_only': 1, 'matched': 3, 'missing_record': 1,
+                    'duplicate_record': 1, 'amount_mismatch': 1, 'unknown_payment': 1}
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            fixture = os.path.join(tmp_dir, 'sessions.jsonl')
+            with open(fixture, 'w') as f:
+                f.writelines(json.dumps(item) + '\n' for item in sessions)
+            report = os.path.join(tmp_dir, 'report.jsonl')
+            checkpoint = os.path.join(tmp_dir, 'checkpoint.json')
+
+            # Runs of two payments force the external sort to spill and merge
+            counts = PaymentReconciler(self.rental_system, JsonlPaymentSource(fixture), report, run_size=2).run()
+            self.assertEqual(counts, expected)
+            with open(report) as f:
+                full_report = f.readlines()
+            self.assertEqual(sorted(json.loads(line)['reference'] for line in full_report),
+                             ['cs_b', 'cs_c', 'cs_local', 'cs_missing'])
+
+            class FakeStripe:
+                class checkout:
+                    class Session:
+                        @staticmethod
+                        def list(limit, starting_after=None):
+                            start = 0 if starting_after is None else \
+                                [item['id'] for item in sessions].index(starting_after) + 1
+                            return {'data': sessions[start:start + limit], 'has_more': start + limit < len(sessions)}
+            source = StripePaymentSource(FakeStripe, page_size=2)
+            self.assertEqual(PaymentReconciler(self.rental_system, source, report).run(), expected)
+
+            # Interrupted after three references, the next run resumes from the checkpoint
+            interrupted = PaymentReconciler(self.rental_system, source, report, checkpoint, checkpoint_every=1)
+            calls = []
+            def failing_compare(reference, payment, rows):
+                calls.append(reference)
+                if len(calls) > 3:
+                    raise RuntimeError("connection lost")
+                return PaymentReconciler.compare(reference, payment, rows)
+            interrupted.compare = failing_compare
+            with self.assertRaises(RuntimeError):
+                interrupted.run()
+            with open(checkpoint) as f:
+                self.assertEqual(json.load(f)['last_reference'], 'cs_c')
+
+            resumed = PaymentReconciler(self.rental_system, source, report, checkpoint, checkpoint_every=1)
+            self.assertEqual(resumed.run(), expected)
+            with open(report) as f:
+                self.assertEqual(f.readlines(), full_report)
+            self.assertFalse(os.path.exists(checkpoint))
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,355 @@
+import os
+import re
+import sys
+import math
+import json
+import time
+import random
+import argparse
+import threading
+import urllib.request
+import urllib.error
+from urllib.parse import parse_qsl, urlencode
+from concurrent.futures import ThreadPoolExecutor
+from flask import request, g
+from sqlalchemy.engine import make_url
+
+# Request headers worth replaying; credentials are never written to disk
+CAPTURED_HEADERS = ('Content-Type', 'Accept', 'Idempotency-Key')
+# Dropped even if they are ever added to CAPTURED_HEADERS
+SENSITIVE_HEADERS = {'authorization', 'cookie', 'stripe-signature', 'x-api-key'}
+# Bodies of these routes carry passwords, API keys or payment data and are not captured
+SENSITIVE_PATHS = ('/api/user/', '/api/payment/', '/api/generate-key', '/api/keys')
+# Query parameters holding secrets: tokens, keys and the signature of signed media URLs
+SENSITIVE_PARAMS = {'s', 'sig', 'signature', 'token', 'api_key', 'key'}
+
+def _scrub_query(query):
+    params = parse_qsl(query, keep_blank_values=True)
+    if not any(name in SENSITIVE_PARAMS for name, _ in params):
+        return query
+    return urlencode([(name, 'REDACTED' if name in SENSITIVE_PARAMS else value) for name, value in params])
+
+class TrafficCapture:
+    """Append a sample of served requests to a JSONL file for later replay"""
+
+    def __init__(self, path, sample_rate=0.01, max_body=65536):
+        self.path = path
+        self.sample_rate = sample_rate
+        self.max_body = max_body
+        self._lock = threading.Lock()
+        self._file = open(path, 'a', encoding='utf-8')
+
+    def instrument_app(self, app):
+        @app.before_request
+        def start_capture():
+            if random.random() < self.sample_rate:
+                g.capture_start = time.perf_counter()
+
+        @app.after_request
+        def write_capture(response):
+            start = g.pop('capture_start', None)
+            if start is not None:
+                self.record(response, time.perf_counter() - start)
+            return response
+
+    def record(self, response, seconds):
+        # Sensitive routes are still sampled, so the route mix stays realistic, but without their bodies
+        sensitive = request.path.startswith(SENSITIVE_PATHS)
+        body = None if sensitive else request.get_data(as_text=True)
+        entry = {
+            'ts': time.time(),
+            'method': request.method,
+            'path': request.path,
+            'query': _scrub_query(request.query_string.decode('latin-1')),
+            'headers': {name: request.headers[name] for name in CAPTURED_HEADERS
+                        if name in request.headers and name.lower() not in SENSITIVE_HEADERS},
+            'body': body if body is not None and len(body) <= self.max_body else None,
+            'redacted': sensitive,
+            'status': response.status_code,
+            'duration_ms': round(seconds * 1000, 3),
+        }
+        line = json.dumps(entry) + '\n'
+        with self._lock:
+            # Requests still finishing after close() are dropped
+            if not self._file.closed:
+                self._file.write(line)
+                self._file.flush()
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+
+
+def setup_traffic_capture(app):
+    """Enable capture when TRAFFIC_CAPTURE_PATH is configured (or ARTLENS_TRAFFIC_CAPTURE is set)"""
+    path = app.config.get('TRAFFIC_CAPTURE_PATH') or os.environ.get('ARTLENS_TRAFFIC_CAPTURE')
+    if not path:
+        return None
+    sample_rate = app.config.get('TRAFFIC_CAPTURE_SAMPLE_RATE',
+                                 float(os.environ.get('ARTLENS_TRAFFIC_SAMPLE_RATE', 0.01)))
+    capture = TrafficCapture(path, sample_rate)
+    capture.instrument_app(app)
+    app.config['TRAFFIC_CAPTURE'] = capture
+    return capture
+
+
+def load_capture(path):
+    """Read captured requests from a JSONL file"""
+    with open(path, 'r', encoding='utf-8') as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+def synthetic_traffic(count, art_ids, seed=None):
+    """Read-heavy request mix resembling gallery browsing, with occasional renders"""
+    rng = random.Random(seed)
+    styles = ['geometric', 'pixel', 'gradient', 'fractal', 'expressionist']
+    records = []
+    for _ in range(count):
+        roll = rng.random()
+        if roll < 0.4 and art_ids:
+            record = {'method': 'GET', 'path': f"/api/art/{rng.choice(art_ids)}"}
+        elif roll < 0.7:
+            record = {'method': 'GET', 'path': '/api/art/', 'query': f"style={rng.choice(styles)}&limit=20"}
+        elif roll < 0.8:
+            record = {'method': 'GET', 'path': '/api/art/facets'}
+        elif roll < 0.95:
+            record = {'method': 'GET', 'path': '/api/health'}
+        else:
+            body = {'style': rng.choice(styles), 'color_palette': 'vibrant', 'theme': 'nature'}
+            record = {'method': 'POST', 'path': '/api/generate-art', 'body': json.dumps(body),
+                      'headers': {'Content-Type': 'application/json'}}
+        records.append(record)
+    return records
+
+
+class AppTarget:
+    """Sends requests through Flask test clients, one per worker thread"""
+
+    def __init__(self, app):
+        self.app = app
+        self._local = threading.local()
+
+    def send(self, method, url, headers, body):
+        client = getattr(self._local, 'client', None)
+        if client is None:
+            client = self._local.client = self.app.test_client()
+        response = client.open(url, method=method, headers=headers, data=body)
+        response.get_data()
+        return response.status_code
+
+
+class HttpTarget:
+    """Sends requests to a running server"""
+
+    def __init__(self, base_url, timeout=30):
+        self.base_url = base_url.rstrip('/')
+        self.timeout = timeout
+
+    def send(self, method, url, headers, body):
+        req = urllib.request.Request(self.base_url + url, data=body.encode('utf-8') if body else None,
+                                     headers=headers, method=method)
+        try:
+            with urllib.request.urlopen(req, timeout=self.timeout) as response:
+                response.read()
+                return response.status
+        except urllib.error.HTTPError as e:
+            return e.code
+
+
+# Numeric path segments are grouped, so /api/art/12 and /api/art/13 report as one route
+_ID_SEGMENT = re.compile(r'/\d+(?=/|$)')
+
+def route_of(record):
+    return f"{record['method']} {_ID_SEGMENT.sub('/<id>', record['path'])}"
+
+def _percentile(sorted_values, p):
+    """Nearest-rank percentile of an already sorted list"""
+    if not sorted_values:
+        return 0.0
+    rank = max(1, math.ceil(p / 100.0 * len(sorted_values)))
+    return sorted_values[rank - 1]
+
+
+class Replayer:
+    """Drive traffic at a target with bounded concurrency and an optional request rate"""
+
+    def __init__(self, target, concurrency=4, rate=None, headers=None):
+        self.target = target
+        self.concurrency = concurrency
+        # Requests per second across all workers; None sends as fast as workers allow
+        self.rate = rate
+        # Added to every request, e.g. Authorization for the replaying client
+        self.headers = headers or {}
+
+    def run(self, records):
+        """Replay records and return the per-route report"""
+        results = [None] * len(records)
+        counter = iter(range(len(records)))
+        lock = threading.Lock()
+        started = time.perf_counter()
+
+        def worker():
+            while True:
+                with lock:
+                    index = next(counter, None)
+                if index is None:
+                    return
+                if self.rate:
+                    # Open-loop schedule: request i is due at i / rate seconds after the start
+                    delay = started + index / self.rate - time.perf_counter()
+                    if delay > 0:
+                        time.sleep(delay)
+                results[index] = self._send(records[index])
+
+        with ThreadPoolExecutor(max_workers=self.concurrency) as pool:
+            for _ in range(self.concurrency):
+                pool.submit(worker)
+
+        return self.report(records, results, time.perf_counter() - started)
+
+    def _send(self, record):
+        url = record['path'] + (f"?{record['query']}" if record.get('query') else '')
+        headers = dict(record.get('headers') or {})
+        headers.update(self.headers)
+        start = time.perf_counter()
+        try:
+            status = self.target.send(record['method'], url, headers, record.get('body'))
+        except Exception:
+            status = None
+        return status, time.perf_counter() - start
+
+    @staticmethod
+    def report(records, results, elapsed):
+        """Throughput, latency percentiles (ms) and error rate per route, plus an overall entry"""
+        routes = {}
+        for record, (status, seconds) in zip(records, results):
+            for name in (route_of(record), 'ALL'):
+                routes.setdefault(name, []).append((status, seconds))
+
+        report = {'elapsed_seconds': round(elapsed, 3), 'routes': {}}
+        for name, samples in sorted(routes.items()):
+            latencies = sorted(seconds * 1000 for _, seconds in samples)
+            errors = sum(1 for status, _ in samples if status is None or status >= 500)
+            report['routes'][name] = {
+                'requests': len(samples),
+                'throughput_rps': round(len(samples) / elapsed, 2) if elapsed else 0.0,
+                'p50_ms': round(_percentile(latencies, 50), 3),
+                'p95_ms': round(_percentile(latencies, 95), 3),
+                'p99_ms': round(_percentile(latencies, 99), 3),
+                'error_rate': round(errors / len(samples), 4),
+                'client_error_rate': round(
+                    sum(1 for status, _ in samples if status and 400 <= status < 500) / len(samples), 4
+                ),
+            }
+        return report
+
+
+def compare_reports(baseline, current, tolerance=0.1, min_delta_ms=1.0):
+    """Per-route changes against a baseline report.
+
+    A route regresses when its p95 grows by more than `tolerance` (10%) and by
+    at least `min_delta_ms`, so jitter on sub-millisecond routes is ignored,
+    or when its error rate rises.
+    """
+    comparison = {}
+    for name, now in current['routes'].items():
+        before = baseline['routes'].get(name)
+        if not before:
+            continue
+        entry = {}
+        for metric in ('p50_ms', 'p95_ms', 'p99_ms', 'throughput_rps', 'error_rate'):
+            old, new = before[metric], now[metric]
+            entry[metric] = {'baseline': old, 'current': new,
+                             'change': round((new - old) / old, 4) if old else None}
+        latency_change = entry['p95_ms']['change']
+        slower = (latency_change is not None and latency_change > tolerance
+                  and now['p95_ms'] - before['p95_ms'] >= min_delta_ms)
+        entry['regression'] = bool(slower or now['error_rate'] > before['error_rate'])
+        comparison[name] = entry
+    return comparison
+
+def print_report(report, comparison=None, out=sys.stdout):
+    out.write(f"{'route':<40} {'reqs':>7} {'rps':>9} {'p50':>9} {'p95':>9} {'p99':>9} {'err%':>7}\n")
+    for name, stats in report['routes'].items():
+        out.write(f"{name:<40} {stats['requests']:>7} {stats['throughput_rps']:>9} {stats['p50_ms']:>9} "
+                  f"{stats['p95_ms']:>9} {stats['p99_ms']:>9} {stats['error_rate'] * 100:>7.2f}\n")
+    for name, entry in (comparison or {}).items():
+        change = entry['p95_ms']['change']
+        flag = 'REGRESSION' if entry['regression'] else 'ok'
+        out.write(f"{name:<40} p95 {entry['p95_ms']['baseline']} -> {entry['p95_ms']['current']} ms "
+                  f"({'n/a' if change is None else f'{change:+.1%}'}) {flag}\n")
+
+
+def _same_database(url, other):
+    url, other = make_url(url), make_url(other)
+    if url.get_backend_name() == 'sqlite' and other.get_backend_name() == 'sqlite':
+        return os.path.abspath(url.database or '') == os.path.abspath(other.database or '')
+    return (url.get_backend_name(), url.host, url.port, url.database) == \
+        (other.get_backend_name(), other.host, other.port, other.database)
+
+def _app_target_with_key(database_url):
+    """Build the app from main.create_main_app on database_url and an enterprise API key to replay with"""
+    from main import create_main_app
+    app = create_main_app(database_url)
+    rental_system = app.config['RENTAL_SYSTEM']
+
+    session = rental_system.Session()
+    user = session.query(rental_system.User).filter(rental_system.User.username == 'loadtest').first()
+    if user is None:
+        user = rental_system.User(username='loadtest', email='loadtest@artlens.io', password_hash='!')
+        session.add(user)
+        session.commit()
+    user_id = user.id
+    art_ids = [art_id for (art_id,) in session.query(rental_system.ArtPiece.id).limit(1000)]
+    session.close()
+
+    api_key, _ = rental_system.api_keys.create(user_id, 'enterprise')
+    return AppTarget(app), api_key, art_ids
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Replay captured or synthetic traffic against ArtLens")
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument('--capture', help="JSONL file written by TrafficCapture")
+    source.add_argument('--synthetic', type=int, metavar='N', help="Generate N synthetic requests")
+    parser.add_argument('--target', help="Base URL of a running server; defaults to the in-process app")
+    parser.add_argument('--api-key', help="API key sent as a Bearer token")
+    parser.add_argument('--database-url',
+                        help="Scratch database for in-process replays, which write rentals, keys and art")
+    parser.add_argument('--concurrency', type=int, default=4)
+    parser.add_argument('--rate', type=float, help="Requests per second (default: as fast as possible)")
+    parser.add_argument('--seed', type=int)
+    parser.add_argument('--save-report', help="Write the JSON report here, e.g. to use as a baseline")
+    parser.add_argument('--baseline', help="Compare against a report saved earlier")
+    args = parser.parse_args(argv)
+
+    art_ids = []
+    if args.target:
+        target, api_key = HttpTarget(args.target), args.api_key
+    else:
+        from rental_system import DEFAULT_DATABASE_URL
+        # Replayed POSTs mutate whatever database the app runs on, so never default to the real one
+        if not args.database_url:
+            parser.error("--database-url is required unless --target is given")
+        if _same_database(args.database_url, DEFAULT_DATABASE_URL):
+            parser.error("--database-url must not be the application database")
+        target, api_key, art_ids = _app_target_with_key(args.database_url)
+        api_key = args.api_key or api_key
+
+    records = load_capture(args.capture) if args.capture else synthetic_traffic(args.synthetic, art_ids, args.seed)
+    headers = {'Authorization': f'Bearer {api_key}'} if api_key else {}
+    report = Replayer(target, args.concurrency, args.rate, headers).run(records)
+
+    comparison = None
+    if args.baseline:
+        with open(args.baseline, 'r', encoding='utf-8') as f:
+            comparison = compare_reports(json.load(f), report)
+    print_report(report, comparison)
+
+    if args.save_report:
+        with open(args.save_report, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=2)
+
+    # Non-zero exit lets CI fail on regressions against the baseline
+    return 1 if comparison and any(entry['regression'] for entry in comparison.values()) else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,216 @@
+import json
+import random
+import datetime
+import threading
+import traceback
+from sqlalchemy import select, update, delete
+from sqlalchemy.exc import IntegrityError
+
+class WebhookQueue:
+    """Durable queue of verified payment webhooks, processed by a pool of worker threads.
+
+    The webhook endpoint only inserts the event and acknowledges it, so its
+    latency does not depend on rental writes. Redeliveries of an event id are
+    dropped by a unique index. Workers claim events in batches by pushing their
+    available_at forward (a lease, so events held by a crashed worker come back),
+    then run the handler for the event type and mark the event done in the same
+    transaction. Failures are retried with exponential backoff; after
+    `max_attempts` the event is copied to the dead-letter table.
+    """
+
+    def __init__(self, rental_system, handlers=None, batch_size=50, workers=2, max_attempts=8,
+                 base_delay=2.0, max_delay=3600.0, lease=300, poll_interval=1.0):
+        self.rental_system = rental_system
+        # event type -> handler(session, event object); other types are acknowledged and ignored
+        self.handlers = dict(handlers or {})
+        self.batch_size = batch_size
+        self.workers = workers
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.lease = lease
+        self.poll_interval = poll_interval
+        self._wakeup = threading.Event()
+        self._stopping = threading.Event()
+        self._threads = []
+
+    def enqueue(self, event_id, event_type, payload):
+        """Store a verified event; returns False if the event id was already received"""
+        session = self.rental_system.Session()
+        session.add(self.rental_system.WebhookEvent(
+            event_id=event_id,
+            event_type=event_type,
+            payload=payload if isinstance(payload, str) else json.dumps(payload)
+        ))
+        try:
+            session.commit()
+        except IntegrityError:
+            session.rollback()
+            return False
+        finally:
+            session.close()
+        self._wakeup.set()
+        return True
+
+    def claim_batch(self, now=None):
+        """Lease up to batch_size due events to the caller; returns their ids"""
+        now = now or datetime.datetime.utcnow()
+        WebhookEvent = self.rental_system.WebhookEvent
+        session = self.rental_system.Session()
+        candidates = session.execute(
+            select(WebhookEvent.id)
+            .where(WebhookEvent.status == 'pending', WebhookEvent.available_at <= now)
+            .order_by(WebhookEvent.id)
+            .limit(self.batch_size)
+        ).scalars().all()
+
+        claimed = []
+        leased_until = now + datetime.timedelta(seconds=self.lease)
+        for event_id in candidates:
+            # Conditional update: a concurrent worker that leased the event first wins
+            result = session.execute(
+                update(WebhookEvent)
+                .where(WebhookEvent.id == event_id, WebhookEvent.status == 'pending',
+                       WebhookEvent.available_at <= now)
+                .values(available_at=leased_until)
+            )
+            if result.rowcount == 1:
+                claimed.append(event_id)
+        session.commit()
+        session.close()
+        return claimed
+
+    def process(self, event_id):
+        """Run the handler for one claimed event; returns True once it is done"""
+        WebhookEvent = self.rental_system.WebhookEvent
+        session = self.rental_system.Session()
+        event = session.get(WebhookEvent, event_id)
+        try:
+            handler = self.handlers.get(event.event_type)
+            if handler is not None:
+                handler(session, json.loads(event.payload))
+            event.status = 'done'
+            event.attempts += 1
+            event.processed_at = datetime.datetime.utcnow()
+            event.last_error = None
+            session.commit()
+            return True
+        except Exception:
+            session.rollback()
+            self._record_failure(session, event_id, traceback.format_exc(limit=5))
+            return False
+        finally:
+            session.close()
+
+    def backoff(self, attempts):
+        """Seconds before retry number `attempts`, with jitter so retries of a burst spread out"""
+        delay = min(self.max_delay, self.base_delay * 2 ** (attempts - 1))
+        return delay * random.uniform(0.5, 1.0)
+
+    def _record_failure(self, session, event_id, error):
+        event = session.get(self.rental_system.WebhookEvent, event_id)
+        now = datetime.datetime.utcnow()
+        event.attempts += 1
+        event.last_error = error
+        if event.attempts >= self.max_attempts:
+            # The event row stays, marked dead, so later redeliveries are still deduplicated
+            event.status = 'dead'
+            session.add(self.rental_system.WebhookDeadLetter(
+                event_id=event.event_id,
+                event_type=event.event_type,
+                payload=event.payload,
+                attempts=event.attempts,
+                last_error=error,
+                failed_at=now
+            ))
+        else:
+            event.available_at = now + datetime.timedelta(seconds=self.backoff(event.attempts))
+        session.commit()
+
+    def process_batch(self, now=None):
+        """Claim and process one batch; returns the number of events claimed"""
+        claimed = self.claim_batch(now)
+        for event_id in claimed:
+            self.process(event_id)
+        return len(claimed)
+
+    def drain(self, now=None):
+        """Process due events until none are left; returns how many were claimed"""
+        total = 0
+        while True:
+            count = self.process_batch(now)
+            if not count:
+                return total
+            total += count
+
+    def requeue_dead_letter(self, dead_letter_id):
+        """Give a dead-lettered event a fresh set of attempts"""
+        session = self.rental_system.Session()
+        letter = session.get(self.rental_system.WebhookDeadLetter, dead_letter_id)
+        if letter is None:
+            session.close()
+            return False
+        WebhookEvent = self.rental_system.WebhookEvent
+        session.execute(
+            update(WebhookEvent).where(WebhookEvent.event_id == letter.event_id).values(
+                status='pending', attempts=0, available_at=datetime.datetime.utcnow()
+            )
+        )
+        session.delete(letter)
+        session.commit()
+        session.close()
+        self._wakeup.set()
+        return True
+
+    def purge_processed(self, older_than_days=30, now=None):
+        """Delete done events older than the redelivery window; returns how many were removed"""
+        now = now or datetime.datetime.utcnow()
+        WebhookEvent = self.rental_system.WebhookEvent
+        session = self.rental_system.Session()
+        removed = session.execute(delete(WebhookEvent).where(
+            WebhookEvent.status == 'done',
+            WebhookEvent.processed_at <= now - datetime.timedelta(days=older_than_days)
+        )).rowcount
+        session.commit()
+        session.close()
+        return removed
+
+    def stats(self):
+        """Event counts by status plus the dead-letter backlog"""
+        WebhookEvent = self.rental_system.WebhookEvent
+        session = self.rental_system.Session()
+        counts = dict(session.execute(
+            select(WebhookEvent.status, self.rental_system.func.count(WebhookEvent.id)).group_by(WebhookEvent.status)
+        ).all())
+        dead_letters = session.query(self.rental_system.WebhookDeadLetter).count()
+        session.close()
+        return {'pending': counts.get('pending', 0), 'done': counts.get('done', 0),
+                'dead': counts.get('dead', 0), 'dead_letters': dead_letters}
+
+    def _worker(self):
+        while not self._stopping.is_set():
+            try:
+                processed = self.process_batch()
+            except Exception:
+                # Database hiccups must not kill the worker; try again after the poll interval
+                processed = 0
+            if not processed:
+                self._wakeup.wait(self.poll_interval)
+                self._wakeup.clear()
+
+    def start(self):
+        """Start the worker threads"""
+        if self._threads:
+            return
+        self._stopping.clear()
+        for index in range(self.workers):
+            thread = threading.Thread(target=self._worker, name=f"webhook-worker-{index}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self, timeout=5):
+        self._stopping.set()
+        self._wakeup.set()
+        for thread in self._threads:
+            thread.join(timeout)
+        self._threads = []